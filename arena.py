@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+An arena for checkpoints: a round-robin tournament between every pair of
+models, played by worker processes, or by threads of this process holding
+every model at once, with an Elo table fitted on all the results so far and
+rewritten after every game.
+"""
+
+from __future__ import print_function
+import glob
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+from game import Board, Game
+from models.mcts_alphaZero import MCTSPlayer
+from selfplay import load_policy_value_net
+
+# the nets loaded by this worker process, key: model_file
+_worker_nets = {}
+
+
+def _load_net(args, model_file):
+    if model_file not in _worker_nets:
+        _worker_nets[model_file] = load_policy_value_net(
+            args, model_file, inference_only=True,
+            intra_op_threads=args.tf_intra_op_threads,
+            inter_op_threads=args.tf_inter_op_threads)
+    return _worker_nets[model_file]
+
+
+def find_checkpoints(checkpoint_dir, pattern="*.model"):
+    """return the models saved in checkpoint_dir matching pattern, both the
+    single files of pytorch and the .index/.meta/.data files of tensorflow
+    """
+    model_files = set(glob.glob(os.path.join(checkpoint_dir, pattern)))
+    for path in glob.glob(os.path.join(checkpoint_dir, pattern + ".index")):
+        model_files.add(path[:-len(".index")])
+    return sorted(model_files)
+
+
+def fit_elo(n_players, results, prior_draws=1.0, n_iter=100):
+    """fit Bradley-Terry ratings by minorization-maximization, like BayesElo,
+    each player also draws prior_draws games against a virtual player of
+    rating 0 so that the ratings stay finite
+    results: [(i, j, score of i), ...] with score 1, 0.5 or 0
+    return: an array of ratings on the Elo scale, of mean 0
+    """
+    scores = np.full(n_players, 0.5 * prior_draws)
+    n_games = np.zeros((n_players, n_players))
+    for i, j, score in results:
+        scores[i] += score
+        scores[j] += 1 - score
+        n_games[i, j] += 1
+        n_games[j, i] += 1
+    gammas = np.ones(n_players)
+    for _ in range(n_iter):
+        denominators = (n_games / (gammas[:, None] + gammas[None, :])).sum(axis=1)
+        denominators += prior_draws / (gammas + 1)
+        gammas = scores / denominators
+    ratings = 400 * np.log10(gammas)
+    return ratings - ratings.mean()
+
+
+def _play_game(args, model_file1, model_file2, start_player):
+    """play one game between two checkpoints, loading each net once per
+    worker process
+    return: the winner, 1 for model_file1, 2 for model_file2, -1 for a tie
+    """
+    players = []
+    for model_file in [model_file1, model_file2]:
+        policy_value_net = _load_net(args, model_file)
+        players.append(MCTSPlayer(policy_value_net.policy_value_fn,
+                                  c_puct=5,
+                                  n_playout=args.n_playout))
+    board = Board(width=args.board_width,
+                  height=args.board_height,
+                  n_in_row=args.n_in_row,
+                  if_check_forbidden_hands=args.if_check_forbidden_hands)
+    return Game(board).start_play(players[0], players[1],
+                                  start_player=start_player, is_shown=0)
+
+
+class Arena(object):
+    """A round-robin tournament of the nets of args.model_type saved in
+    model_files, every pair plays n_games games, alternating the first
+    player, on n_workers processes, or on n_workers threads if use_threads;
+    the threads share one instance of every net, each with a graph and a
+    session of its own for tensorflow, and run concurrently while the nets
+    evaluate, since the sessions release the GIL.
+    """
+
+    def __init__(self, args, model_files, n_workers, n_games=2, use_threads=False):
+        self.args = args
+        self.model_files = list(model_files)
+        self.n_workers = n_workers
+        self.n_games = n_games
+        self.use_threads = use_threads
+        # (i, j, score of i)
+        self.results = []
+
+    def schedule(self):
+        """return the games to play as (i, j, start_player), the rounds of
+        all the pairs one after the other, so the table fills evenly
+        """
+        n = len(self.model_files)
+        return [(i, j, r % 2)
+                for r in range(self.n_games)
+                for i in range(n)
+                for j in range(i + 1, n)]
+
+    def table(self):
+        """return the rows of the Elo table, strongest first, as dicts of
+        model_file, elo, games, win, lose and tie
+        """
+        n = len(self.model_files)
+        ratings = fit_elo(n, self.results)
+        rows = [{"model_file": model_file, "elo": ratings[i],
+                 "games": 0, "win": 0, "lose": 0, "tie": 0}
+                for i, model_file in enumerate(self.model_files)]
+        for i, j, score in self.results:
+            rows[i]["games"] += 1
+            rows[j]["games"] += 1
+            if score == 0.5:
+                rows[i]["tie"] += 1
+                rows[j]["tie"] += 1
+            else:
+                winner, loser = (i, j) if score == 1 else (j, i)
+                rows[winner]["win"] += 1
+                rows[loser]["lose"] += 1
+        return sorted(rows, key=lambda row: -row["elo"])
+
+    def write_table(self, output_file):
+        with open(output_file + ".tmp", 'w', encoding='utf8') as fout:
+            fout.write("rank\telo\tgames\twin\tlose\ttie\tmodel_file\n")
+            for rank, row in enumerate(self.table()):
+                fout.write("{}\t{:.0f}\t{}\t{}\t{}\t{}\t{}\n".format(
+                    rank + 1, row["elo"], row["games"], row["win"],
+                    row["lose"], row["tie"], row["model_file"]))
+        # replace the table at once, so it can be read at any time
+        os.replace(output_file + ".tmp", output_file)
+
+    def run(self, output_file):
+        """play every game of the schedule, rewriting the Elo table in
+        output_file whenever a game is finished
+        return: the final table
+        """
+        if self.use_threads:
+            # load every net once, before the threads share them
+            for model_file in self.model_files:
+                _load_net(self.args, model_file)
+            executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        else:
+            # processes are spawned, since the deep learning frameworks
+            # are not fork-safe once a session exists
+            executor = ProcessPoolExecutor(max_workers=self.n_workers,
+                                           mp_context=multiprocessing.get_context("spawn"))
+        futures = {}
+        try:
+            for i, j, start_player in self.schedule():
+                future = executor.submit(_play_game, self.args,
+                                         self.model_files[i], self.model_files[j],
+                                         start_player)
+                futures[future] = (i, j)
+            for future in as_completed(futures):
+                i, j = futures[future]
+                winner = future.result()
+                score = 0.5 if winner == -1 else (1.0 if winner == 1 else 0.0)
+                self.results.append((i, j, score))
+                self.write_table(output_file)
+                print("{} games of {} played".format(len(self.results), len(futures)))
+        finally:
+            # drop the games not started yet, shutdown(cancel_futures=True)
+            # needs python 3.9
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+        return self.table()
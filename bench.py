@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Seeded benchmarks of the engine hot paths, for several board sizes:
+micro-benchmarks of Board, the numpy network and the data augmentation, and
+macro-benchmarks of the searches and of self-play.
+
+The results are printed, written as JSON with --output_file, and compared
+with a stored baseline with --baseline_file, in which case the exit status
+is 1 if any result is worse than the baseline by more than --threshold.
+
+python bench.py --output_file bench.json
+python bench.py --baseline_file bench.json --threshold 0.1
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import numpy as np
+from game import Board, Game
+from models.mcts_alphaZero import MCTSPlayer
+from models.mcts_pure import MCTSPlayer as MCTS_Pure
+from models.policy_value_net_numpy import PolicyValueNetNumpy
+from symmetry import get_equi_data
+
+
+def _timeit(fn, items, repeat=3):
+    """return the best over repeat runs of the mean time of fn per item, in us"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        elapsed = (time.perf_counter() - start) / len(items) * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def random_positions(width, height, n_positions, seed=0, max_moves=60):
+    """return n_positions seeded boards, played by random moves biased to the
+    centre so that the lines of stones, and forbidden hands, are frequent
+    """
+    rng = random.Random(seed)
+    center_h, center_w = height // 2, width // 2
+    boards = []
+    while len(boards) < n_positions:
+        board = Board(width=width, height=height, n_in_row=5)
+        board.init_board(rng.randint(0, 1))
+        for _ in range(rng.randint(5, max_moves)):
+            if not board.availables:
+                break
+            candidates = rng.sample(list(board.availables), min(4, len(board.availables)))
+            move = min(candidates, key=lambda m: abs(m // width - center_h) + abs(m % width - center_w))
+            board.do_move(move)
+            boards.append(board.clone())
+    return boards[:n_positions]
+
+
+def uniform_policy_value_fn(board):
+    """a stub network: uniform priors over the candidate moves and value 0,
+    so that the searches are measured without any inference cost
+    """
+    moves = board.candidate_moves()
+    return zip(moves, np.full(len(moves), 1.0 / len(moves))), 0.0
+
+
+def random_numpy_params(width, height, seed=0):
+    """return seeded random parameters of the numpy network, in the original
+    theano layout accepted by PolicyValueNetNumpy
+    """
+    rng = np.random.RandomState(seed)
+    n_cells = width * height
+    shapes = [(32, 4, 3, 3), (32,), (64, 32, 3, 3), (64,), (128, 64, 3, 3), (128,),
+              (4, 128, 1, 1), (4,), (4 * n_cells, n_cells), (n_cells,),
+              (2, 128, 1, 1), (2,), (2 * n_cells, 64), (64,), (64, 1), (1,)]
+    return [rng.normal(0, 0.1, shape).astype(np.float32) for shape in shapes]
+
+
+def bench_board(width, height, n_positions, seed=0):
+    boards = random_positions(width, height, n_positions, seed)
+    moves = [board.availables[0] if board.availables else None for board in boards]
+    boards_moves = [(b, m) for b, m in zip(boards, moves) if m is not None]
+
+    def do_undo(item):
+        board, move = item
+        board.do_move(move)
+        board.undo_move()
+
+    n_diff = 0
+    for board in boards:
+        n_diff += bool(board.check_forbidden_hands_by_patterns()) != board.check_forbidden_hands()
+    return {
+        "board.do_undo_move_us": (_timeit(do_undo, boards_moves), "us", False),
+        "board.has_a_winner_us": (_timeit(lambda b: b.has_a_winner(), boards), "us", False),
+        "board.game_end_us": (_timeit(lambda b: b.game_end(), boards), "us", False),
+        "board.current_state_us": (_timeit(lambda b: b.current_state(), boards), "us", False),
+        "board.check_forbidden_hands_us": (
+            _timeit(lambda b: b.check_forbidden_hands(), boards), "us", False),
+        "board.check_forbidden_hands_by_patterns_us": (
+            _timeit(lambda b: b.check_forbidden_hands_by_patterns(), boards), "us", False),
+        "board.forbidden_hands_mismatches": (n_diff, "positions", False),
+    }
+
+
+def bench_numpy_net(width, height, n_positions, seed=0):
+    net = PolicyValueNetNumpy(None, width, height, random_numpy_params(width, height, seed))
+    boards = random_positions(width, height, n_positions, seed)
+    return {
+        "net.numpy_policy_value_fn_us": (
+            _timeit(lambda b: list(net.policy_value_fn(b)[0]), boards, repeat=1), "us", False),
+        "net.numpy_policy_value_fn_batch_us_per_board": (
+            _timeit(net.policy_value_fn_batch, [boards], repeat=1) / len(boards), "us", False),
+    }
+
+
+def bench_equi_data(width, height, n_samples, seed=0):
+    boards = random_positions(width, height, n_samples, seed)
+    rng = np.random.RandomState(seed)
+    play_data = [(board.current_state(), rng.dirichlet(np.ones(width * height)), 1.0)
+                 for board in boards]
+    us = _timeit(lambda data: get_equi_data(data, height, width), [play_data])
+    return {"train.get_equi_data_samples_per_s": (n_samples / us * 1e6, "samples/s", True)}
+
+
+def _playouts_per_s(player, width, height, n_moves, n_playout, seed=0):
+    """time the first n_moves moves of a seeded game between two copies of
+    player, return the playouts per second
+    """
+    _seed(seed)
+    board = Board(width=width, height=height, n_in_row=5)
+    board.init_board(0)
+    start = time.perf_counter()
+    n_searches = 0
+    for _ in range(n_moves):
+        move = player.get_action(board)
+        n_searches += 1
+        board.do_move(move)
+        if board.game_end()[0]:
+            break
+    return n_searches * n_playout / (time.perf_counter() - start)
+
+
+def bench_mcts(width, height, n_playout, n_moves, seed=0):
+    numpy_net = PolicyValueNetNumpy(None, width, height, random_numpy_params(width, height, seed))
+    return {
+        "mcts_alphazero.stub_playouts_per_s": (_playouts_per_s(
+            MCTSPlayer(uniform_policy_value_fn, c_puct=5, n_playout=n_playout),
+            width, height, n_moves, n_playout, seed), "playouts/s", True),
+        "mcts_alphazero.numpy_playouts_per_s": (_playouts_per_s(
+            MCTSPlayer(numpy_net.policy_value_fn, c_puct=5, n_playout=n_playout),
+            width, height, n_moves, n_playout, seed), "playouts/s", True),
+        "mcts_pure.playouts_per_s": (_playouts_per_s(
+            MCTS_Pure(c_puct=5, n_playout=n_playout),
+            width, height, n_moves, n_playout, seed), "playouts/s", True),
+    }
+
+
+def bench_selfplay(width, height, n_playout, n_games, seed=0):
+    """self-play games of the stub network, which measures the search and
+    the game loop but not the inference
+    """
+    _seed(seed)
+    player = MCTSPlayer(uniform_policy_value_fn, c_puct=5, n_playout=n_playout, is_selfplay=1)
+    game = Game(Board(width=width, height=height, n_in_row=5))
+    start = time.perf_counter()
+    for _ in range(n_games):
+        game.start_self_play(player, temp=1.0)
+    return {"selfplay.stub_games_per_hour": (
+        n_games * 3600.0 / (time.perf_counter() - start), "games/h", True)}
+
+
+def run_benchmarks(args):
+    """return the results, a dict of name: (value, unit, higher_is_better)"""
+    results = {}
+    for size in [int(s) for s in args.board_sizes.split(",")]:
+        suite = {}
+        suite.update(bench_board(size, size, args.n_positions, args.seed))
+        suite.update(bench_numpy_net(size, size, max(1, args.n_positions // 20), args.seed))
+        suite.update(bench_equi_data(size, size, args.n_positions, args.seed))
+        suite.update(bench_mcts(size, size, args.n_playout, args.n_moves, args.seed))
+        suite.update(bench_selfplay(size, size, args.selfplay_playout, args.n_games, args.seed))
+        for name, result in suite.items():
+            results["{0}x{0}/{1}".format(size, name)] = result
+        print("{0}x{0} done".format(size))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """return the names of the results worse than the baseline by more than
+    threshold, a fraction of the baseline value
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        value, unit, higher_is_better = results[name]
+        base = baseline[name]["value"]
+        if base == 0:
+            worse = value > 0 and not higher_is_better
+        elif higher_is_better:
+            worse = value < base * (1 - threshold)
+        else:
+            worse = value > base * (1 + threshold)
+        change = (value - base) / base if base else 0.0
+        print("{:<60} {:>12.2f} {:>12.2f} {:>+8.1%} {}".format(
+            name, base, value, change, "REGRESSION" if worse else ""))
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--board_sizes", default="6,9,15", type=str,
+                        help="comma separated board sizes to benchmark")
+    parser.add_argument("--n_positions", default=2000, type=int,
+                        help="num of positions of the micro-benchmarks per board size")
+    parser.add_argument("--n_playout", default=200, type=int, help="num of playouts per move of the searches")
+    parser.add_argument("--n_moves", default=6, type=int, help="num of moves timed per search benchmark")
+    parser.add_argument("--selfplay_playout", default=50, type=int, help="num of playouts per move of self-play")
+    parser.add_argument("--n_games", default=1, type=int, help="num of self-play games per board size")
+    parser.add_argument("--seed", default=0, type=int, help="random seed of the benchmarks")
+    parser.add_argument("--output_file", default=None, type=str, help="write the results as JSON to this file")
+    parser.add_argument("--baseline_file", default=None, type=str,
+                        help="compare the results with the JSON results of an earlier run")
+    parser.add_argument("--threshold", default=0.1, type=float,
+                        help="a result worse than the baseline by more than this fraction is a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    for name in sorted(results):
+        value, unit, higher_is_better = results[name]
+        print("{:<60} {:>12.2f} {}".format(name, value, unit))
+    if args.output_file is not None:
+        with open(args.output_file, 'w', encoding='utf8') as fout:
+            json.dump({"config": vars(args),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "results": {name: {"value": value, "unit": unit,
+                                          "higher_is_better": higher_is_better}
+                                   for name, (value, unit, higher_is_better) in results.items()}},
+                      fout, indent=2, sort_keys=True)
+    if args.baseline_file is not None:
+        with open(args.baseline_file, encoding='utf8') as fin:
+            baseline = json.load(fin)["results"]
+        print("{:<60} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "current", "change"))
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("{} regressions above {:.0%}".format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -45,10 +45,25 @@ parser.add_argument("--model_file2", default='./best_policy.model', type=str,
 parser.add_argument("--round_num",default=2,type=int,help="round number")
 parser.add_argument("--n_playout",default=400,type=int,help="n_playout")
 parser.add_argument("--n_layer_resnet", default=-1, type=int, help="num of simulations for each move.")
+parser.add_argument("--use_xla", action='store_true',
+                    help="compile the frozen inference graphs of the tensorflow models with XLA")
 parser.add_argument("--enable_gui", action='store_true',
                     help="enable_gui")
 parser.add_argument("--if_check_forbidden_hands", action='store_true',
                     help="if check forbidden hands, default false")
+parser.add_argument("--arena_dir", default=None, type=str,
+                    help="directory of checkpoints of model_type1 to rank in a round-robin tournament, "
+                         "each pair plays round_num games")
+parser.add_argument("--arena_pattern", default="*.model", type=str,
+                    help="glob pattern of the checkpoints in arena_dir, e.g. */current_policy.model")
+parser.add_argument("--arena_workers", default=4, type=int,
+                    help="num of worker processes playing the arena games")
+parser.add_argument("--arena_threads", action='store_true',
+                    help="play the arena games on arena_workers threads of this process, which holds every model at once")
+parser.add_argument("--tf_intra_op_threads", default=0, type=int,
+                    help="intra-op threads of the session of each tensorflow model, 0 for the default")
+parser.add_argument("--tf_inter_op_threads", default=0, type=int,
+                    help="inter-op threads of the session of each tensorflow model, 0 for the default")
 
 
 args, _ = parser.parse_known_args()
@@ -135,6 +150,10 @@ def get_mcts_player(model_type, model_file, width, height):
                                    encoding='bytes')  # To support python3
 
         best_policy = MODEL_CLASSES[model_type](args, width, height, policy_param)
+    elif model_type == "tensorflow":
+        # only the heads are needed to play
+        best_policy = MODEL_CLASSES[model_type](args, width, height, model_file=model_file,
+                                                inference_only=True, use_xla=args.use_xla)
     else:
         best_policy = MODEL_CLASSES[model_type](args, width, height, model_file=model_file)
     mcts_player = MCTSPlayer(best_policy.policy_value_fn,
@@ -142,6 +161,22 @@ def get_mcts_player(model_type, model_file, width, height):
                              n_playout=args.n_playout)  # set larger n_playout for better performance
     return mcts_player
 from UI.gui import GUI
+from arena import Arena, find_checkpoints
+def run_arena():
+    arena_args = argparse.Namespace(**vars(args))
+    arena_args.model_type = args.model_type1
+    model_files = find_checkpoints(args.arena_dir, args.arena_pattern)
+    if len(model_files) < 2:
+        raise Exception('the arena needs at least two checkpoints in {}'.format(args.arena_dir))
+    print("{} checkpoints in the arena".format(len(model_files)))
+    output_file = os.path.join(args.output_dir, "arena_elo.tsv")
+    arena = Arena(arena_args, model_files, args.arena_workers, n_games=args.round_num,
+                  use_threads=args.arena_threads)
+    table = arena.run(output_file)
+    print("output elo table to {}".format(output_file))
+    for rank, row in enumerate(table):
+        print("{}\t{:.0f}\t{}".format(rank + 1, row["elo"], row["model_file"]))
+
 def run():
     n = args.n_in_row
     width, height = args.board_width, args.board_height
@@ -192,4 +227,7 @@ def run():
 if __name__ == '__main__':
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
-    run()
+    if args.arena_dir is not None:
+        run_arena()
+    else:
+        run()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous evaluation of the trained policy: the games against the pure
+MCTS player are played by a pool of worker processes on a snapshot of the
+weights, while the trainer keeps training.
+"""
+
+from __future__ import print_function
+import glob
+import math
+import multiprocessing
+import os
+import shutil
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from game import Board, Game
+from models.mcts_alphaZero import MCTSPlayer
+from models.mcts_pure import MCTSPlayer as MCTS_Pure
+from selfplay import load_policy_value_net
+
+# the net of the snapshot last played by this worker process
+_worker_cache = {}
+
+
+def elo_difference(score, n_games):
+    """estimate the Elo difference to the opponent from a score in [0, 1],
+    clipped by half a game so that a clean sweep stays finite
+    """
+    eps = 0.5 / n_games
+    score = min(max(score, eps), 1 - eps)
+    return -400.0 * math.log10(1.0 / score - 1.0)
+
+
+def copy_model(src, dst):
+    """copy every file of the model saved at src, e.g. the .index, .meta and
+    .data files of a tensorflow checkpoint, to dst
+    """
+    for path in glob.glob(src + "*"):
+        shutil.copyfile(path, dst + path[len(src):])
+
+
+def remove_model(path):
+    for p in glob.glob(path + "*"):
+        os.remove(p)
+
+
+def _evaluate_game(args, model_file, pure_mcts_playout_num, start_player):
+    """play one game of the snapshot model_file against the pure MCTS player
+    return: the winner, 1 for the snapshot, 2 for the pure MCTS, -1 for a tie
+    """
+    if _worker_cache.get("model_file") != model_file:
+        policy_value_net = _worker_cache.get("policy_value_net")
+        if policy_value_net is not None and hasattr(policy_value_net, "restore_model"):
+            policy_value_net.restore_model(model_file)
+        else:
+            policy_value_net = load_policy_value_net(args, model_file, inference_only=True)
+        _worker_cache["policy_value_net"] = policy_value_net
+        _worker_cache["model_file"] = model_file
+    policy_value_net = _worker_cache["policy_value_net"]
+    board = Board(width=args.board_width,
+                  height=args.board_height,
+                  n_in_row=args.n_in_row,
+                  ef_for_eight=args.ef_for_eight,
+                  if_check_forbidden_hands=args.if_check_forbidden_hands)
+    current_mcts_player = MCTSPlayer(policy_value_net.policy_value_fn,
+                                     c_puct=args.c_puct,
+                                     n_playout=args.n_playout,
+                                     ef_for_eight=args.ef_for_eight,
+                                     n_batch=args.mcts_batch_size,
+                                     policy_value_batch_function=policy_value_net.policy_value_fn_batch,
+                                     cache_size=args.mcts_cache_size,
+                                     prune_radius=args.prune_radius,
+                                     prune_top_k=args.prune_top_k,
+                                     solver_depth=args.solver_depth,
+                                     solver_in_tree=args.solver_in_tree)
+    pure_mcts_player = MCTS_Pure(c_puct=5,
+                                 n_playout=pure_mcts_playout_num,
+                                 n_rollout=args.pure_mcts_n_rollout)
+    return Game(board).start_play(current_mcts_player,
+                                  pure_mcts_player,
+                                  start_player=start_player,
+                                  is_shown=0)
+
+
+class AsyncEvaluator(object):
+    """Evaluate snapshots of the policy-value net in n_workers processes.
+    submit() saves a snapshot and queues its games, poll() returns the
+    results of the evaluations whose games are all finished, oldest first.
+    """
+
+    def __init__(self, args, n_workers):
+        self.args = args
+        self.snapshot_dir = os.path.join(args.output_dir, "eval")
+        if not os.path.exists(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        # processes are spawned, since the deep learning frameworks
+        # are not fork-safe once a session exists
+        self._executor = ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"))
+        self._pending = []
+
+    def submit(self, step_index, policy_value_net, pure_mcts_playout_num, n_games=6):
+        model_file = os.path.join(self.snapshot_dir, "eval_policy_{}.model".format(step_index))
+        policy_value_net.save_model(model_file)
+        futures = [self._executor.submit(_evaluate_game, self.args, model_file,
+                                         pure_mcts_playout_num, i % 2)
+                   for i in range(n_games)]
+        self._pending.append((step_index, model_file, pure_mcts_playout_num, futures))
+
+    def __len__(self):
+        """num of evaluations not returned by poll() yet"""
+        return len(self._pending)
+
+    def poll(self, wait=False):
+        """return the finished evaluations, waiting for all of them if wait,
+        as a list of dicts of step_index, model_file (the snapshot, to be
+        removed by the caller), num_playouts, win, lose, tie, win_ratio and
+        elo, the Elo difference to the pure MCTS player
+        """
+        results = []
+        while self._pending:
+            step_index, model_file, pure_mcts_playout_num, futures = self._pending[0]
+            if not wait and not all(future.done() for future in futures):
+                break
+            self._pending.pop(0)
+            win_cnt = defaultdict(int)
+            for future in futures:
+                win_cnt[future.result()] += 1
+            n_games = len(futures)
+            win_ratio = 1.0*(win_cnt[1] + 0.5*win_cnt[-1]) / n_games
+            results.append({"step_index": step_index,
+                            "model_file": model_file,
+                            "num_playouts": pure_mcts_playout_num,
+                            "win": win_cnt[1],
+                            "lose": win_cnt[2],
+                            "tie": win_cnt[-1],
+                            "win_ratio": win_ratio,
+                            "elo": elo_difference(win_ratio, n_games)})
+        return results
+
+    def shutdown(self):
+        """stop the workers, dropping the evaluations not finished yet"""
+        # the games not started yet are cancelled one by one, since
+        # shutdown(cancel_futures=True) needs python 3.9
+        for step_index, model_file, pure_mcts_playout_num, futures in self._pending:
+            for future in futures:
+                future.cancel()
+        self._executor.shutdown(wait=False)
+        for step_index, model_file, pure_mcts_playout_num, futures in self._pending:
+            remove_model(model_file)
+        self._pending = []
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Export a tensorflow or pytorch checkpoint to the weights of the numpy
+policy-value net, which plays without any deep learning framework, maybe
+with its weights quantized to int8 or float16 for a smaller model file, in
+which case the accuracy of the quantized net is reported against the
+float32 one on the positions of seeded self-play games.
+
+The quantization is a storage format only: the weights are dequantized to
+float32 when loaded, since numpy has no fast int8 or float16 matrix product,
+so the quantized net computes exactly like a float32 one.
+
+python export_numpy.py --model_type tensorflow --model_file output/best_policy.model --output_file best_policy.numpy.model --check
+python export_numpy.py --model_type pytorch --model_file output/best_policy.model --output_file best_policy.int8.model --quantize int8
+"""
+
+from __future__ import print_function
+import argparse
+import pickle
+import random
+import numpy as np
+from game import Board, Game
+from models.mcts_alphaZero import MCTSPlayer
+from models.policy_value_net_numpy import (PolicyValueNetNumpy, load_net_params, params_from_pytorch,
+                                           params_from_tensorflow, quantize_params, save_net_params)
+
+
+def read_tensorflow_checkpoint(model_file):
+    """return the weights of a tensorflow checkpoint as a dict of name: array,
+    without the slots of the optimizer
+    """
+    import tensorflow as tf
+    reader = tf.train.load_checkpoint(model_file)
+    return {name: reader.get_tensor(name)
+            for name in reader.get_variable_to_shape_map()
+            if "Adam" not in name and not name.endswith("_power")}
+
+
+def read_pytorch_checkpoint(model_file):
+    """return the state dict of a pytorch checkpoint as a dict of name: array"""
+    import torch
+    state_dict = torch.load(model_file, map_location='cpu')
+    return {name: value.cpu().numpy() for name, value in state_dict.items()
+            if hasattr(value, "cpu")}
+
+
+def export_net_params(args, model_file):
+    if args.model_type.startswith("tensorflow"):
+        return params_from_tensorflow(read_tensorflow_checkpoint(model_file),
+                                      args.board_height, args.board_width)
+    if args.model_type.startswith("pytorch"):
+        return params_from_pytorch(read_pytorch_checkpoint(model_file))
+    if args.model_type == "numpy":
+        net_params = load_net_params(model_file)
+        if isinstance(net_params, dict) and net_params.get("quantization"):
+            raise Exception('{} is quantized already'.format(model_file))
+        return PolicyValueNetNumpy(args, args.board_width, args.board_height, net_params).params
+    raise Exception('cannot export model_type {}'.format(args.model_type))
+
+
+def check_export(args, net_params, n_positions=200):
+    """compare the exported net with the checkpoint on seeded positions
+    return: the max abs difference of the move probabilities and of the values
+    """
+    from bench import random_positions
+    from selfplay import load_policy_value_net
+    source = load_policy_value_net(args, args.model_file)
+    exported = PolicyValueNetNumpy(args, args.board_width, args.board_height, net_params)
+    state_batch = np.array([board.current_state() for board in
+                            random_positions(args.board_width, args.board_height, n_positions)])
+    act_probs, value = source.policy_value(state_batch)
+    numpy_act_probs, numpy_value = exported.policy_value(state_batch)
+    return (float(np.abs(act_probs - numpy_act_probs).max()),
+            float(np.abs(np.reshape(value, -1) - numpy_value.reshape(-1)).max()))
+
+
+def selfplay_states(args, net, n_games, n_playout, seed=0):
+    """return the states of n_games seeded self-play games of net"""
+    random.seed(seed)
+    np.random.seed(seed)
+    player = MCTSPlayer(net.policy_value_fn, c_puct=5, n_playout=n_playout, is_selfplay=1)
+    game = Game(Board(width=args.board_width, height=args.board_height, n_in_row=args.n_in_row))
+    states = []
+    for _ in range(n_games):
+        winner, play_data = game.start_self_play(player, temp=1.0)
+        states.extend(state for state, mcts_probs, z in play_data)
+    return np.array(states)
+
+
+def quantization_report(net, quantized_net, state_batch):
+    """compare the quantized net with the float32 one on state_batch
+    return: a dict of the mean and max KL divergence of the quantized move
+        probabilities from the float32 ones, the MSE of the values, and the
+        ratio of states whose most probable move is the same
+    """
+    act_probs, value = net.policy_value(state_batch)
+    quantized_act_probs, quantized_value = quantized_net.policy_value(state_batch)
+    eps = 1e-10
+    kl = np.sum(act_probs * (np.log(act_probs + eps) - np.log(quantized_act_probs + eps)), axis=1)
+    return {"n_states": len(state_batch),
+            "policy_kl_mean": float(kl.mean()),
+            "policy_kl_max": float(kl.max()),
+            "value_mse": float(np.mean((value - quantized_value) ** 2)),
+            "top1_agreement": float(np.mean(act_probs.argmax(axis=1) == quantized_act_probs.argmax(axis=1)))}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", default="tensorflow", type=str,
+                        help="Model type of the checkpoint: tensorflow, tensorflow2, pytorch, pytorch2, "
+                             "or numpy to quantize a numpy model")
+    parser.add_argument("--model_file", required=True, type=str, help="the checkpoint to export")
+    parser.add_argument("--output_file", required=True, type=str, help="the exported numpy model")
+    parser.add_argument("--board_width", default=9, type=int, help="board_width")
+    parser.add_argument("--board_height", default=9, type=int, help="board_height")
+    parser.add_argument("--n_in_row", default=5, type=int, help="n_in_row of the self-play games of the report")
+    parser.add_argument("--n_layer_resnet", default=-1, type=int,
+                        help="num of resnet blocks of the checkpoint, only used by --check")
+    parser.add_argument("--quantize", default="none", choices=["none", "int8", "float16"],
+                        help="store the weights as int8 with per output channel scales, or as float16, "
+                             "for a smaller file; they are dequantized to float32 when loaded")
+    parser.add_argument("--report_games", default=4, type=int,
+                        help="num of seeded self-play games whose positions the quantized net is compared on")
+    parser.add_argument("--report_playout", default=100, type=int,
+                        help="num of playouts per move of the self-play games of the report")
+    parser.add_argument("--seed", default=0, type=int, help="random seed of the self-play games of the report")
+    parser.add_argument("--check", action='store_true',
+                        help="compare the outputs of the export with the checkpoint on seeded positions")
+    args = parser.parse_args()
+
+    net_params = export_net_params(args, args.model_file)
+    float32_size = len(pickle.dumps(net_params, protocol=pickle.HIGHEST_PROTOCOL))
+    if args.quantize != "none":
+        net = PolicyValueNetNumpy(args, args.board_width, args.board_height, net_params)
+        net_params = quantize_params(net_params, args.quantize)
+        quantized_net = PolicyValueNetNumpy(args, args.board_width, args.board_height, net_params)
+        state_batch = selfplay_states(args, net, args.report_games, args.report_playout, args.seed)
+        report = quantization_report(net, quantized_net, state_batch)
+        print("{} against float32 on {} self-play states: ".format(args.quantize, report["n_states"]) +
+              ", ".join("{}:{:.3g}".format(key, value) for key, value in sorted(report.items())
+                        if key != "n_states"))
+    save_net_params(net_params, args.output_file)
+    print("exported {} with {} blocks to {}".format(
+        args.model_file, len(net_params["blocks"]), args.output_file))
+    if args.quantize != "none":
+        size = len(pickle.dumps(net_params, protocol=pickle.HIGHEST_PROTOCOL))
+        print("{} file of {} bytes, {:.2f} of float32".format(args.quantize, size, 1.0 * size / float32_size))
+    if args.check:
+        probs_diff, value_diff = check_export(args, net_params)
+        print("max abs difference: move probabilities {:.2e}, value {:.2e}".format(
+            probs_diff, value_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,78 @@
 from __future__ import print_function
 import numpy as np
 import random
+import copy
+from profiling import profiler
+
+
+class MoveSet(object):
+    """A set of moves of a board, backed by a boolean mask with O(1) add,
+    remove and membership test. It is iterated and indexed in increasing
+    order, like the sorted lists of moves it replaces, and its mask can
+    index the action probabilities of a network directly.
+    """
+
+    def __init__(self, n_cells, moves=()):
+        self._flags = bytearray(n_cells)
+        for move in moves:
+            self._flags[move] = 1
+        self._size = sum(self._flags)
+        self._list = None
+
+    @property
+    def mask(self):
+        """a boolean array view of the set, not to be modified"""
+        return np.frombuffer(self._flags, dtype=bool)
+
+    def add(self, move):
+        if not self._flags[move]:
+            self._flags[move] = 1
+            self._size += 1
+            self._list = None
+
+    def discard(self, move):
+        if self._flags[move]:
+            self._flags[move] = 0
+            self._size -= 1
+            self._list = None
+
+    def remove(self, move):
+        if not self._flags[move]:
+            raise KeyError(move)
+        self.discard(move)
+
+    def _sorted(self):
+        # rebuilt on demand, and replaced rather than modified, so that
+        # running iterators are not affected by later changes
+        if self._list is None:
+            self._list = np.flatnonzero(self.mask).tolist()
+        return self._list
+
+    def tolist(self):
+        return list(self._sorted())
+
+    def copy(self):
+        move_set = MoveSet.__new__(MoveSet)
+        move_set._flags = bytearray(self._flags)
+        move_set._size = self._size
+        move_set._list = self._list
+        return move_set
+
+    def __contains__(self, move):
+        return 0 <= move < len(self._flags) and self._flags[move] == 1
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return iter(self._sorted())
+
+    def __getitem__(self, index):
+        return self._sorted()[index]
+
+    def __repr__(self):
+        return "MoveSet({})".format(self._sorted())
+
 
 class Board(object):
     """board for the game"""
@@ -35,6 +107,17 @@ class Board(object):
         [1, 0, 1, 1, 1, 2],
     ]
 
+    # cache of win masks, key: (width, height, n_in_row)
+    _win_masks_cache = {}
+    # cache of zobrist keys, key: number of cells
+    _zobrist_keys_cache = {}
+    # cache of dilation masks, key: (width, height, radius)
+    _dilation_masks_cache = {}
+    # cache of the lines of the forbidden-hand check, key: (width, height)
+    _forbidden_lines_cache = {}
+    # num of the three and four patterns matched by a line, key: line code
+    _forbidden_counts_table = {}
+
     def __init__(self, **kwargs):
         self.width = int(kwargs.get('width', 8))
         self.height = int(kwargs.get('height', 8))
@@ -47,6 +130,112 @@ class Board(object):
         self._ef_for_eight = int(kwargs.get('ef_for_eight', -1))
         self.players = [1, 2]  # player1 and player2
         self.if_check_forbidden_hands = bool(kwargs.get('if_check_forbidden_hands', False))
+        # every n_in_row window passing through each cell, as bitmasks
+        self._win_masks = Board.get_win_masks(self.width, self.height, self.n_in_row)
+        self._zobrist_keys = Board.get_zobrist_keys(self.width * self.height)
+        # candidate moves are limited to the empty moves within this
+        # distance of a stone, see set_prune_radius
+        self._prune_radius = int(kwargs.get('prune_radius', 0))
+        self._forbidden_lines = Board.get_forbidden_lines(self.width, self.height)
+
+    @staticmethod
+    def get_win_masks(width, height, n):
+        """return a list indexed by move, each item is a tuple of bitmasks
+        of the n-in-a-row windows which contain this move
+        """
+        key = (width, height, n)
+        if key not in Board._win_masks_cache:
+            win_masks = [[] for _ in range(width * height)]
+            # horizontal, vertical, diagonal, anti-diagonal
+            for dh, dw in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+                for h in range(height):
+                    for w in range(width):
+                        end_h = h + dh * (n - 1)
+                        end_w = w + dw * (n - 1)
+                        if not (0 <= end_h < height and 0 <= end_w < width):
+                            continue
+                        window = [(h + dh * i) * width + (w + dw * i)
+                                  for i in range(n)]
+                        mask = 0
+                        for m in window:
+                            mask |= 1 << m
+                        for m in window:
+                            win_masks[m].append(mask)
+            Board._win_masks_cache[key] = [tuple(masks) for masks in win_masks]
+        return Board._win_masks_cache[key]
+
+    @staticmethod
+    def get_zobrist_keys(n_cells):
+        """return random 64-bit keys, a dict of one list per player and one
+        list for the last move, indexed by move, and a key for the side to
+        move; drawn from a fixed seed so that hashes are reproducible and the
+        global random state is left alone
+        """
+        if n_cells not in Board._zobrist_keys_cache:
+            rng = random.Random(n_cells)
+            keys = {name: [rng.getrandbits(64) for _ in range(n_cells)]
+                    for name in [1, 2, 'last_move']}
+            keys['side'] = rng.getrandbits(64)
+            Board._zobrist_keys_cache[n_cells] = keys
+        return Board._zobrist_keys_cache[n_cells]
+
+    @staticmethod
+    def get_dilation_masks(width, height, radius):
+        """return a boolean array of shape (n_cells, n_cells) whose row m
+        marks the moves at Chebyshev distance 1 to radius of move m, and the
+        same as a list of lists of moves; radius 1 is the 8 neighbours
+        """
+        key = (width, height, radius)
+        if key not in Board._dilation_masks_cache:
+            hs, ws = np.divmod(np.arange(width * height), width)
+            masks = ((np.abs(hs[:, None] - hs[None, :]) <= radius) &
+                     (np.abs(ws[:, None] - ws[None, :]) <= radius))
+            np.fill_diagonal(masks, False)
+            neighbours = [np.flatnonzero(row).tolist() for row in masks]
+            Board._dilation_masks_cache[key] = (masks, neighbours)
+        return Board._dilation_masks_cache[key]
+
+    @staticmethod
+    def get_forbidden_lines(width, height):
+        """return a list indexed by move, each item is a tuple of 4 lines, one
+        per direction of check_forbidden_hands, of the moves at offsets -5 to
+        5 from this move, -1 for the offsets off the board; the patterns are
+        at most 6 long, so these 11 cells hold every window checked
+        """
+        key = (width, height)
+        if key not in Board._forbidden_lines_cache:
+            lines = []
+            for h in range(height):
+                for w in range(width):
+                    lines.append(tuple(
+                        tuple((h + k * dh) * width + w + k * dw
+                              if 0 <= h + k * dh < height and 0 <= w + k * dw < width
+                              else -1
+                              for k in range(-5, 6))
+                        for dh, dw in [(1, 0), (1, 1), (0, 1), (-1, 1)]))
+            Board._forbidden_lines_cache[key] = lines
+        return Board._forbidden_lines_cache[key]
+
+    @staticmethod
+    def count_forbidden_patterns(code):
+        """return the num of three patterns and of four patterns matched by
+        the line of a base-4 code, as check_forbidden_pattern does: its 11
+        digits are the cells at offsets -5 to 5, 0 blank, 1 black, 2 white
+        and 3 off the board, which matches no pattern
+        """
+        counts = Board._forbidden_counts_table.get(code)
+        if counts is None:
+            line = [(code >> (2 * (10 - k))) & 3 for k in range(11)]
+
+            def match(pattern):
+                n = len(pattern)
+                return any(x == 1 and line[5 - i:5 - i + n] == pattern
+                           for (i, x) in enumerate(pattern))
+
+            counts = (sum(1 for p in Board.forbidden_hands_of_three_patterns if match(p)),
+                      sum(1 for p in Board.forbidden_hands_of_four_patterns if match(p)))
+            Board._forbidden_counts_table[code] = counts
+        return counts
 
     def init_board(self, start_player=0):
         if self.width < self.n_in_row or self.height < self.n_in_row:
@@ -54,12 +243,49 @@ class Board(object):
                             'less than {}'.format(self.n_in_row))
         self.start_player = start_player
         self.current_player = self.players[start_player]  # start player
-        # keep available moves in a list
-        self.availables = list(range(self.width * self.height))
+        # keep available moves in a set
+        self.availables = MoveSet(self.width * self.height, range(self.width * self.height))
         self.moved = list()
-        self.eight_connected_region_to_moved = list()   #   8 connected region to moved positions
         self.states = {}
+        # bitboard of each player, bit m is set if the player occupies move m
+        self.bitboards = {player: 0 for player in self.players}
+        # zobrist hash of the stones and the side to move, see do_move
+        self.zobrist_hash = 0
         self.last_move = -1
+        # what is needed to take back each move, see undo_move
+        self.undo_stack = []
+        # the input planes of the networks from the perspective of each
+        # player, kept up to date by do_move and undo_move, see current_state
+        self._planes = {player: np.zeros((4, self.height, self.width), dtype=np.float32)
+                        for player in self.players}
+        for planes in self._planes.values():
+            planes[3] = 1.0
+        # 8 connected region to moved positions, see set_prune_radius
+        self.set_prune_radius(self._prune_radius)
+
+    def set_prune_radius(self, radius):
+        """limit candidate_moves() to the empty moves within Chebyshev
+        distance radius of a stone, 0 for no limit but the eight connected
+        region (radius 1) with ef_for_eight. The region is rebuilt from the
+        stones on the board, then kept up to date by do_move and undo_move.
+        """
+        self._prune_radius = radius
+        if radius > 0:
+            self._region_radius = radius
+        else:
+            self._region_radius = 1 if self._ef_for_eight > 0 else 0
+        n_cells = self.width * self.height
+        if self._region_radius > 0:
+            masks, self._neighbours = Board.get_dilation_masks(
+                self.width, self.height, self._region_radius)
+            # num of stones among the neighbours of each move
+            n_stone_neighbours = masks[list(self.states)].sum(axis=0, dtype=np.int64)
+            self._n_stone_neighbours = n_stone_neighbours.tolist()
+            self.eight_connected_region_to_moved = MoveSet(
+                n_cells, np.flatnonzero((n_stone_neighbours > 0) & self.availables.mask))
+        else:
+            self._n_stone_neighbours = None
+            self.eight_connected_region_to_moved = MoveSet(n_cells)
 
     def move_to_location(self, move):
         """
@@ -88,55 +314,85 @@ class Board(object):
             return -1
         return move
 
-    def current_state(self):
+    def current_state(self, out=None, share=False):
         """return the board state from the perspective of the current player.
-        state shape: 4*width*height
+        state shape: 4*height*width, float32, upside down
+        out: an array of that shape to write the state into, e.g. a slot
+            of a batch, which is returned
+        share: if True, return the planes kept by the board, which are not
+            to be modified and only valid until the next move
         """
-
-        square_state = np.zeros((4, self.width, self.height))
-        if self.states:
-            moves, players = np.array(list(zip(*self.states.items())))
-            move_curr = moves[players == self.current_player]
-            move_oppo = moves[players != self.current_player]
-            square_state[0][move_curr // self.width,
-                            move_curr % self.height] = 1.0
-            square_state[1][move_oppo // self.width,
-                            move_oppo % self.height] = 1.0
+        planes = self._planes[self.current_player]
+        if out is not None:
+            out[...] = planes
+            return out
+        if share:
+            return planes
+        return planes.copy()
+
+    def _update_planes(self, player, move, stone):
+        """put (stone=1.0) or take back (stone=0.0) the stone of player at
+        move in the planes of both perspectives, then mark self.last_move
+        and the colour to play
+        """
+        planes_player = self._planes[player]
+        planes_other = self._planes[
+            self.players[0] if player == self.players[1]
+            else self.players[1]
+        ]
+        # the planes are upside down, as the networks were trained on them
+        planes_player[0, self.height - 1 - move // self.width, move % self.width] = stone
+        planes_other[1, self.height - 1 - move // self.width, move % self.width] = stone
+        for planes in [planes_player, planes_other]:
             # indicate the last move location
-            square_state[2][self.last_move // self.width,
-                            self.last_move % self.height] = 1.0
-        if len(self.states) % 2 == 0:
-            square_state[3][:, :] = 1.0  # indicate the colour to play
-        return square_state[:, ::-1, :]
-
-    def appendMoveForEightConnectedRegion(self, new_h, new_w):
-        new_move = self.location_to_move([new_h, new_w])
-        if new_move != -1 and new_move not in self.eight_connected_region_to_moved:
-            self.eight_connected_region_to_moved.append(new_move)
+            planes[2] = 0.0
+            if self.last_move != -1:
+                planes[2, self.height - 1 - self.last_move // self.width,
+                       self.last_move % self.width] = 1.0
+            # indicate the colour to play
+            planes[3] = 1.0 if len(self.states) % 2 == 0 else 0.0
 
     def appendEightConnectedRegion(self, move):
-        h, w = self.move_to_location(move)
-        
-        # up
-        self.appendMoveForEightConnectedRegion(h+1, w)
-        # down
-        self.appendMoveForEightConnectedRegion(h-1, w)
-        # right
-        self.appendMoveForEightConnectedRegion(h, w+1)
-        # left
-        self.appendMoveForEightConnectedRegion(h, w-1)
-        # upper right
-        self.appendMoveForEightConnectedRegion(h+1, w+1)
-        # upper left
-        self.appendMoveForEightConnectedRegion(h+1, w-1)
-        # bottom right
-        self.appendMoveForEightConnectedRegion(h-1, w+1)
-        # bottom left
-        self.appendMoveForEightConnectedRegion(h-1, w-1)
+        """add the empty neighbours of the stone just placed at move to the
+        region, and take move out of it
+        """
+        self.eight_connected_region_to_moved.discard(move)
+        for neighbour in self._neighbours[move]:
+            self._n_stone_neighbours[neighbour] += 1
+            if neighbour not in self.states:
+                self.eight_connected_region_to_moved.add(neighbour)
+
+    def removeEightConnectedRegion(self, move):
+        """the inverse of appendEightConnectedRegion, once move is empty again:
+        the region is the empty moves with at least one stone around them
+        """
+        for neighbour in self._neighbours[move]:
+            self._n_stone_neighbours[neighbour] -= 1
+            if self._n_stone_neighbours[neighbour] == 0:
+                self.eight_connected_region_to_moved.discard(neighbour)
+        if self._n_stone_neighbours[move] > 0:
+            self.eight_connected_region_to_moved.add(move)
+
+    def candidate_moves(self):
+        """return the moves considered by the networks and the searches:
+        the region around the stones with ef_for_eight, except for the
+        first two moves, or with a prune radius, else every available move
+        """
+        if self._ef_for_eight > 0 and len(self.moved) <= 2:
+            return self.availables
+        if self._region_radius > 0 and len(self.eight_connected_region_to_moved) > 0:
+            return self.eight_connected_region_to_moved
+        return self.availables
 
     def do_move(self, move):
-        self.states[move] = self.current_player
+        # moves may come in as numpy integers, which can't be shifted past 63
+        move = int(move)
         self.availables.remove(move)
+        self.undo_stack.append(self.last_move)
+
+        self.states[move] = self.current_player
+        self.bitboards[self.current_player] |= 1 << move
+        self.zobrist_hash ^= self._zobrist_keys[self.current_player][move] ^ self._zobrist_keys['side']
 
         if self._ef_for_eight > 0:
             # get 8 connected region to moved
@@ -144,54 +400,110 @@ class Board(object):
             # from virtual board, and this board will update it's appendEightConnectedRegion
             # after each virtual move
             self.moved.append(move)
+        if self._region_radius > 0:
             self.appendEightConnectedRegion(move)
-            # remove moved
-            for temp_move in self.moved:
-                if temp_move in self.eight_connected_region_to_moved:
-                    self.eight_connected_region_to_moved.remove(temp_move)
         self.current_player = (
             self.players[0] if self.current_player == self.players[1]
             else self.players[1]
         )
         self.last_move = move
+        self._update_planes(self.states[move], move, 1.0)
 
-    def has_a_winner(self):
-        width = self.width
-        height = self.height
-        states = self.states
-        n = self.n_in_row
+    def undo_move(self):
+        """Take back the last move, restoring the board exactly as it was
+        before the matching do_move, so a search can walk down and back up
+        one board instead of copying it for every playout.
+        """
+        move = self.last_move
+        last_move = self.undo_stack.pop()
+        self.current_player = (
+            self.players[0] if self.current_player == self.players[1]
+            else self.players[1]
+        )
+        del self.states[move]
+        self.bitboards[self.current_player] ^= 1 << move
+        self.zobrist_hash ^= self._zobrist_keys[self.current_player][move] ^ self._zobrist_keys['side']
+        self.availables.add(move)
+        if self._ef_for_eight > 0:
+            self.moved.pop()
+        if self._region_radius > 0:
+            self.removeEightConnectedRegion(move)
+        self.last_move = last_move
+        self._update_planes(self.current_player, move, 0.0)
+
+    def zobrist_key(self):
+        """Return the zobrist hash of the position including the last move,
+        which the networks see as an input plane, so that positions with the
+        same key have the same network evaluation.
+        """
+        if self.last_move == -1:
+            return self.zobrist_hash
+        return self.zobrist_hash ^ self._zobrist_keys['last_move'][self.last_move]
+
+    def clone(self):
+        """Return a copy of the board which can be moved independently,
+        much cheaper than copy.deepcopy since the static tables are shared.
+        """
+        timing = profiler.enabled
+        if timing:
+            start = profiler.clock()
+        board = copy.copy(self)
+        board.states = dict(self.states)
+        board.bitboards = dict(self.bitboards)
+        board.availables = self.availables.copy()
+        board.moved = list(self.moved)
+        board.eight_connected_region_to_moved = self.eight_connected_region_to_moved.copy()
+        if self._n_stone_neighbours is not None:
+            board._n_stone_neighbours = list(self._n_stone_neighbours)
+        board.undo_stack = list(self.undo_stack)
+        board._planes = {player: planes.copy() for player, planes in self._planes.items()}
+        if timing:
+            profiler.add_time('clone', profiler.clock() - start)
+        return board
 
+    def has_a_winner(self):
+        """Only the lines through the last move need to be checked, since the
+        game is over as soon as any player gets n in a row.
+        """
         if self.if_check_forbidden_hands and self.states[self.last_move] == self.players[self.start_player] and self.check_forbidden_hands():
             return True, self.players[(self.start_player + 1) % 2]
 
-        moved = list(set(range(width * height)) - set(self.availables))
-        if len(moved) < self.n_in_row *2-1:
+        if len(self.states) < self.n_in_row *2-1:
             return False, -1
 
-        for m in moved:
-            h = m // width
-            w = m % width
-            player = states[m]
-
-            if (w in range(width - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n))) == 1):
-                return True, player
-
-            if (h in range(height - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n * width, width))) == 1):
-                return True, player
-
-            if (w in range(width - n + 1) and h in range(height - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n * (width + 1), width + 1))) == 1):
-                return True, player
-
-            if (w in range(n - 1, width) and h in range(height - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n * (width - 1), width - 1))) == 1):
+        player = self.states[self.last_move]
+        bitboard = self.bitboards[player]
+        for mask in self._win_masks[self.last_move]:
+            if bitboard & mask == mask:
                 return True, player
 
         return False, -1
 
     def check_forbidden_hands(self):
+        """whether the last move, of the first player, is a double three or a
+        double four; the same verdict as check_forbidden_hands_by_patterns,
+        but every line through the last move is encoded as an integer and its
+        pattern counts are looked up in a table shared by all the boards
+        """
+        black = self.bitboards[self.players[self.start_player]]
+        white = self.bitboards[self.players[(self.start_player + 1) % 2]]
+        table = Board._forbidden_counts_table
+        n_three = n_four = 0
+        for cells in self._forbidden_lines[self.last_move]:
+            code = 0
+            for c in cells:
+                code = (code << 2) | (3 if c < 0 else ((black >> c) & 1) | (((white >> c) & 1) << 1))
+            counts = table.get(code)
+            if counts is None:
+                counts = Board.count_forbidden_patterns(code)
+            n_three += counts[0]
+            n_four += counts[1]
+        return n_three > 1 or n_four > 1
+
+    def check_forbidden_hands_by_patterns(self):
+        """the reference check, which collects the pieces of every window of
+        every pattern, kept to test and benchmark check_forbidden_hands
+        """
         directions = [
             [1, 0],
             [1, 1],
@@ -258,12 +570,15 @@ class Board(object):
 
     def game_end(self):
         """Check whether the game is ended or not"""
+        timing = profiler.enabled
+        if timing:
+            start = profiler.clock()
         win, winner = self.has_a_winner()
-        if win:
-            return True, winner
-        elif not len(self.availables):
-            return True, -1
-        return False, -1
+        # winner is -1 unless win, so a full board is a tie
+        end = win or not len(self.availables)
+        if timing:
+            profiler.add_time('game_end', profiler.clock() - start)
+        return end, winner
 
     def get_current_player(self):
         return self.current_player
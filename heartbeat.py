@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+A keep-alive for shared clusters which reclaim jobs whose device looks idle,
+e.g. while the trainer only plays or evaluates games on the CPU. It runs in
+its own thread, away from the search loops.
+"""
+
+from __future__ import print_function
+import threading
+
+
+class Heartbeat(object):
+    """Call beat() every interval seconds in a daemon thread, from start()
+    until stop().
+    """
+
+    def __init__(self, beat, interval):
+        self.beat = beat
+        self.interval = interval
+        self.n_beats = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                print("WARNING: heartbeat failed: {}".format(e))
+            self.n_beats += 1
@@ -35,6 +35,8 @@ parser.add_argument("--output_dir", default=None, type=str,
 parser.add_argument("--model_file", default='./best_policy.model', type=str,
                     help="The model_file.")
 parser.add_argument("--n_layer_resnet", default=-1, type=int, help="num of simulations for each move.")
+parser.add_argument("--use_xla", action='store_true',
+                    help="compile the frozen inference graph of a tensorflow model with XLA")
 parser.add_argument("--enable_gui", default=True, action='store_true',
                     help="enable_gui")
 parser.add_argument("--if_check_forbidden_hands", action='store_true',
@@ -108,6 +110,10 @@ def run():
                                     encoding='bytes')  # To support python3
 
         best_policy = MODEL_CLASSES[args.model_type](args, width, height, policy_param)
+    elif args.model_type == "tensorflow":
+        # only the heads are needed to play
+        best_policy = MODEL_CLASSES[args.model_type](args, width, height, args.model_file,
+                                                     inference_only=True, use_xla=args.use_xla)
     else:
         best_policy = MODEL_CLASSES[args.model_type](args, width, height, args.model_file)
     mcts_player = MCTSPlayer(best_policy.policy_value_fn,
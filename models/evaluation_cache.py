@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+A transposition table for the AlphaZero MCTS: the network evaluations of the
+leaves, keyed by the zobrist key of the board (see Board.zobrist_key), so a
+position reached again by another move order, a later playout after the tree
+was reset, or another search is not sent to the network twice.
+"""
+
+from collections import OrderedDict
+
+
+class EvaluationCache(object):
+    """A bounded LRU map from zobrist keys to (action_probs, leaf_value),
+    counting its hits and misses.
+
+    The entries are only valid for the weights they were computed with,
+    clear() the cache when the weights change.
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """return the cached evaluation of key, or None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, action_probs, leaf_value):
+        """cache an evaluation, action_probs is turned into a list since
+        the nets return a one-shot zip of (action, probability) tuples
+        return: the cached (action_probs, leaf_value)
+        """
+        entry = (list(action_probs), leaf_value)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+    def hit_rate(self):
+        return 1.0*self.hits / max(self.hits + self.misses, 1)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
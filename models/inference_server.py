@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+A local inference service which owns one policy-value net and serves many
+concurrent searches, either threads of the same process or self-play worker
+processes. Requests are merged into dynamic batches bounded by a max batch
+size and a max wait time, so the net sees large batches and is only held in
+memory once.
+"""
+
+import queue
+import threading
+import time
+import numpy as np
+
+
+class InferenceServer(object):
+    """Evaluate board states sent by InferenceClients with one net.
+
+    policy_value_net: any net with a policy_value(state_batch) method
+    max_batch_size: a batch is run as soon as it holds this many states
+    max_wait: seconds to wait for more requests after the first one of a batch
+    context: a multiprocessing context to serve worker processes, None to
+        serve threads of this process only
+    """
+
+    def __init__(self, policy_value_net, board_width, board_height,
+                 max_batch_size=32, max_wait=0.002, context=None):
+        self.policy_value_net = policy_value_net
+        self.board_width = board_width
+        self.board_height = board_height
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._make_queue = queue.Queue if context is None else context.Queue
+        self._request_queue = self._make_queue()
+        self._response_queues = []
+        self._thread = None
+        self.n_requests = 0
+        self.n_states = 0
+        self.n_batches = 0
+
+    def make_client(self):
+        """create a client with its own response queue, clients for worker
+        processes must be made before the processes are started
+        """
+        response_queue = self._make_queue()
+        self._response_queues.append(response_queue)
+        return InferenceClient(len(self._response_queues) - 1,
+                               self._request_queue, response_queue,
+                               self.board_width, self.board_height)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._request_queue.put(None)
+        self._thread.join()
+
+    def mean_batch_size(self):
+        return 1.0*self.n_states / max(self.n_batches, 1)
+
+    def _serve(self):
+        while True:
+            request = self._request_queue.get()
+            if request is None:
+                return
+            requests = [request]
+            n_states = len(request[1])
+            deadline = time.time() + self.max_wait
+            while n_states < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._request_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    # finish this batch before stopping
+                    self._request_queue.put(None)
+                    break
+                requests.append(request)
+                n_states += len(request[1])
+            self._run_batch(requests)
+
+    def _run_batch(self, requests):
+        state_batch = np.concatenate([states for client_id, states in requests])
+        act_probs, value = self.policy_value_net.policy_value(state_batch)
+        start = 0
+        for client_id, states in requests:
+            end = start + len(states)
+            self._response_queues[client_id].put((act_probs[start:end], value[start:end]))
+            start = end
+        self.n_requests += len(requests)
+        self.n_states += len(state_batch)
+        self.n_batches += 1
+
+
+class InferenceClient(object):
+    """Stand-in for a policy-value net, which sends its states to an
+    InferenceServer; use its policy_value_fn as the policy_value_function
+    of MCTSPlayer and its policy_value_fn_batch as the batch function.
+    """
+
+    def __init__(self, client_id, request_queue, response_queue,
+                 board_width, board_height):
+        self.client_id = client_id
+        self._request_queue = request_queue
+        self._response_queue = response_queue
+        self.board_width = board_width
+        self.board_height = board_height
+
+    def policy_value(self, state_batch):
+        """
+        input: a batch of states
+        output: a batch of action probabilities and state values
+        """
+        state_batch = np.ascontiguousarray(state_batch, dtype=np.float32)
+        self._request_queue.put((self.client_id, state_batch))
+        return self._response_queue.get()
+
+    def policy_value_fn(self, board):
+        """
+        input: board
+        output: a list of (action, probability) tuples for each available
+        action and the score of the board state
+        """
+        (act_probs, value), = self.policy_value_fn_batch([board])
+        return act_probs, value
+
+    def policy_value_fn_batch(self, boards):
+        """
+        input: a list of boards
+        output: a list of what policy_value_fn outputs for each board,
+        sent to the server as one request
+        """
+        # the first two move is random
+        legal_positions_batch = [board.candidate_moves() for board in boards]
+
+        state_batch = np.empty((len(boards), 4, self.board_height, self.board_width),
+                               dtype=np.float32)
+        for i, board in enumerate(boards):
+            board.current_state(out=state_batch[i])
+        act_probs, value = self.policy_value(state_batch.reshape(
+                -1, 4, self.board_width, self.board_height))
+        return [(zip(legal_positions, act_probs[i][legal_positions.mask]), value[i][0].item())
+                for i, legal_positions in enumerate(legal_positions_batch)]
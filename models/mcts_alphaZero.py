@@ -7,7 +7,10 @@ network to guide the tree search and evaluate the leaf nodes
 """
 
 import numpy as np
-import copy
+from models.mcts_tree import ArrayTree
+from models.evaluation_cache import EvaluationCache
+from models.threat_search import ThreatSearch
+from profiling import profiler
 
 
 def softmax(x):
@@ -16,79 +19,28 @@ def softmax(x):
     return probs
 
 
-class TreeNode(object):
-    """A node in the MCTS tree.
-
-    Each node keeps track of its own value Q, prior probability P, and
-    its visit-count-adjusted prior score u.
+def top_k_priors(action_probs, k):
+    """keep the k actions of highest prior, in their original order, and
+    renormalize their priors
     """
-
-    def __init__(self, parent, prior_p):
-        self._parent = parent
-        self._children = {}  # a map from action to TreeNode
-        self._n_visits = 0
-        self._Q = 0
-        self._u = 0
-        self._P = prior_p
-
-    def expand(self, action_priors):
-        """Expand tree by creating new children.
-        action_priors: a list of tuples of actions and their prior probability
-            according to the policy function.
-        """
-        for action, prob in action_priors:
-            if action not in self._children:
-                self._children[action] = TreeNode(self, prob)
-
-    def select(self, c_puct):
-        """Select action among children that gives maximum action value Q
-        plus bonus u(P).
-        Return: A tuple of (action, next_node)
-        """
-        return max(self._children.items(),
-                   key=lambda act_node: act_node[1].get_value(c_puct))
-
-    def update(self, leaf_value):
-        """Update node values from leaf evaluation.
-        leaf_value: the value of subtree evaluation from the current player's
-            perspective.
-        """
-        # Count visit.
-        self._n_visits += 1
-        # Update Q, a running average of values for all visits.
-        self._Q += 1.0*(leaf_value - self._Q) / self._n_visits
-
-    def update_recursive(self, leaf_value):
-        """Like a call to update(), but applied recursively for all ancestors.
-        """
-        # If it is not root, this node's parent should be updated first.
-        if self._parent:
-            self._parent.update_recursive(-leaf_value)
-        self.update(leaf_value)
-
-    def get_value(self, c_puct):
-        """Calculate and return the value for this node.
-        It is a combination of leaf evaluations Q, and this node's prior
-        adjusted for its visit count, u.
-        c_puct: a number in (0, inf) controlling the relative impact of
-            value Q, and prior probability P, on this node's score.
-        """
-        self._u = (c_puct * self._P *
-                   np.sqrt(self._parent._n_visits) / (1 + self._n_visits))
-        return self._Q + self._u
-
-    def is_leaf(self):
-        """Check if leaf node (i.e. no nodes below this have been expanded)."""
-        return self._children == {}
-
-    def is_root(self):
-        return self._parent is None
+    action_probs = list(action_probs)
+    if len(action_probs) <= k:
+        return action_probs
+    probs = np.array([prob for action, prob in action_probs], dtype=np.float64)
+    keep = np.sort(np.argpartition(-probs, k - 1)[:k])
+    total = probs[keep].sum()
+    if total <= 0:
+        return [action_probs[i] for i in keep]
+    return [(action_probs[i][0], probs[i] / total) for i in keep]
 
 
 class MCTS(object):
     """An implementation of Monte Carlo Tree Search."""
 
-    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000, ef_for_eight=-1):
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000, ef_for_eight=-1,
+                 n_batch=1, policy_value_batch_fn=None, virtual_loss=3,
+                 cache_size=0, prune_radius=0, prune_top_k=0, solver_depth=0,
+                 solver_in_tree=False):
         """
         policy_value_fn: a function that takes in a board state and outputs
             a list of (action, probability) tuples and also a score in [-1, 1]
@@ -98,34 +50,138 @@ class MCTS(object):
             converges to the maximum-value policy. A higher value means
             relying on the prior more.
         ef_for_eight: efficient for eight connected region
+        n_batch: number of leaves collected with virtual loss and evaluated
+            together, 1 to evaluate every leaf on its own
+        policy_value_batch_fn: a function that takes in a list of boards and
+            outputs a list of what policy_value_fn outputs for each of them,
+            policy_value_fn is called on each board if it is None
+        virtual_loss: number of losses a pending leaf counts for
+        cache_size: max number of leaf evaluations kept in a transposition
+            table keyed by zobrist hash, 0 to disable it
+        prune_radius: only search the empty moves within this distance of a
+            stone, 0 to search every candidate move of the board
+        prune_top_k: only expand the k moves of highest prior of each node,
+            0 to expand them all
+        solver_depth: max number of fours of the VCF looked for by a threat
+            search before the playouts, which returns a forced move at once,
+            0 to disable it
+        solver_in_tree: also look for a forced win at every new leaf, which
+            is then backed up as a win instead of being evaluated
         """
-        self._root = TreeNode(None, 1.0)
+        self._tree = ArrayTree()
         self._policy = policy_value_fn
         self._c_puct = c_puct
         self._n_playout = n_playout
         self._ef_for_eight = ef_for_eight
-
-    def _playout(self, state):
-        """Run a single playout from the root to the leaf, getting a value at
-        the leaf and propagating it back through its parents.
-        State is modified in-place, so a copy must be provided.
+        self._n_batch = n_batch
+        if policy_value_batch_fn is None:
+            policy_value_batch_fn = lambda boards: [self._policy(b) for b in boards]
+        self._policy_batch = policy_value_batch_fn
+        self._virtual_loss = virtual_loss
+        if cache_size > 0:
+            self.cache = EvaluationCache(cache_size)
+        else:
+            self.cache = None
+        self._prune_radius = prune_radius
+        self._prune_top_k = prune_top_k
+        self._solver_depth = solver_depth
+        self._solver_in_tree = solver_in_tree and solver_depth > 0
+        self._solver = None
+
+    def _get_solver(self, state):
+        solver = self._solver
+        if solver is None or (solver.width, solver.height, solver.n_in_row) != (
+                state.width, state.height, state.n_in_row):
+            solver = ThreatSearch(state.width, state.height, state.n_in_row,
+                                  max_depth=self._solver_depth)
+            self._solver = solver
+        return solver
+
+    def _is_forced_win(self, state):
+        """whether the player to move of a state, whose game is not over,
+        wins by force
         """
-        node = self._root
+        forced = self._get_solver(state).solve(state)
+        return forced is not None and forced[0] != 'block'
+
+    def _expand(self, node, action_probs):
+        if self._prune_top_k > 0:
+            action_probs = top_k_priors(action_probs, self._prune_top_k)
+        self._tree.expand(node, action_probs)
+
+    def _evaluate(self, state):
+        """policy_value_fn through the transposition table, if any"""
+        if self.cache is None:
+            return self._call_policy(state)
+        key = state.zobrist_key()
+        entry = self.cache.get(key)
+        if entry is None:
+            action_probs, leaf_value = self._call_policy(state)
+            entry = self.cache.put(key, action_probs, leaf_value)
+        return entry
+
+    def _call_policy(self, state):
+        if not profiler.enabled:
+            return self._policy(state)
+        start = profiler.clock()
+        result = self._policy(state)
+        profiler.add_time('policy_value_fn', profiler.clock() - start)
+        profiler.count('nn_states')
+        return result
+
+    def _call_policy_batch(self, states):
+        if not profiler.enabled:
+            return self._policy_batch(states)
+        start = profiler.clock()
+        results = self._policy_batch(states)
+        profiler.add_time('policy_value_fn', profiler.clock() - start)
+        profiler.count('nn_states', len(states))
+        return results
+
+    def _select_leaf(self, state):
+        """walk down the tree from the root, playing the selected moves on
+        state, and return the leaf reached
+        """
+        timing = profiler.enabled
+        if timing:
+            start = profiler.clock()
+        tree = self._tree
+        node = 0
         while(1):
-            if node.is_leaf():
+            if tree.is_leaf(node):
                 break
             # Greedily select next move.
-            action, node = node.select(self._c_puct)
+            action, node = tree.select(node, self._c_puct)
             state.do_move(action)
+        if timing:
+            profiler.add_time('mcts_select', profiler.clock() - start)
+        return node
+
+    def _playout(self, state):
+        """Run a single playout from the root to the leaf, getting a value at
+        the leaf and propagating it back through its parents.
+        State is modified in-place while walking down the tree and is
+        restored with undo_move before returning.
+        """
+        n_stones = len(state.states)
+        tree = self._tree
+        node = self._select_leaf(state)
+
+        if self._solver_in_tree and not state.game_end()[0] and self._is_forced_win(state):
+            # the player to move wins by force, back up a win
+            tree.update_recursive(node, -1.0)
+            while len(state.states) > n_stones:
+                state.undo_move()
+            return
 
         # Evaluate the leaf using a network which outputs a list of
         # (action, probability) tuples p and also a score v in [-1, 1]
         # for the current player.
-        action_probs, leaf_value = self._policy(state)
+        action_probs, leaf_value = self._evaluate(state)
         # Check for end of game.
         end, winner = state.game_end()
         if not end:
-            node.expand(action_probs)
+            self._expand(node, action_probs)
         else:
             # for end state，return the "true" leaf_value
             if winner == -1:  # tie
@@ -136,7 +192,70 @@ class MCTS(object):
                 )
 
         # Update value and visit count of nodes in this traversal.
-        node.update_recursive(-leaf_value)
+        tree.update_recursive(node, -leaf_value)
+        # walk back up to the root position
+        while len(state.states) > n_stones:
+            state.undo_move()
+
+    def _playout_batch(self, state, n_batch):
+        """Run n_batch playouts from the root, selecting the leaves with
+        virtual loss, and evaluate the leaves in one call of the batch policy.
+        State is restored with undo_move before returning.
+        return: the num of playouts backed up, less than n_batch when a leaf
+            still pending in this batch is selected again
+        """
+        n_stones = len(state.states)
+        tree = self._tree
+        pending_nodes = []
+        pending_states = []
+        n_skipped = 0
+        for i in range(n_batch):
+            node = self._select_leaf(state)
+
+            end, winner = state.game_end()
+            entry = None
+            if not end and self.cache is not None:
+                entry = self.cache.get(state.zobrist_key())
+            if end:
+                # for end state，back up the "true" leaf_value right away
+                if winner == -1:  # tie
+                    leaf_value = 0.0
+                else:
+                    leaf_value = (
+                        1.0 if winner == state.get_current_player() else -1.0
+                    )
+                tree.update_recursive(node, -leaf_value)
+            elif self._solver_in_tree and self._is_forced_win(state):
+                # the player to move wins by force, back up a win
+                tree.update_recursive(node, -1.0)
+            elif entry is not None:
+                # a transposition, expand it right away
+                action_probs, leaf_value = entry
+                self._expand(node, action_probs)
+                tree.update_recursive(node, -leaf_value)
+            elif node not in pending_nodes:
+                # the same leaf is only evaluated once per batch, selecting
+                # it again is not a playout
+                tree.add_virtual_loss_recursive(node, self._virtual_loss)
+                pending_nodes.append(node)
+                pending_states.append(state.clone())
+            else:
+                n_skipped += 1
+
+            while len(state.states) > n_stones:
+                state.undo_move()
+
+        if pending_states:
+            results = self._call_policy_batch(pending_states)
+            for node, pending_state, (action_probs, leaf_value) in zip(
+                    pending_nodes, pending_states, results):
+                if self.cache is not None:
+                    action_probs, leaf_value = self.cache.put(
+                        pending_state.zobrist_key(), action_probs, leaf_value)
+                tree.add_virtual_loss_recursive(node, -self._virtual_loss)
+                self._expand(node, action_probs)
+                tree.update_recursive(node, -leaf_value)
+        return n_batch - n_skipped
 
     def get_move_probs(self, state, temp=1e-3):
         """Run all playouts sequentially and return the available actions and
@@ -155,14 +274,30 @@ class MCTS(object):
                 _n_playout = self._n_playout
         else:
             _n_playout = self._n_playout
-        for n in range(_n_playout):
-            state_copy = copy.deepcopy(state)
-            self._playout(state_copy)
+        if self._solver_depth > 0:
+            forced = self._get_solver(state).solve(state)
+            if forced is not None:
+                # a win, a VCF or the only move not losing at once
+                kind, line = forced
+                return (line[0],), np.array([1.0])
+        # copy once per search, every playout walks down and back up this copy
+        state_copy = state.clone()
+        if self._prune_radius > 0:
+            state_copy.set_prune_radius(self._prune_radius)
+        if self._n_batch > 1:
+            # the first leaf of a batch is always backed up, so this ends
+            n = 0
+            while n < _n_playout:
+                n += self._playout_batch(state_copy, min(self._n_batch, _n_playout - n))
+        else:
+            for n in range(_n_playout):
+                self._playout(state_copy)
+        if profiler.enabled:
+            profiler.count('playouts', _n_playout)
 
         # calc the move probabilities based on visit counts at the root node
-        act_visits = [(act, node._n_visits)
-                      for act, node in self._root._children.items()]
-        acts, visits = zip(*act_visits)
+        acts, visits = self._tree.root_children()
+        acts = tuple(acts.tolist())
         act_probs = softmax(1.0/temp * np.log(np.array(visits) + 1e-10))
 
         return acts, act_probs
@@ -171,11 +306,11 @@ class MCTS(object):
         """Step forward in the tree, keeping everything we already know
         about the subtree.
         """
-        if last_move in self._root._children:
-            self._root = self._root._children[last_move]
-            self._root._parent = None
-        else:
-            self._root = TreeNode(None, 1.0)
+        self._tree.update_with_move(last_move)
+
+    def clear_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
 
     def __str__(self):
         return "MCTS"
@@ -185,8 +320,14 @@ class MCTSPlayer(object):
     """AI player based on MCTS"""
 
     def __init__(self, policy_value_function,
-                 c_puct=5, n_playout=2000, is_selfplay=0, ef_for_eight=-1):
-        self.mcts = MCTS(policy_value_function, c_puct, n_playout, ef_for_eight)
+                 c_puct=5, n_playout=2000, is_selfplay=0, ef_for_eight=-1,
+                 n_batch=1, policy_value_batch_function=None, cache_size=0,
+                 prune_radius=0, prune_top_k=0, solver_depth=0, solver_in_tree=False):
+        self.mcts = MCTS(policy_value_function, c_puct, n_playout, ef_for_eight,
+                         n_batch, policy_value_batch_function,
+                         cache_size=cache_size, prune_radius=prune_radius,
+                         prune_top_k=prune_top_k, solver_depth=solver_depth,
+                         solver_in_tree=solver_in_tree)
         self._is_selfplay = is_selfplay
 
     def set_player_ind(self, p):
@@ -194,6 +335,8 @@ class MCTSPlayer(object):
 
     def reset_player(self):
         self.mcts.update_with_move(-1)
+        # the weights may change between games
+        self.mcts.clear_cache()
 
     def get_action(self, board, temp=1e-3, return_prob=0, UI=None):
         sensible_moves = board.availables
@@ -6,9 +6,9 @@ A pure implementation of the Monte Carlo Tree Search (MCTS)
 """
 
 import numpy as np
-import copy
 from operator import itemgetter
-import tensorflow as tf
+from models.mcts_tree import ArrayTree
+from models.rollout import RolloutEngine
 
 def rollout_policy_fn(board):
     """a coarse, fast version of policy_fn used in the rollout phase."""
@@ -20,83 +20,18 @@ def rollout_policy_fn(board):
 def policy_value_fn(board):
     """a function that takes in a state and outputs a list of (action, probability)
     tuples and a score for the state"""
+    # the region around the stones if the search set a prune radius
+    moves = board.candidate_moves() if board._prune_radius > 0 else board.availables
     # return uniform probabilities and 0 score for pure MCTS
-    action_probs = np.ones(len(board.availables))/len(board.availables)
-    return zip(board.availables, action_probs), 0
-
-
-class TreeNode(object):
-    """A node in the MCTS tree. Each node keeps track of its own value Q,
-    prior probability P, and its visit-count-adjusted prior score u.
-    """
-
-    def __init__(self, parent, prior_p):
-        self._parent = parent
-        self._children = {}  # a map from action to TreeNode
-        self._n_visits = 0
-        self._Q = 0
-        self._u = 0
-        self._P = prior_p
-
-    def expand(self, action_priors):
-        """Expand tree by creating new children.
-        action_priors: a list of tuples of actions and their prior probability
-            according to the policy function.
-        """
-        for action, prob in action_priors:
-            if action not in self._children:
-                self._children[action] = TreeNode(self, prob)
-
-    def select(self, c_puct):
-        """Select action among children that gives maximum action value Q
-        plus bonus u(P).
-        Return: A tuple of (action, next_node)
-        """
-        return max(self._children.items(),
-                   key=lambda act_node: act_node[1].get_value(c_puct))
-
-    def update(self, leaf_value):
-        """Update node values from leaf evaluation.
-        leaf_value: the value of subtree evaluation from the current player's
-            perspective.
-        """
-        # Count visit.
-        self._n_visits += 1
-        # Update Q, a running average of values for all visits.
-        self._Q += 1.0*(leaf_value - self._Q) / self._n_visits
-
-    def update_recursive(self, leaf_value):
-        """Like a call to update(), but applied recursively for all ancestors.
-        """
-        # If it is not root, this node's parent should be updated first.
-        if self._parent:
-            self._parent.update_recursive(-leaf_value)
-        self.update(leaf_value)
-
-    def get_value(self, c_puct):
-        """Calculate and return the value for this node.
-        It is a combination of leaf evaluations Q, and this node's prior
-        adjusted for its visit count, u.
-        c_puct: a number in (0, inf) controlling the relative impact of
-            value Q, and prior probability P, on this node's score.
-        """
-        self._u = (c_puct * self._P *
-                   np.sqrt(self._parent._n_visits) / (1 + self._n_visits))
-        return self._Q + self._u
-
-    def is_leaf(self):
-        """Check if leaf node (i.e. no nodes below this have been expanded).
-        """
-        return self._children == {}
-
-    def is_root(self):
-        return self._parent is None
+    action_probs = np.ones(len(moves))/len(moves)
+    return zip(moves, action_probs), 0
 
 
 class MCTS(object):
     """A simple implementation of Monte Carlo Tree Search."""
 
-    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000):
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000, n_rollout=1,
+                 prune_radius=0):
         """
         policy_value_fn: a function that takes in a board state and outputs
             a list of (action, probability) tuples and also a score in [-1, 1]
@@ -105,35 +40,68 @@ class MCTS(object):
         c_puct: a number in (0, inf) that controls how quickly exploration
             converges to the maximum-value policy. A higher value means
             relying on the prior more.
+        n_rollout: number of random games played from each leaf, the leaf
+            value is their mean outcome
+        prune_radius: only search the empty moves within this distance of a
+            stone, 0 to search every available move; the rollouts still
+            play anywhere
         """
-        self._root = TreeNode(None, 1.0)
+        self._tree = ArrayTree()
         self._policy = policy_value_fn
         self._c_puct = c_puct
         self._n_playout = n_playout
+        self._n_rollout = n_rollout
+        self._prune_radius = prune_radius
+        self._rollout_engine = None
 
     def _playout(self, state):
         """Run a single playout from the root to the leaf, getting a value at
         the leaf and propagating it back through its parents.
-        State is modified in-place, so a copy must be provided.
+        State is modified in-place while walking down the tree and is
+        restored with undo_move before returning.
         """
-        node = self._root
+        n_stones = len(state.states)
+        tree = self._tree
+        node = 0
         while(1):
-            if node.is_leaf():
+            if tree.is_leaf(node):
 
                 break
             # Greedily select next move.
-            action, node = node.select(self._c_puct)
+            action, node = tree.select(node, self._c_puct)
             state.do_move(action)
 
         action_probs, _ = self._policy(state)
         # Check for end of game
         end, winner = state.game_end()
         if not end:
-            node.expand(action_probs)
-        # Evaluate the leaf node by random rollout
-        leaf_value = self._evaluate_rollout(state)
+            tree.expand(node, action_probs)
+        # Evaluate the leaf node by random rollouts
+        if end or state.if_check_forbidden_hands:
+            # the forbidden hands are only checked by game_end,
+            # so play the rollouts one move at a time
+            n_leaf_stones = len(state.states)
+            leaf_value = 0.0
+            for i in range(self._n_rollout):
+                leaf_value += self._evaluate_rollout(state)
+                while len(state.states) > n_leaf_stones:
+                    state.undo_move()
+            leaf_value /= self._n_rollout
+        else:
+            leaf_value = self._get_rollout_engine(state).evaluate(state, self._n_rollout)
         # Update value and visit count of nodes in this traversal.
-        node.update_recursive(-leaf_value)
+        tree.update_recursive(node, -leaf_value)
+        # take back the tree moves
+        while len(state.states) > n_stones:
+            state.undo_move()
+
+    def _get_rollout_engine(self, state):
+        engine = self._rollout_engine
+        if engine is None or (engine.width, engine.height, engine.n_in_row) != (
+                state.width, state.height, state.n_in_row):
+            engine = RolloutEngine(state.width, state.height, state.n_in_row)
+            self._rollout_engine = engine
+        return engine
 
     def _evaluate_rollout(self, state, limit=1000):
         """Use the rollout policy to play until the end of the game,
@@ -162,29 +130,20 @@ class MCTS(object):
 
         Return: the selected action
         """
-        x = tf.placeholder(tf.int32, [None])
-        y = tf.sort(x, direction='DESCENDING', axis=0)
-        
-        with tf.Session() as sess:
-            for n in range(self._n_playout):
-                # to prevent killed by ITP
-                if state._ef_for_eight > 0:
-                    a = sess.run(y, feed_dict={x:np.random.randint(100, size=(100000))}).shape
-
-                state_copy = copy.deepcopy(state)
-                self._playout(state_copy)
-        return max(self._root._children.items(),
-                   key=lambda act_node: act_node[1]._n_visits)[0]
+        # copy once per search, every playout walks down and back up this copy
+        state_copy = state.clone()
+        if self._prune_radius > 0:
+            state_copy.set_prune_radius(self._prune_radius)
+        for n in range(self._n_playout):
+            self._playout(state_copy)
+        acts, visits = self._tree.root_children()
+        return int(acts[np.argmax(visits)])
 
     def update_with_move(self, last_move):
         """Step forward in the tree, keeping everything we already know
         about the subtree.
         """
-        if last_move in self._root._children:
-            self._root = self._root._children[last_move]
-            self._root._parent = None
-        else:
-            self._root = TreeNode(None, 1.0)
+        self._tree.update_with_move(last_move)
 
     def __str__(self):
         return "MCTS"
@@ -192,8 +151,8 @@ class MCTS(object):
 
 class MCTSPlayer(object):
     """AI player based on MCTS"""
-    def __init__(self, c_puct=5, n_playout=2000):
-        self.mcts = MCTS(policy_value_fn, c_puct, n_playout)
+    def __init__(self, c_puct=5, n_playout=2000, n_rollout=1, prune_radius=0):
+        self.mcts = MCTS(policy_value_fn, c_puct, n_playout, n_rollout, prune_radius)
 
     def set_player_ind(self, p):
         self.player = p
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+The search tree of both MCTS implementations, stored as a struct of arrays:
+node i is described by the i-th item of each preallocated NumPy array, and
+the children of a node are kept next to each other, so that selecting a child
+is a single vectorized argmax over a slice.
+"""
+
+import numpy as np
+
+
+class ArrayTree(object):
+    """A MCTS tree whose nodes are indices into NumPy arrays.
+
+    Each node keeps track of the action leading to it, its parent, the slice
+    of its children, its visit count N, its pending (virtual) visits, its
+    value Q and its prior probability P. Node 0 is always the root.
+    """
+
+    def __init__(self, capacity=1024):
+        self._capacity = capacity
+        self.parent = np.empty(capacity, dtype=np.int32)
+        self.action = np.empty(capacity, dtype=np.int32)
+        self.first_child = np.empty(capacity, dtype=np.int32)
+        self.n_children = np.empty(capacity, dtype=np.int32)
+        self.n_visits = np.empty(capacity, dtype=np.int64)
+        self.n_virtual = np.empty(capacity, dtype=np.int64)
+        self.Q = np.empty(capacity, dtype=np.float64)
+        self.P = np.empty(capacity, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        """Drop every node but a fresh root."""
+        self.size = 1
+        self.parent[0] = -1
+        self.action[0] = -1
+        self.first_child[0] = 0
+        self.n_children[0] = 0
+        self.n_visits[0] = 0
+        self.n_virtual[0] = 0
+        self.Q[0] = 0
+        self.P[0] = 1.0
+
+    def _fields(self):
+        return ['parent', 'action', 'first_child', 'n_children',
+                'n_visits', 'n_virtual', 'Q', 'P']
+
+    def _reserve(self, n):
+        """Make room for n more nodes, doubling the arrays when needed."""
+        if self.size + n <= self._capacity:
+            return
+        while self.size + n > self._capacity:
+            self._capacity *= 2
+        for name in self._fields():
+            old = getattr(self, name)
+            new = np.empty(self._capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def is_leaf(self, node):
+        """Check if leaf node (i.e. no nodes below this have been expanded)."""
+        return self.n_children[node] == 0
+
+    def children(self, node):
+        """Return the slice of the children of node."""
+        first = self.first_child[node]
+        return slice(first, first + self.n_children[node])
+
+    def expand(self, node, action_priors):
+        """Expand node by creating its children in one contiguous block.
+        action_priors: a list of tuples of actions and their prior probability
+            according to the policy function.
+        """
+        if self.n_children[node]:
+            return
+        action_priors = list(action_priors)
+        n = len(action_priors)
+        if n == 0:
+            return
+        actions, priors = zip(*action_priors)
+        self._reserve(n)
+        first = self.size
+        block = slice(first, first + n)
+        self.parent[block] = node
+        self.action[block] = actions
+        self.first_child[block] = 0
+        self.n_children[block] = 0
+        self.n_visits[block] = 0
+        self.n_virtual[block] = 0
+        self.Q[block] = 0
+        self.P[block] = priors
+        self.first_child[node] = first
+        self.n_children[node] = n
+        self.size += n
+
+    def select(self, node, c_puct):
+        """Select the child of node that gives maximum action value Q plus
+        bonus u(P), pending visits counting as losses.
+        Return: A tuple of (action, child)
+        """
+        kids = self.children(node)
+        if self.n_virtual[node] == 0:
+            u = (c_puct * self.P[kids] *
+                 np.sqrt(self.n_visits[node]) / (1 + self.n_visits[kids]))
+            values = self.Q[kids] + u
+        else:
+            n_visits = self.n_visits[kids] + self.n_virtual[kids]
+            Q = ((self.Q[kids] * self.n_visits[kids] - self.n_virtual[kids]) /
+                 np.maximum(n_visits, 1))
+            u = (c_puct * self.P[kids] *
+                 np.sqrt(self.n_visits[node] + self.n_virtual[node]) /
+                 (1 + n_visits))
+            values = Q + u
+        child = kids.start + int(np.argmax(values))
+        return int(self.action[child]), child
+
+    def update_recursive(self, node, leaf_value):
+        """Update the visit count and the running average value Q of node and
+        all its ancestors, the sign of leaf_value flipping at each level.
+        leaf_value: a float, the value of subtree evaluation from the
+            perspective of the player who moved into node.
+        """
+        while node != -1:
+            self.n_visits[node] += 1
+            self.Q[node] += 1.0*(leaf_value - self.Q[node]) / self.n_visits[node]
+            leaf_value = -leaf_value
+            node = self.parent[node]
+
+    def add_virtual_loss_recursive(self, node, virtual_loss):
+        """Add virtual_loss pending visits to node and all its ancestors,
+        a negative virtual_loss reverts it.
+        """
+        while node != -1:
+            self.n_virtual[node] += virtual_loss
+            node = self.parent[node]
+
+    def root_children(self):
+        """Return the actions and the visit counts of the root's children."""
+        kids = self.children(0)
+        return self.action[kids], self.n_visits[kids]
+
+    def update_with_move(self, last_move):
+        """Make the child of the root reached by last_move the new root,
+        keeping its subtree and compacting it to the front of the arrays.
+        Any other last_move, e.g. -1, resets the tree.
+        """
+        kids = self.children(0)
+        matches = np.flatnonzero(self.action[kids] == last_move)
+        if last_move == -1 or len(matches) == 0:
+            self.reset()
+            return
+        # breadth-first order keeps the children of every node contiguous
+        order = [kids.start + int(matches[0])]
+        i = 0
+        while i < len(order):
+            n = self.n_children[order[i]]
+            if n:
+                first = self.first_child[order[i]]
+                order.extend(range(first, first + n))
+            i += 1
+        order = np.array(order)
+        new_index = np.full(self.size, -1, dtype=np.int32)
+        new_index[order] = np.arange(len(order), dtype=np.int32)
+        for name in self._fields():
+            array = getattr(self, name)
+            array[:len(order)] = array[order]
+        n = len(order)
+        self.parent[0] = -1
+        self.parent[1:n] = new_index[self.parent[1:n]]
+        expanded = self.n_children[:n] > 0
+        self.first_child[:n][expanded] = new_index[self.first_child[:n][expanded]]
+        self.size = n
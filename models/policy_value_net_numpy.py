@@ -3,17 +3,32 @@
 Implement the policy value network using numpy, so that we can play with the
 trained AI model without installing any DL framwork
 
+The weights are either the original list of 16 theano arrays, or a dict
+exported from a tensorflow or pytorch checkpoint by export_numpy.py, see
+params_from_tensorflow and params_from_pytorch. The forward pass runs on
+batches in float32, with the activations laid out as (C, H, W, N), so that
+every conv is one gather of cached im2col indices and one matrix product.
+The weights may be quantized to int8 or float16 by quantize_params, which
+only makes the model files smaller: they are dequantized to float32 when
+loaded, since numpy has no fast int8 or float16 matrix product.
+
 @author: Junxiao Song
 """
 
 from __future__ import print_function
+import pickle
 import numpy as np
 
+# im2col indices, key: (channels, height, width, field_height, field_width, padding, stride)
+_im2col_indices_cache = {}
+# flat im2col indices into a padded input, key: (channels, height, width, field_height, field_width, padding)
+_im2col_flat_indices_cache = {}
+
 
 # some utility functions
 def softmax(x):
-    probs = np.exp(x - np.max(x))
-    probs /= np.sum(probs)
+    probs = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    probs /= np.sum(probs, axis=-1, keepdims=True)
     return probs
 
 
@@ -22,22 +37,42 @@ def relu(X):
     return out
 
 
-def conv_forward(X, W, b, stride=1, padding=1):
-    n_filters, d_filter, h_filter, w_filter = W.shape
-    # theano conv2d flips the filters (rotate 180 degree) first
-    # while doing the calculation
-    W = W[:, :, ::-1, ::-1]
-    n_x, d_x, h_x, w_x = X.shape
-    h_out = (h_x - h_filter + 2 * padding) / stride + 1
-    w_out = (w_x - w_filter + 2 * padding) / stride + 1
-    h_out, w_out = int(h_out), int(w_out)
-    X_col = im2col_indices(X, h_filter, w_filter,
-                           padding=padding, stride=stride)
-    W_col = W.reshape(n_filters, -1)
-    out = (np.dot(W_col, X_col).T + b).T
-    out = out.reshape(n_filters, h_out, w_out, n_x)
-    out = out.transpose(3, 0, 1, 2)
-    return out
+def get_im2col_flat_indices(channels, height, width, field_height, field_width, padding):
+    """return the indices, of shape (channels * field_height * field_width,
+    height * width), of the columns of a conv keeping the board size, into
+    the flattened (channels, height + 2 * padding, width + 2 * padding)
+    padded input
+    """
+    key = (channels, height, width, field_height, field_width, padding)
+    if key not in _im2col_flat_indices_cache:
+        k, i, j = get_im2col_indices((1, channels, height, width), field_height,
+                                     field_width, padding=padding)
+        padded_height, padded_width = height + 2 * padding, width + 2 * padding
+        _im2col_flat_indices_cache[key] = (k * padded_height + i) * padded_width + j
+    return _im2col_flat_indices_cache[key]
+
+
+def conv2d(X, W_col, b, field_height, field_width):
+    """a batched cross-correlation keeping the board size, like the "same"
+    conv layers of tensorflow and pytorch
+    X: array of shape (C, H, W, N)
+    W_col: the filters of shape (F, C, field_height, field_width), reshaped
+        to (F, C * field_height * field_width)
+    return: array of shape (F, H, W, N)
+    """
+    d_x, h_x, w_x, n_x = X.shape
+    if field_height == 1 and field_width == 1:
+        # a 1x1 convolution is a matrix product over the channels
+        cols = X.reshape(d_x, -1)
+    else:
+        padding = field_height // 2
+        X_padded = np.zeros((d_x, h_x + 2 * padding, w_x + 2 * padding, n_x), dtype=X.dtype)
+        X_padded[:, padding:padding + h_x, padding:padding + w_x] = X
+        indices = get_im2col_flat_indices(d_x, h_x, w_x, field_height, field_width, padding)
+        cols = np.take(X_padded.reshape(-1, n_x), indices, axis=0).reshape(W_col.shape[1], -1)
+    out = np.dot(W_col, cols)
+    out += b.reshape(-1, 1)
+    return out.reshape(W_col.shape[0], h_x, w_x, n_x)
 
 
 def fc_forward(X, W, b):
@@ -47,8 +82,11 @@ def fc_forward(X, W, b):
 
 def get_im2col_indices(x_shape, field_height,
                        field_width, padding=1, stride=1):
-    # First figure out what the size of the output should be
     N, C, H, W = x_shape
+    key = (C, H, W, field_height, field_width, padding, stride)
+    if key in _im2col_indices_cache:
+        return _im2col_indices_cache[key]
+    # First figure out what the size of the output should be
     assert (H + 2 * padding - field_height) % stride == 0
     assert (W + 2 * padding - field_height) % stride == 0
     out_height = int((H + 2 * padding - field_height) / stride + 1)
@@ -64,30 +102,256 @@ def get_im2col_indices(x_shape, field_height,
 
     k = np.repeat(np.arange(C), field_height * field_width).reshape(-1, 1)
 
-    return (k.astype(int), i.astype(int), j.astype(int))
+    indices = (k.astype(int), i.astype(int), j.astype(int))
+    _im2col_indices_cache[key] = indices
+    return indices
+
+
+def params_from_theano(net_params):
+    """convert the original list of 16 theano arrays, whose filters are
+    flipped, to the dict of weights of PolicyValueNetNumpy
+    """
+    p = [np.asarray(param) for param in net_params]
+
+    def conv(i):
+        return (p[i][:, :, ::-1, ::-1], p[i + 1])
+
+    return {
+        "trunk": [conv(0), conv(2), conv(4)],
+        "blocks": [],
+        "action_conv": conv(6),
+        "action_fc": (p[8], p[9]),
+        "value_conv": conv(10),
+        "value_fc1": (p[12], p[13]),
+        "value_fc2": (p[14], p[15]),
+    }
+
+
+def _hwc_rows_to_chw(W, height, width):
+    """reorder the input rows of a dense kernel from the flattening of a
+    channels_last tensor to the flattening of a channels_first one
+    """
+    channels = W.shape[0] // (height * width)
+    return W.reshape(height, width, channels, -1).transpose(2, 0, 1, 3).reshape(W.shape[0], -1)
+
+
+def params_from_tensorflow(variables, board_height, board_width):
+    """convert the variables of a checkpoint of policy_value_net_tensorflow
+    or policy_value_net_tensorflow2, a dict of name: array, to the dict of
+    weights of PolicyValueNetNumpy; the layers are found by the default
+    names of tf.layers, in their order of creation
+    """
+    def layers(kind):
+        found = {}
+        for name, value in variables.items():
+            parts = name.split("/")
+            if len(parts) < 2 or parts[-1] not in ("kernel", "bias"):
+                continue
+            layer = parts[-2]
+            if layer != kind and not layer.startswith(kind + "_"):
+                continue
+            index = 0 if layer == kind else int(layer[len(kind) + 1:])
+            found.setdefault(index, {})[parts[-1]] = np.asarray(value)
+        return [found[index] for index in sorted(found)]
+
+    # HWIO to OIHW
+    convs = [(layer["kernel"].transpose(3, 2, 0, 1), layer["bias"]) for layer in layers("conv2d")]
+    dense = [(layer["kernel"], layer["bias"]) for layer in layers("dense")]
+    if len(convs) < 5 or len(dense) != 3:
+        raise Exception('unexpected layers in the tensorflow checkpoint: {} conv2d, {} dense'.format(
+            len(convs), len(dense)))
+    return {
+        "trunk": convs[:3],
+        # the blocks of policy_value_net_tensorflow2 are a conv with relu
+        "blocks": [[conv] for conv in convs[3:-2]],
+        "action_conv": convs[-2],
+        "action_fc": (_hwc_rows_to_chw(dense[0][0], board_height, board_width), dense[0][1]),
+        "value_conv": convs[-1],
+        "value_fc1": (_hwc_rows_to_chw(dense[1][0], board_height, board_width), dense[1][1]),
+        "value_fc2": dense[2],
+    }
+
+
+def params_from_pytorch(state_dict, bn_eps=1e-5):
+    """convert the state dict of policy_value_net_pytorch or
+    policy_value_net_pytorch2, a dict of name: array, to the dict of weights
+    of PolicyValueNetNumpy; the batch norms of the residual blocks are
+    folded into their convs
+    """
+    state_dict = {name: np.asarray(value) for name, value in state_dict.items()}
+
+    def layer(name, transpose=False):
+        W = state_dict[name + ".weight"]
+        return (W.T if transpose else W, state_dict[name + ".bias"])
+
+    def folded(conv, bn):
+        scale = state_dict[bn + ".weight"] / np.sqrt(state_dict[bn + ".running_var"] + bn_eps)
+        W = state_dict[conv + ".weight"] * scale.reshape(-1, 1, 1, 1)
+        return (W, state_dict[bn + ".bias"] - state_dict[bn + ".running_mean"] * scale)
+
+    blocks = []
+    while "res_{}.conv1.weight".format(len(blocks)) in state_dict:
+        prefix = "res_{}.".format(len(blocks))
+        blocks.append([folded(prefix + "conv1", prefix + "bn1"),
+                       folded(prefix + "conv2", prefix + "bn2")])
+    return {
+        "trunk": [layer("conv1"), layer("conv2"), layer("conv3")],
+        "blocks": blocks,
+        "action_conv": layer("act_conv1"),
+        "action_fc": layer("act_fc1", transpose=True),
+        "value_conv": layer("val_conv1"),
+        "value_fc1": layer("val_fc1", transpose=True),
+        "value_fc2": layer("val_fc2", transpose=True),
+    }
+
+
+def load_net_params(model_file):
+    with open(model_file, 'rb') as fin:
+        # encoding to support the python2 pickles of the theano weights
+        return pickle.load(fin, encoding='bytes')
+
+
+def save_net_params(net_params, model_file):
+    with open(model_file, 'wb') as fout:
+        pickle.dump(net_params, fout, protocol=pickle.HIGHEST_PROTOCOL)
 
 
-def im2col_indices(x, field_height, field_width, padding=1, stride=1):
-    """ An implementation of im2col based on some fancy indexing """
-    # Zero-pad the input
-    p = padding
-    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+# the layers of the net, the convs with filters (F, C, H, W) and the dense
+# layers with kernels (in, out), whose output channels are on axis 0 and 1
+_CONV_LAYERS = ["action_conv", "value_conv"]
+_DENSE_LAYERS = ["action_fc", "value_fc1", "value_fc2"]
 
-    k, i, j = get_im2col_indices(x.shape, field_height,
-                                 field_width, padding, stride)
 
-    cols = x_padded[:, k, i, j]
-    C = x.shape[1]
-    cols = cols.transpose(1, 2, 0).reshape(field_height * field_width * C, -1)
-    return cols
+def _quantize_layer(W, b, quantization, axis):
+    """return a layer (W, b) quantized to float16, or to int8 with one
+    symmetric scale per output channel on axis: (W_int8, b, scale)
+    """
+    W = np.asarray(W, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    if quantization == "float16":
+        return (W.astype(np.float16), b.astype(np.float16))
+    if quantization == "int8":
+        reduce_axes = tuple(i for i in range(W.ndim) if i != axis)
+        scale = np.abs(W).max(axis=reduce_axes, keepdims=True) / 127.0
+        scale[scale == 0] = 1.0
+        W_int8 = np.clip(np.round(W / scale), -127, 127).astype(np.int8)
+        return (W_int8, b, scale.astype(np.float32))
+    raise Exception('unknown quantization {}'.format(quantization))
+
+
+def _dequantize_layer(layer):
+    if len(layer) == 3:
+        W_int8, b, scale = layer
+        return (W_int8.astype(np.float32) * scale, np.asarray(b, dtype=np.float32))
+    W, b = layer
+    return (np.asarray(W, dtype=np.float32), np.asarray(b, dtype=np.float32))
+
+
+def quantize_params(net_params, quantization):
+    """quantize the weights of a dict of weights of PolicyValueNetNumpy
+    quantization: "float16", or "int8" for the weights with per output
+        channel scales, the biases staying float32
+    return: a dict of weights marked by its "quantization", about 2x or 4x
+        smaller, which PolicyValueNetNumpy dequantizes when loading it
+    """
+    if net_params.get("quantization"):
+        raise Exception('the weights are already quantized to {}'.format(net_params["quantization"]))
+
+    def conv(layer):
+        return _quantize_layer(layer[0], layer[1], quantization, axis=0)
+
+    quantized = {
+        "quantization": quantization,
+        "trunk": [conv(layer) for layer in net_params["trunk"]],
+        "blocks": [[conv(layer) for layer in block] for block in net_params["blocks"]],
+    }
+    for name in _CONV_LAYERS:
+        quantized[name] = conv(net_params[name])
+    for name in _DENSE_LAYERS:
+        quantized[name] = _quantize_layer(net_params[name][0], net_params[name][1],
+                                          quantization, axis=1)
+    return quantized
+
+
+def dequantize_params(net_params):
+    """return the float32 dict of weights of a quantized one"""
+    dequantized = {
+        "trunk": [_dequantize_layer(layer) for layer in net_params["trunk"]],
+        "blocks": [[_dequantize_layer(layer) for layer in block] for block in net_params["blocks"]],
+    }
+    for name in _CONV_LAYERS + _DENSE_LAYERS:
+        dequantized[name] = _dequantize_layer(net_params[name])
+    return dequantized
+
+
+class _Conv(object):
+    """a conv layer ready for conv2d"""
+
+    def __init__(self, W, b):
+        W = np.asarray(W, dtype=np.float32)
+        self.field_height, self.field_width = W.shape[2], W.shape[3]
+        self.W_col = np.ascontiguousarray(W.reshape(W.shape[0], -1))
+        self.b = np.asarray(b, dtype=np.float32)
+
+    def __call__(self, X):
+        return conv2d(X, self.W_col, self.b, self.field_height, self.field_width)
 
 
 class PolicyValueNetNumpy():
     """policy-value network in numpy """
-    def __init__(self, board_width, board_height, net_params):
+    def __init__(self, args, board_width, board_height, net_params=None, model_file=None):
+        """
+        net_params: the original list of theano arrays, or the dict of an
+            export of export_numpy.py, maybe quantized by quantize_params
+        model_file: a pickle of net_params, read if net_params is None
+        """
         self.board_width = board_width
         self.board_height = board_height
+        if net_params is None:
+            net_params = load_net_params(model_file)
+        if not isinstance(net_params, dict):
+            net_params = params_from_theano(net_params)
         self.params = net_params
+        # the weights of a quantized export are stored small but computed
+        # in float32, so their outputs carry the rounding of the weights only
+        self.quantization = net_params.get("quantization")
+        if self.quantization:
+            net_params = dequantize_params(net_params)
+        self._trunk = [_Conv(W, b) for W, b in net_params["trunk"]]
+        # a block of one conv is a conv with relu, of two convs a residual block
+        self._blocks = [[_Conv(W, b) for W, b in block] for block in net_params["blocks"]]
+        self._action_conv = _Conv(*net_params["action_conv"])
+        self._value_conv = _Conv(*net_params["value_conv"])
+        self._action_fc, self._value_fc1, self._value_fc2 = [
+            tuple(np.asarray(x, dtype=np.float32) for x in net_params[name])
+            for name in ["action_fc", "value_fc1", "value_fc2"]]
+
+    def policy_value(self, state_batch):
+        """
+        input: a batch of states
+        output: a batch of action probabilities and state values
+        """
+        X = np.asarray(state_batch, dtype=np.float32).reshape(
+                -1, 4, self.board_height, self.board_width)
+        n = X.shape[0]
+        # (N, C, H, W) to (C, H, W, N)
+        X = np.ascontiguousarray(X.transpose(1, 2, 3, 0))
+        for conv in self._trunk:
+            X = relu(conv(X))
+        for block in self._blocks:
+            if len(block) == 1:
+                X = relu(block[0](X))
+            else:
+                X = relu(block[1](relu(block[0](X))) + X)
+        # policy head
+        # flatten every board in the (C, H, W) order
+        X_p = relu(self._action_conv(X)).reshape(-1, n).T
+        act_probs = softmax(fc_forward(X_p, *self._action_fc))
+        # value head
+        X_v = relu(self._value_conv(X)).reshape(-1, n).T
+        X_v = relu(fc_forward(X_v, *self._value_fc1))
+        value = np.tanh(fc_forward(X_v, *self._value_fc2))
+        return act_probs, value
 
     def policy_value_fn(self, board):
         """
@@ -95,21 +359,22 @@ class PolicyValueNetNumpy():
         output: a list of (action, probability) tuples for each available
         action and the score of the board state
         """
-        legal_positions = board.availables
-        current_state = board.current_state()
+        legal_positions = board.candidate_moves()
+        act_probs, value = self.policy_value(board.current_state(share=True))
+        act_probs = zip(legal_positions, act_probs[0][legal_positions.mask])
+        return act_probs, value[0][0].item()
 
-        X = current_state.reshape(-1, 4, self.board_width, self.board_height)
-        # first 3 conv layers with ReLu nonlinearity
-        for i in [0, 2, 4]:
-            X = relu(conv_forward(X, self.params[i], self.params[i+1]))
-        # policy head
-        X_p = relu(conv_forward(X, self.params[6], self.params[7], padding=0))
-        X_p = fc_forward(X_p.flatten(), self.params[8], self.params[9])
-        act_probs = softmax(X_p)
-        # value head
-        X_v = relu(conv_forward(X, self.params[10],
-                                self.params[11], padding=0))
-        X_v = relu(fc_forward(X_v.flatten(), self.params[12], self.params[13]))
-        value = np.tanh(fc_forward(X_v, self.params[14], self.params[15]))[0]
-        act_probs = zip(legal_positions, act_probs.flatten()[legal_positions])
-        return act_probs, value
+    def policy_value_fn_batch(self, boards):
+        """
+        input: a list of boards
+        output: a list of what policy_value_fn outputs for each board,
+        computed with one forward pass
+        """
+        legal_positions_batch = [board.candidate_moves() for board in boards]
+        state_batch = np.empty((len(boards), 4, self.board_height, self.board_width),
+                               dtype=np.float32)
+        for i, board in enumerate(boards):
+            board.current_state(out=state_batch[i])
+        act_probs, value = self.policy_value(state_batch)
+        return [(zip(legal_positions, act_probs[i][legal_positions.mask]), value[i][0].item())
+                for i, legal_positions in enumerate(legal_positions_batch)]
@@ -140,12 +140,10 @@ class PolicyValueNet():
         action and the score of the board state
         """
         # the first two move is random
-        if len(board.moved) <= 2 or board._ef_for_eight <= 0:
-                legal_positions = board.availables
-        else:
-                legal_positions = board.eight_connected_region_to_moved
-        current_state = np.ascontiguousarray(board.current_state().reshape(
-                -1, 4, self.board_width, self.board_height))
+        legal_positions = board.candidate_moves()
+        # the planes kept by the board are contiguous float32 already
+        current_state = board.current_state(share=True).reshape(
+                -1, 4, self.board_width, self.board_height)
         if self.use_gpu:
             log_act_probs, value = self.policy_value_net(
                     Variable(torch.from_numpy(current_state)).cuda().float())
@@ -154,10 +152,29 @@ class PolicyValueNet():
             log_act_probs, value = self.policy_value_net(
                     Variable(torch.from_numpy(current_state)).float())
             act_probs = np.exp(log_act_probs.data.numpy().flatten())
-        act_probs = zip(legal_positions, act_probs[legal_positions])
-        value = value.data[0][0]
+        act_probs = zip(legal_positions, act_probs[legal_positions.mask])
+        # a python float, the value may be a cuda tensor
+        value = value.data[0][0].item()
         return act_probs, value
 
+    def policy_value_fn_batch(self, boards):
+        """
+        input: a list of boards
+        output: a list of what policy_value_fn outputs for each board,
+        computed with one forward pass
+        """
+        # the first two move is random
+        legal_positions_batch = [board.candidate_moves() for board in boards]
+
+        state_batch = np.empty((len(boards), 4, self.board_height, self.board_width),
+                               dtype=np.float32)
+        for i, board in enumerate(boards):
+            board.current_state(out=state_batch[i])
+        act_probs, value = self.policy_value(state_batch.reshape(
+                -1, 4, self.board_width, self.board_height))
+        return [(zip(legal_positions, act_probs[i][legal_positions.mask]), value[i][0].item())
+                for i, legal_positions in enumerate(legal_positions_batch)]
+
     def train_step(self, state_batch, mcts_probs, winner_batch, lr):
         """perform a training step"""
         # wrap in Variable
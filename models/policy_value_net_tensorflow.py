@@ -6,19 +6,100 @@ Tested in Tensorflow 1.4 and 1.5
 @author: Xiang Zhong
 """
 
+import threading
 import numpy as np
 import tensorflow as tf
 
 
+def session_config(intra_op_threads=0, inter_op_threads=0):
+    """the config of the session of a net, 0 threads for the defaults of
+    tensorflow
+    """
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                          inter_op_parallelism_threads=inter_op_threads)
+
+
 class PolicyValueNet():
-    def __init__(self, args, board_width, board_height, model_file=None):
+    def __init__(self, args, board_width, board_height, model_file=None,
+                 inference_only=False, use_xla=False, intra_op_threads=0,
+                 inter_op_threads=0):
+        """
+        inference_only: only load the policy and value heads, as a frozen
+            graph whose weights are constants, for playing; model_file is
+            either a checkpoint or a frozen graph saved by save_frozen_graph
+        use_xla: compile the frozen graph with XLA
+        intra_op_threads, inter_op_threads: the thread pools of the session
+            of this net, 0 for the defaults of tensorflow
+        """
         self.board_width = board_width
         self.board_height = board_height
+        self.inference_only = inference_only
+        self.use_xla = use_xla
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        # the input buffer of each thread, see _input_buffer
+        self._buffers = threading.local()
+        if inference_only:
+            self.session = None
+            self.restore_model(model_file)
+            return
+
+        # a graph and a session of its own, so that several nets live in
+        # one process without sharing variables
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self._build_network(board_width, board_height)
+
+            # Define the Loss function
+            # 1. Label: the array containing if the game wins or not for each state
+            self.labels = tf.placeholder(tf.float32, shape=[None, 1])
+            # 2. Predictions: the array containing the evaluation score of each state
+            # which is self.evaluation_fc2
+            # 3-1. Value Loss function
+            self.value_loss = tf.losses.mean_squared_error(self.labels,
+                                                           self.evaluation_fc2)
+            # 3-2. Policy Loss function
+            self.mcts_probs = tf.placeholder(
+                    tf.float32, shape=[None, board_height * board_width])
+            self.policy_loss = tf.negative(tf.reduce_mean(
+                    tf.reduce_sum(tf.multiply(self.mcts_probs, self.action_fc), 1)))
+            # 3-3. L2 penalty (regularization)
+            l2_penalty_beta = 1e-4
+            vars = self.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
+            l2_penalty = l2_penalty_beta * tf.add_n(
+                [tf.nn.l2_loss(v) for v in vars if 'bias' not in v.name.lower()])
+            # 3-4 Add up to be the Loss function
+            self.loss = self.value_loss + self.policy_loss + l2_penalty
+
+            # Define the optimizer we use for training
+            self.learning_rate = tf.placeholder(tf.float32)
+            self.optimizer = tf.train.AdamOptimizer(
+                    learning_rate=self.learning_rate).minimize(self.loss)
+
+            # Make a session
+            self.session = tf.Session(graph=self.graph, config=self._session_config())
 
+            # calc policy entropy, for monitoring only
+            self.entropy = tf.negative(tf.reduce_mean(
+                    tf.reduce_sum(tf.exp(self.action_fc) * self.action_fc, 1)))
+
+            # Initialize variables
+            init = tf.global_variables_initializer()
+            self.session.run(init)
+
+            # For saving and restoring
+            self.saver = tf.train.Saver()
+        if model_file is not None:
+            self.restore_model(model_file)
+
+    def _build_network(self, board_width, board_height):
+        """define the layers from the input to the policy and value heads in
+        the default graph
+        """
         # Define the tensorflow neural network
         # 1. Input:
         self.input_states = tf.placeholder(
-                tf.float32, shape=[None, 4, board_height, board_width])
+                tf.float32, shape=[None, 4, board_height, board_width], name="input_states")
         self.input_state = tf.transpose(self.input_states, [0, 2, 3, 1])
         # 2. Common Networks Layers
         self.conv1 = tf.layers.conv2d(inputs=self.input_state,
@@ -60,57 +141,80 @@ class PolicyValueNet():
         self.evaluation_fc2 = tf.layers.dense(inputs=self.evaluation_fc1,
                                               units=1, activation=tf.nn.tanh)
 
-        # Define the Loss function
-        # 1. Label: the array containing if the game wins or not for each state
-        self.labels = tf.placeholder(tf.float32, shape=[None, 1])
-        # 2. Predictions: the array containing the evaluation score of each state
-        # which is self.evaluation_fc2
-        # 3-1. Value Loss function
-        self.value_loss = tf.losses.mean_squared_error(self.labels,
-                                                       self.evaluation_fc2)
-        # 3-2. Policy Loss function
-        self.mcts_probs = tf.placeholder(
-                tf.float32, shape=[None, board_height * board_width])
-        self.policy_loss = tf.negative(tf.reduce_mean(
-                tf.reduce_sum(tf.multiply(self.mcts_probs, self.action_fc), 1)))
-        # 3-3. L2 penalty (regularization)
-        l2_penalty_beta = 1e-4
-        vars = tf.trainable_variables()
-        l2_penalty = l2_penalty_beta * tf.add_n(
-            [tf.nn.l2_loss(v) for v in vars if 'bias' not in v.name.lower()])
-        # 3-4 Add up to be the Loss function
-        self.loss = self.value_loss + self.policy_loss + l2_penalty
-
-        # Define the optimizer we use for training
-        self.learning_rate = tf.placeholder(tf.float32)
-        self.optimizer = tf.train.AdamOptimizer(
-                learning_rate=self.learning_rate).minimize(self.loss)
-
-        # Make a session
-        self.session = tf.Session()
-
-        # calc policy entropy, for monitoring only
-        self.entropy = tf.negative(tf.reduce_mean(
-                tf.reduce_sum(tf.exp(self.action_fc) * self.action_fc, 1)))
-
-        # Initialize variables
-        init = tf.global_variables_initializer()
-        self.session.run(init)
-
-        # For saving and restoring
-        self.saver = tf.train.Saver()
-        if model_file is not None:
-            self.restore_model(model_file)
+    def _session_config(self):
+        return session_config(self.intra_op_threads, self.inter_op_threads)
+
+    def _freeze(self, model_path=None):
+        """return the graph def of the policy and value heads only, with the
+        weights of the checkpoint model_path, or random ones if None, folded
+        in as constants
+        """
+        graph = tf.Graph()
+        with graph.as_default():
+            self._build_network(self.board_width, self.board_height)
+            tf.identity(self.action_fc, name="log_act_probs")
+            tf.identity(self.evaluation_fc2, name="value")
+            with tf.Session(graph=graph) as session:
+                if model_path is None:
+                    session.run(tf.global_variables_initializer())
+                else:
+                    # the slots of the optimizer in the checkpoint are not needed
+                    tf.train.Saver(tf.global_variables()).restore(session, model_path)
+                # only the nodes the two heads depend on are kept
+                return tf.graph_util.convert_variables_to_constants(
+                        session, graph.as_graph_def(), ["log_act_probs", "value"])
+
+    def _load_frozen_graph(self, graph_def):
+        """run graph_def in a session of its own, with a callable feeding
+        the input and fetching both heads without going through session.run
+        """
+        graph = tf.Graph()
+        with graph.as_default():
+            self.input_states, self.action_fc, self.evaluation_fc2 = tf.import_graph_def(
+                    graph_def, name="",
+                    return_elements=["input_states:0", "log_act_probs:0", "value:0"])
+        config = self._session_config()
+        if self.use_xla:
+            config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        if self.session is not None:
+            self.session.close()
+        self.graph = graph
+        self.graph_def = graph_def
+        self.session = tf.Session(graph=graph, config=config)
+        self._predict = self.session.make_callable(
+                [self.action_fc, self.evaluation_fc2], feed_list=[self.input_states])
+
+    def save_frozen_graph(self, output_file):
+        """save the frozen graph of an inference_only net, which loads
+        without the training graph nor the checkpoint
+        """
+        if not self.inference_only:
+            raise Exception('only an inference_only net has a frozen graph')
+        with tf.gfile.GFile(output_file, "wb") as fout:
+            fout.write(self.graph_def.SerializeToString())
+
+    def _input_buffer(self, n):
+        """return an input array of n states, reused by the calls of the
+        same thread
+        """
+        buffer = getattr(self._buffers, "states", None)
+        if buffer is None or len(buffer) < n:
+            buffer = np.empty((n, 4, self.board_height, self.board_width), dtype=np.float32)
+            self._buffers.states = buffer
+        return buffer[:n]
 
     def policy_value(self, state_batch):
         """
         input: a batch of states
         output: a batch of action probabilities and state values
         """
-        log_act_probs, value = self.session.run(
-                [self.action_fc, self.evaluation_fc2],
-                feed_dict={self.input_states: state_batch}
-                )
+        if self.inference_only:
+            log_act_probs, value = self._predict(state_batch)
+        else:
+            log_act_probs, value = self.session.run(
+                    [self.action_fc, self.evaluation_fc2],
+                    feed_dict={self.input_states: state_batch}
+                    )
         act_probs = np.exp(log_act_probs)
         return act_probs, value
 
@@ -121,19 +225,36 @@ class PolicyValueNet():
         action and the score of the board state
         """
         # the first two move is random
-        if len(board.moved) <= 2 or board._ef_for_eight <= 0:
-                legal_positions = board.availables
-        else:
-                legal_positions = board.eight_connected_region_to_moved
+        legal_positions = board.candidate_moves()
                 
-        current_state = np.ascontiguousarray(board.current_state().reshape(
-                -1, 4, self.board_width, self.board_height))
+        # the planes kept by the board are contiguous float32 already
+        current_state = board.current_state(share=True).reshape(
+                -1, 4, self.board_width, self.board_height)
         act_probs, value = self.policy_value(current_state)
-        act_probs = zip(legal_positions, act_probs[0][legal_positions])
-        return act_probs, value
+        act_probs = zip(legal_positions, act_probs[0][legal_positions.mask])
+        return act_probs, value[0][0].item()
+
+    def policy_value_fn_batch(self, boards):
+        """
+        input: a list of boards
+        output: a list of what policy_value_fn outputs for each board,
+        computed with one forward pass
+        """
+        # the first two move is random
+        legal_positions_batch = [board.candidate_moves() for board in boards]
+
+        state_batch = self._input_buffer(len(boards))
+        for i, board in enumerate(boards):
+            board.current_state(out=state_batch[i])
+        act_probs, value = self.policy_value(state_batch.reshape(
+                -1, 4, self.board_width, self.board_height))
+        return [(zip(legal_positions, act_probs[i][legal_positions.mask]), value[i][0].item())
+                for i, legal_positions in enumerate(legal_positions_batch)]
 
     def train_step(self, state_batch, mcts_probs, winner_batch, lr):
         """perform a training step"""
+        if self.inference_only:
+            raise Exception('an inference_only net cannot be trained')
         winner_batch = np.reshape(winner_batch, (-1, 1))
         loss, entropy, _ = self.session.run(
                 [self.loss, self.entropy, self.optimizer],
@@ -144,7 +265,17 @@ class PolicyValueNet():
         return loss, entropy
 
     def save_model(self, model_path):
+        if self.inference_only:
+            raise Exception('an inference_only net has no checkpoint to save, see save_frozen_graph')
         self.saver.save(self.session, model_path)
 
     def restore_model(self, model_path):
-        self.saver.restore(self.session, model_path)
+        if not self.inference_only:
+            self.saver.restore(self.session, model_path)
+        elif model_path is not None and model_path.endswith(".pb"):
+            graph_def = tf.GraphDef()
+            with tf.gfile.GFile(model_path, "rb") as fin:
+                graph_def.ParseFromString(fin.read())
+            self._load_frozen_graph(graph_def)
+        else:
+            self._load_frozen_graph(self._freeze(model_path))
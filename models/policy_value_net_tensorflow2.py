@@ -8,119 +8,130 @@ Tested in Tensorflow 1.4 and 1.5
 
 import numpy as np
 import tensorflow as tf
+from models.policy_value_net_tensorflow import session_config
 
 
 class PolicyValueNet():
-    def __init__(self, args, board_width, board_height, training=False, model_file=None):
+    def __init__(self, args, board_width, board_height, training=False, model_file=None,
+                 intra_op_threads=0, inter_op_threads=0):
+        """
+        intra_op_threads, inter_op_threads: the thread pools of the session
+            of this net, 0 for the defaults of tensorflow
+        """
         self.board_width = board_width
         self.board_height = board_height
 
-        # Define the tensorflow neural network
-        # 1. Input:
-        self.input_states = tf.placeholder(
-                tf.float32, shape=[None, 4, board_height, board_width])
-        self.input_state = tf.transpose(self.input_states, [0, 2, 3, 1])
-        # 2. Common Networks Layers
-        self.conv1 = tf.layers.conv2d(inputs=self.input_state,
-                                      filters=32, kernel_size=[3, 3],
-                                      padding="same", data_format="channels_last",
-                                      activation=tf.nn.relu)
-        self.conv2 = tf.layers.conv2d(inputs=self.conv1, filters=64,
-                                      kernel_size=[3, 3], padding="same",
-                                      data_format="channels_last",
-                                      activation=tf.nn.relu)
-        self.conv3 = tf.layers.conv2d(inputs=self.conv2, filters=128,
-                                      kernel_size=[3, 3], padding="same",
-                                      data_format="channels_last",
-                                      activation=tf.nn.relu)
-        if args.n_layer_resnet != -1:
-            for block in range(args.n_layer_resnet):
-                if block == 0:
-                    setattr(self, "res_%i" % block, self.ResBlock(self.conv3, training=training))
-                else:
-                    setattr(self, "res_%i" % block, self.ResBlock(getattr(self, "res_%i" % (block-1)), training=training))
-
-        # 3-1 Action Networks
-        if args.n_layer_resnet != -1:
-            self.action_conv = tf.layers.conv2d(inputs=getattr(self, "res_%i" % (args.n_layer_resnet-1)), filters=4,
-                                            kernel_size=[1, 1], padding="same",
-                                            data_format="channels_last",
-                                            activation=tf.nn.relu)
-        else:
-            self.action_conv = tf.layers.conv2d(inputs=self.conv3, filters=4,
-                                            kernel_size=[1, 1], padding="same",
-                                            data_format="channels_last",
-                                            activation=tf.nn.relu)
-        # Flatten the tensor
-        self.action_conv_flat = tf.reshape(
-                self.action_conv, [-1, 4 * board_height * board_width])
-
-        # 3-2 Full connected layer, the output is the log probability of moves
-        # on each slot on the board
-        self.action_fc = tf.layers.dense(inputs=self.action_conv_flat,
-                                         units=board_height * board_width,
-                                         activation=tf.nn.log_softmax)
-
-        # 4 Evaluation Networks
-        if args.n_layer_resnet != -1:
-            self.evaluation_conv = tf.layers.conv2d(inputs=getattr(self, "res_%i" % (args.n_layer_resnet-1)), filters=2,
-                                                    kernel_size=[1, 1],
-                                                    padding="same",
-                                                    data_format="channels_last",
-                                                    activation=tf.nn.relu)
-        else:
-            self.evaluation_conv = tf.layers.conv2d(inputs=self.conv3, filters=2,
-                                                    kernel_size=[1, 1],
-                                                    padding="same",
-                                                    data_format="channels_last",
-                                                    activation=tf.nn.relu)
-        self.evaluation_conv_flat = tf.reshape(
-                self.evaluation_conv, [-1, 2 * board_height * board_width])
-        self.evaluation_fc1 = tf.layers.dense(inputs=self.evaluation_conv_flat,
-                                              units=64, activation=tf.nn.relu)
-        # output the score of evaluation on current state
-        self.evaluation_fc2 = tf.layers.dense(inputs=self.evaluation_fc1,
-                                              units=1, activation=tf.nn.tanh)
-
-        # Define the Loss function
-        # 1. Label: the array containing if the game wins or not for each state
-        self.labels = tf.placeholder(tf.float32, shape=[None, 1])
-        # 2. Predictions: the array containing the evaluation score of each state
-        # which is self.evaluation_fc2
-        # 3-1. Value Loss function
-        self.value_loss = tf.losses.mean_squared_error(self.labels,
-                                                       self.evaluation_fc2)
-        # 3-2. Policy Loss function
-        self.mcts_probs = tf.placeholder(
-                tf.float32, shape=[None, board_height * board_width])
-        self.policy_loss = tf.negative(tf.reduce_mean(
-                tf.reduce_sum(tf.multiply(self.mcts_probs, self.action_fc), 1)))
-        # 3-3. L2 penalty (regularization)
-        l2_penalty_beta = 1e-4
-        vars = tf.trainable_variables()
-        l2_penalty = l2_penalty_beta * tf.add_n(
-            [tf.nn.l2_loss(v) for v in vars if 'bias' not in v.name.lower()])
-        # 3-4 Add up to be the Loss function
-        self.loss = self.value_loss + self.policy_loss + l2_penalty
-
-        # Define the optimizer we use for training
-        self.learning_rate = tf.placeholder(tf.float32)
-        self.optimizer = tf.train.AdamOptimizer(
-                learning_rate=self.learning_rate).minimize(self.loss)
-
-        # Make a session
-        self.session = tf.Session()
-
-        # calc policy entropy, for monitoring only
-        self.entropy = tf.negative(tf.reduce_mean(
-                tf.reduce_sum(tf.exp(self.action_fc) * self.action_fc, 1)))
-
-        # Initialize variables
-        init = tf.global_variables_initializer()
-        self.session.run(init)
-
-        # For saving and restoring
-        self.saver = tf.train.Saver()
+        # a graph and a session of its own, so that several nets live in
+        # one process without sharing variables
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            # Define the tensorflow neural network
+            # 1. Input:
+            self.input_states = tf.placeholder(
+                    tf.float32, shape=[None, 4, board_height, board_width])
+            self.input_state = tf.transpose(self.input_states, [0, 2, 3, 1])
+            # 2. Common Networks Layers
+            self.conv1 = tf.layers.conv2d(inputs=self.input_state,
+                                          filters=32, kernel_size=[3, 3],
+                                          padding="same", data_format="channels_last",
+                                          activation=tf.nn.relu)
+            self.conv2 = tf.layers.conv2d(inputs=self.conv1, filters=64,
+                                          kernel_size=[3, 3], padding="same",
+                                          data_format="channels_last",
+                                          activation=tf.nn.relu)
+            self.conv3 = tf.layers.conv2d(inputs=self.conv2, filters=128,
+                                          kernel_size=[3, 3], padding="same",
+                                          data_format="channels_last",
+                                          activation=tf.nn.relu)
+            if args.n_layer_resnet != -1:
+                for block in range(args.n_layer_resnet):
+                    if block == 0:
+                        setattr(self, "res_%i" % block, self.ResBlock(self.conv3, training=training))
+                    else:
+                        setattr(self, "res_%i" % block, self.ResBlock(getattr(self, "res_%i" % (block-1)), training=training))
+
+            # 3-1 Action Networks
+            if args.n_layer_resnet != -1:
+                self.action_conv = tf.layers.conv2d(inputs=getattr(self, "res_%i" % (args.n_layer_resnet-1)), filters=4,
+                                                kernel_size=[1, 1], padding="same",
+                                                data_format="channels_last",
+                                                activation=tf.nn.relu)
+            else:
+                self.action_conv = tf.layers.conv2d(inputs=self.conv3, filters=4,
+                                                kernel_size=[1, 1], padding="same",
+                                                data_format="channels_last",
+                                                activation=tf.nn.relu)
+            # Flatten the tensor
+            self.action_conv_flat = tf.reshape(
+                    self.action_conv, [-1, 4 * board_height * board_width])
+
+            # 3-2 Full connected layer, the output is the log probability of moves
+            # on each slot on the board
+            self.action_fc = tf.layers.dense(inputs=self.action_conv_flat,
+                                             units=board_height * board_width,
+                                             activation=tf.nn.log_softmax)
+
+            # 4 Evaluation Networks
+            if args.n_layer_resnet != -1:
+                self.evaluation_conv = tf.layers.conv2d(inputs=getattr(self, "res_%i" % (args.n_layer_resnet-1)), filters=2,
+                                                        kernel_size=[1, 1],
+                                                        padding="same",
+                                                        data_format="channels_last",
+                                                        activation=tf.nn.relu)
+            else:
+                self.evaluation_conv = tf.layers.conv2d(inputs=self.conv3, filters=2,
+                                                        kernel_size=[1, 1],
+                                                        padding="same",
+                                                        data_format="channels_last",
+                                                        activation=tf.nn.relu)
+            self.evaluation_conv_flat = tf.reshape(
+                    self.evaluation_conv, [-1, 2 * board_height * board_width])
+            self.evaluation_fc1 = tf.layers.dense(inputs=self.evaluation_conv_flat,
+                                                  units=64, activation=tf.nn.relu)
+            # output the score of evaluation on current state
+            self.evaluation_fc2 = tf.layers.dense(inputs=self.evaluation_fc1,
+                                                  units=1, activation=tf.nn.tanh)
+
+            # Define the Loss function
+            # 1. Label: the array containing if the game wins or not for each state
+            self.labels = tf.placeholder(tf.float32, shape=[None, 1])
+            # 2. Predictions: the array containing the evaluation score of each state
+            # which is self.evaluation_fc2
+            # 3-1. Value Loss function
+            self.value_loss = tf.losses.mean_squared_error(self.labels,
+                                                           self.evaluation_fc2)
+            # 3-2. Policy Loss function
+            self.mcts_probs = tf.placeholder(
+                    tf.float32, shape=[None, board_height * board_width])
+            self.policy_loss = tf.negative(tf.reduce_mean(
+                    tf.reduce_sum(tf.multiply(self.mcts_probs, self.action_fc), 1)))
+            # 3-3. L2 penalty (regularization)
+            l2_penalty_beta = 1e-4
+            vars = self.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
+            l2_penalty = l2_penalty_beta * tf.add_n(
+                [tf.nn.l2_loss(v) for v in vars if 'bias' not in v.name.lower()])
+            # 3-4 Add up to be the Loss function
+            self.loss = self.value_loss + self.policy_loss + l2_penalty
+
+            # Define the optimizer we use for training
+            self.learning_rate = tf.placeholder(tf.float32)
+            self.optimizer = tf.train.AdamOptimizer(
+                    learning_rate=self.learning_rate).minimize(self.loss)
+
+            # Make a session
+            self.session = tf.Session(graph=self.graph, config=session_config(
+                    intra_op_threads, inter_op_threads))
+
+            # calc policy entropy, for monitoring only
+            self.entropy = tf.negative(tf.reduce_mean(
+                    tf.reduce_sum(tf.exp(self.action_fc) * self.action_fc, 1)))
+
+            # Initialize variables
+            init = tf.global_variables_initializer()
+            self.session.run(init)
+
+            # For saving and restoring
+            self.saver = tf.train.Saver()
         if model_file is not None:
             self.restore_model(model_file)
 
@@ -166,16 +177,32 @@ class PolicyValueNet():
         action and the score of the board state
         """
         # the first two move is random
-        if len(board.moved) <= 2 or board._ef_for_eight <= 0:
-                legal_positions = board.availables
-        else:
-                legal_positions = board.eight_connected_region_to_moved
+        legal_positions = board.candidate_moves()
                 
-        current_state = np.ascontiguousarray(board.current_state().reshape(
-                -1, 4, self.board_width, self.board_height))
+        # the planes kept by the board are contiguous float32 already
+        current_state = board.current_state(share=True).reshape(
+                -1, 4, self.board_width, self.board_height)
         act_probs, value = self.policy_value(current_state)
-        act_probs = zip(legal_positions, act_probs[0][legal_positions])
-        return act_probs, value
+        act_probs = zip(legal_positions, act_probs[0][legal_positions.mask])
+        return act_probs, value[0][0].item()
+
+    def policy_value_fn_batch(self, boards):
+        """
+        input: a list of boards
+        output: a list of what policy_value_fn outputs for each board,
+        computed with one forward pass
+        """
+        # the first two move is random
+        legal_positions_batch = [board.candidate_moves() for board in boards]
+
+        state_batch = np.empty((len(boards), 4, self.board_height, self.board_width),
+                               dtype=np.float32)
+        for i, board in enumerate(boards):
+            board.current_state(out=state_batch[i])
+        act_probs, value = self.policy_value(state_batch.reshape(
+                -1, 4, self.board_width, self.board_height))
+        return [(zip(legal_positions, act_probs[i][legal_positions.mask]), value[i][0].item())
+                for i, legal_positions in enumerate(legal_positions_batch)]
 
     def train_step(self, state_batch, mcts_probs, winner_batch, lr):
         """perform a training step"""
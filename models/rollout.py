@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+A vectorized random-rollout engine for the pure MCTS: many random games are
+played out from the same board at once with array operations, instead of
+one stone and one game_end() at a time.
+
+A uniformly random move order is the same as a random permutation of the
+empty cells, so every rollout is given one: its stones are played in that
+order, alternating the players. Each n_in_row window is then complete, for
+the player owning all of its cells, at the largest move number of its cells,
+and the winner of a rollout is the owner of the window completed first.
+"""
+
+import numpy as np
+
+
+class RolloutEngine(object):
+    """Random rollouts on a width x height board with n_in_row to win.
+    The forbidden hands are not checked, see MCTS._evaluate_rollout.
+    """
+
+    # cache of windows, key: (width, height, n_in_row)
+    _windows_cache = {}
+
+    def __init__(self, width, height, n_in_row):
+        self.width = width
+        self.height = height
+        self.n_in_row = n_in_row
+        self.windows = RolloutEngine.get_windows(width, height, n_in_row)
+
+    @staticmethod
+    def get_windows(width, height, n_in_row):
+        """return an array of shape (n_windows, n_in_row) of the moves of
+        every n_in_row window of the board
+        """
+        key = (width, height, n_in_row)
+        if key not in RolloutEngine._windows_cache:
+            windows = []
+            for h in range(height):
+                for w in range(width):
+                    for dh, dw in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+                        end_h = h + (n_in_row - 1) * dh
+                        end_w = w + (n_in_row - 1) * dw
+                        if 0 <= end_h < height and 0 <= end_w < width:
+                            windows.append([(h + k * dh) * width + w + k * dw
+                                            for k in range(n_in_row)])
+            RolloutEngine._windows_cache[key] = np.array(
+                windows, dtype=np.intp).reshape(-1, n_in_row)
+        return RolloutEngine._windows_cache[key]
+
+    def rollout(self, board, n_rollout=1):
+        """play n_rollout random games from board, which must not be over
+        return: the winner of each game, -1 for a tie
+        """
+        player = board.get_current_player()
+        opponent = (
+            board.players[0] if player == board.players[1]
+            else board.players[1]
+        )
+        n_cells = self.width * self.height
+        if len(self.windows) == 0:
+            # n_in_row does not fit on the board, every game is a tie
+            return np.full(n_rollout, -1)
+        empties = np.flatnonzero(board.availables.mask)
+        owners = np.zeros((n_rollout, n_cells), dtype=np.int8)
+        if board.states:
+            owners[:, list(board.states.keys())] = list(board.states.values())
+        # the move number of each cell, -1 for the stones already placed
+        times = np.full((n_rollout, n_cells), -1, dtype=np.int32)
+        if len(empties):
+            orders = np.argsort(np.random.rand(n_rollout, len(empties)), axis=1)
+            times[:, empties] = orders
+            owners[:, empties] = np.where(orders % 2 == 0, player, opponent)
+
+        window_owners = owners[:, self.windows]
+        complete = ((window_owners == window_owners[:, :, :1]).all(axis=2) &
+                    (window_owners[:, :, 0] != 0))
+        # a window which is never complete is done after the last move
+        done = np.where(complete, times[:, self.windows].max(axis=2), n_cells)
+        first = np.argmin(done, axis=1)
+        games = np.arange(n_rollout)
+        return np.where(done[games, first] < n_cells,
+                        window_owners[games, first, 0], -1)
+
+    def evaluate(self, board, n_rollout=1):
+        """return the mean outcome of n_rollout random games from board,
+        +1 for a win of the current player, -1 for a loss and 0 for a tie
+        """
+        winners = self.rollout(board, n_rollout)
+        player = board.get_current_player()
+        return float(np.mean(np.where(winners == player, 1.0,
+                                      np.where(winners == -1, 0.0, -1.0))))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+A threat-space search for forced lines, used to short-circuit the MCTS in
+tactical positions: an immediate win, the block of the only winning move of
+the opponent, or a VCF (victory by continuous fours), where every move of
+the attacker threatens to win at once, so every move of the defender is
+forced, until the attacker has two winning moves or completes n in a row.
+
+It works on the bitboards of Board: a window of n_in_row cells holding
+n_in_row - 1 stones of a player and no stone of the other one is a four,
+and its empty cell wins; with n_in_row - 2 stones, a move on one of its two
+empty cells makes a four.
+The forbidden hands are not checked, so boards checking them are not
+searched.
+"""
+
+from game import Board
+
+
+def _cells(bits):
+    """the moves of the set bits"""
+    cells = []
+    while bits:
+        low = bits & -bits
+        cells.append(low.bit_length() - 1)
+        bits ^= low
+    return cells
+
+
+def _popcount(bits):
+    return bin(bits).count("1")
+
+
+class ThreatSearch(object):
+    """Search forced lines on boards of width x height with n_in_row to win.
+
+    max_depth: max number of attacker fours in a VCF
+    max_nodes: max number of attacker moves tried per search, so that
+        positions with many fours stay cheap
+    """
+
+    # cache of every window of the board as a bitmask, key: (width, height, n_in_row)
+    _windows_cache = {}
+
+    def __init__(self, width, height, n_in_row, max_depth=4, max_nodes=2000):
+        self.width = width
+        self.height = height
+        self.n_in_row = n_in_row
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        key = (width, height, n_in_row)
+        if key not in ThreatSearch._windows_cache:
+            win_masks = Board.get_win_masks(width, height, n_in_row)
+            ThreatSearch._windows_cache[key] = sorted(
+                set(mask for masks in win_masks for mask in masks))
+        self.windows = ThreatSearch._windows_cache[key]
+        self._n_nodes = 0
+
+    def winning_moves(self, own, other):
+        """return the set of empty moves completing n in a row for the player
+        of bitboard own, against the bitboard other
+        """
+        moves = set()
+        for window in self.windows:
+            if window & other:
+                continue
+            stones = window & own
+            if stones != window and _popcount(stones) == self.n_in_row - 1:
+                moves.add((window ^ stones).bit_length() - 1)
+        return moves
+
+    def four_moves(self, own, other):
+        """return the set of empty moves making a four for the player of
+        bitboard own, i.e. after which own has a winning move
+        """
+        moves = set()
+        for window in self.windows:
+            if window & other:
+                continue
+            if _popcount(window & own) == self.n_in_row - 2:
+                moves.update(_cells(window & ~own))
+        return moves
+
+    def solve(self, board):
+        """look for a forced line of the current player of board
+        return: (kind, line) or None, kind is 'win' for an immediate win,
+            'block' for the only move not losing at once, or 'vcf' for a
+            VCF, line is the forced moves, the first one being the move to
+            play, then alternately the forced reply and the next four
+        """
+        if board.if_check_forbidden_hands or not board.availables:
+            return None
+        player = board.get_current_player()
+        opponent = (
+            board.players[0] if player == board.players[1]
+            else board.players[1]
+        )
+        own = board.bitboards[player]
+        other = board.bitboards[opponent]
+        wins = self.winning_moves(own, other)
+        if wins:
+            return 'win', [min(wins)]
+        threats = self.winning_moves(other, own)
+        if len(threats) == 1:
+            return 'block', [threats.pop()]
+        if threats:
+            # the opponent wins next move whatever we play
+            return None
+        self._n_nodes = 0
+        line = self._vcf(own, other, self.max_depth)
+        if line is not None:
+            return 'vcf', line
+        return None
+
+    def _vcf(self, own, other, depth):
+        """return a VCF of own against other, own to move and other having no
+        winning move, as a list of moves, or None
+        """
+        if depth == 0:
+            return None
+        for move in sorted(self.four_moves(own, other)):
+            if self._n_nodes >= self.max_nodes:
+                return None
+            self._n_nodes += 1
+            attack = own | (1 << move)
+            wins = self.winning_moves(attack, other)
+            if len(wins) >= 2:
+                # a double four or an open four, both can't be blocked
+                return [move]
+            reply = wins.pop()
+            defence = other | (1 << reply)
+            if self.winning_moves(defence, attack):
+                # the forced reply makes a four, the attacker would have to
+                # block it with its next move, which ends this simple VCF
+                continue
+            line = self._vcf(attack, defence, depth - 1)
+            if line is not None:
+                return [move, reply] + line
+        return None
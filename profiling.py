@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and timers of the hot paths of self-play and training.
+
+They are disabled by default: every instrumented site first checks
+profiler.enabled, so a disabled profiler only costs that attribute lookup,
+and no clock is read.
+"""
+
+from __future__ import print_function
+import time
+from collections import defaultdict
+
+
+class Profiler(object):
+    """Accumulate the time spent in named phases and named counts, from
+    reset() to report().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.clock = time.perf_counter
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._start = self.clock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.times.clear()
+        self.counts.clear()
+        self._start = self.clock()
+
+    def add_time(self, name, seconds, n=1):
+        """add seconds spent in phase name, n times"""
+        self.times[name] += seconds
+        self.counts[name] += n
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def timer(self, name):
+        """a context manager timing its block as phase name, for the coarse
+        phases; the hot paths read the clock themselves
+        """
+        return _Timer(self, name)
+
+    def summary(self):
+        """return the wall time since the last reset, and a dict of the
+        rates and of the percentage of the wall time of every phase; nested
+        phases overlap, e.g. mcts_select is part of selfplay
+        """
+        elapsed = max(self.clock() - self._start, 1e-9)
+        counts = self.counts
+        stats = {}
+        for name, seconds in self.times.items():
+            stats["{}_pct".format(name)] = 100.0 * seconds / elapsed
+        stats["playouts_per_sec"] = counts["playouts"] / elapsed
+        stats["nn_calls_per_sec"] = counts["policy_value_fn"] / elapsed
+        if counts["policy_value_fn"]:
+            stats["mean_batch_size"] = 1.0 * counts["nn_states"] / counts["policy_value_fn"]
+        stats["selfplay_samples_per_sec"] = counts["selfplay_samples"] / elapsed
+        stats["train_samples_per_sec"] = counts["train_samples"] / elapsed
+        return elapsed, stats
+
+    def report(self, tb_writer, step_index):
+        """print the summary, add it to tensorboard and reset"""
+        elapsed, stats = self.summary()
+        print("profile of the last {:.1f}s: {}".format(elapsed, ", ".join(
+            "{}:{:.1f}".format(key, value) for key, value in sorted(stats.items()))))
+        for key, value in stats.items():
+            tb_writer.add_scalar('profile_{}'.format(key), value, step_index)
+        self.reset()
+
+
+class _Timer(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self._start = self.profiler.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler.enabled:
+            self.profiler.add_time(self.name, self.profiler.clock() - self._start)
+        return False
+
+
+# the profiler of this process, enabled by train.py --profile
+profiler = Profiler()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Replay memory of the self-play samples, kept in contiguous preallocated
+arrays used as a ring buffer: the binary state planes are bit-packed, the
+MCTS probabilities stored as float16 and the game results as int8.
+"""
+
+import numpy as np
+
+
+def pack_states(states):
+    """bit-pack binary states of shape (N, n_planes, H, W) into uint8 arrays
+    of shape (N, n_planes, ceil(H * W / 8))
+    """
+    return np.packbits(states.reshape(len(states), states.shape[1], -1) > 0, axis=-1)
+
+
+def unpack_states(packed, board_height, board_width):
+    """the inverse of pack_states, as float32"""
+    states = np.unpackbits(packed, axis=-1)[..., :board_height * board_width]
+    return states.reshape(
+        (len(packed), packed.shape[1], board_height, board_width)).astype(np.float32)
+
+
+class ReplayBuffer(object):
+    """A fixed-size buffer of (state, mcts_prob, winner_z) samples, the
+    oldest samples are overwritten first, like a deque with maxlen.
+    """
+
+    def __init__(self, capacity, board_height, board_width, n_planes=4,
+                 probs_dtype=np.float16):
+        self.capacity = capacity
+        self.board_height = board_height
+        self.board_width = board_width
+        self.n_planes = n_planes
+        n_cells = board_height * board_width
+        self.states = np.zeros((capacity, n_planes, (n_cells + 7) // 8), dtype=np.uint8)
+        self.mcts_probs = np.zeros((capacity, n_cells), dtype=probs_dtype)
+        self.winners = np.zeros(capacity, dtype=np.int8)
+        self._next = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, play_data):
+        """add samples
+        play_data: [(state, mcts_prob, winner_z), ..., ...]
+        """
+        play_data = list(play_data)
+        if not play_data:
+            return
+        states, mcts_probs, winners = zip(*play_data)
+        self.extend_arrays(np.array(states), np.array(mcts_probs), np.array(winners))
+
+    def extend_arrays(self, states, mcts_probs, winners):
+        """add samples given as arrays of shape (N, n_planes, H, W),
+        (N, H * W) and (N,)
+        """
+        n = len(states)
+        if n > self.capacity:
+            # only the newest samples would be kept anyway
+            states, mcts_probs, winners = states[-self.capacity:], mcts_probs[-self.capacity:], winners[-self.capacity:]
+            n = self.capacity
+        packed = pack_states(states)
+        index = (self._next + np.arange(n)) % self.capacity
+        self.states[index] = packed
+        self.mcts_probs[index] = mcts_probs
+        self.winners[index] = winners
+        self._next = (self._next + n) % self.capacity
+        self._size = min(self._size + n, self.capacity)
+
+    def get_arrays(self, index):
+        """return the samples at index as ready-to-feed float32 arrays of
+        states, mcts_probs and winners
+        """
+        return (unpack_states(self.states[index], self.board_height, self.board_width),
+                self.mcts_probs[index].astype(np.float32),
+                self.winners[index].astype(np.float32))
+
+    def sample(self, batch_size):
+        """sample a mini-batch without replacement, like random.sample"""
+        index = np.random.choice(self._size, batch_size, replace=False)
+        return self.get_arrays(index)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel self-play: a pool of worker processes which keep playing self-play
+games with the latest published weights and stream the (state, mcts_probs, z)
+samples back to the trainer over a queue.
+"""
+
+from __future__ import print_function
+import importlib
+import multiprocessing
+import os
+import glob
+import queue
+from game import Board, Game
+from models.mcts_alphaZero import MCTSPlayer
+from models.inference_server import InferenceServer
+
+# model_type: (module, class), imported lazily in each process
+MODEL_MODULES = {
+"pytorch": ("models.policy_value_net_pytorch", "PolicyValueNet"),
+"pytorch2": ("models.policy_value_net_pytorch2", "PolicyValueNet"),
+"tensorflow": ("models.policy_value_net_tensorflow", "PolicyValueNet"),
+"tensorflow2": ("models.policy_value_net_tensorflow2", "PolicyValueNet"),
+"numpy": ("models.policy_value_net_numpy", "PolicyValueNetNumpy"),
+}
+
+
+def load_policy_value_net(args, model_file=None, inference_only=False,
+                          intra_op_threads=0, inter_op_threads=0):
+    """build the policy-value net of args.model_type for playing,
+    restoring its weights from model_file if given; with inference_only, a
+    tensorflow net only loads a frozen graph of its heads, see
+    PolicyValueNet of policy_value_net_tensorflow; the threads are those of
+    the session of a tensorflow net, 0 for the defaults
+    """
+    module_name, class_name = MODEL_MODULES[args.model_type]
+    model_class = getattr(importlib.import_module(module_name), class_name)
+    if args.model_type == "tensorflow":
+        return model_class(args, args.board_width, args.board_height,
+                           model_file=model_file, inference_only=inference_only,
+                           use_xla=inference_only and args.use_xla,
+                           intra_op_threads=intra_op_threads,
+                           inter_op_threads=inter_op_threads)
+    if args.model_type == "tensorflow2":
+        return model_class(args, args.board_width, args.board_height,
+                           model_file=model_file,
+                           intra_op_threads=intra_op_threads,
+                           inter_op_threads=inter_op_threads)
+    return model_class(args, args.board_width, args.board_height,
+                       model_file=model_file)
+
+
+def get_weights_path(output_dir, version):
+    return os.path.join(output_dir, "selfplay", "selfplay_policy_{}.model".format(version))
+
+
+def _selfplay_worker(worker_id, args, version, loaded_versions, sample_queue, stop_event,
+                     inference_client=None):
+    """play self-play games until stop_event is set, reloading the weights
+    whenever a new version is published, or evaluating the boards with
+    inference_client if given; loaded_versions[worker_id] is the version
+    the worker is loading or playing, which is kept on disk until then
+    """
+    board = Board(width=args.board_width,
+                  height=args.board_height,
+                  n_in_row=args.n_in_row,
+                  ef_for_eight=args.ef_for_eight,
+                  if_check_forbidden_hands=args.if_check_forbidden_hands)
+    game = Game(board)
+    policy_value_net = None
+    loaded_version = 0
+    if inference_client is not None:
+        mcts_player = MCTSPlayer(inference_client.policy_value_fn,
+                                 c_puct=args.c_puct,
+                                 n_playout=args.n_playout,
+                                 is_selfplay=1,
+                                 ef_for_eight=args.ef_for_eight,
+                                 n_batch=args.mcts_batch_size,
+                                 policy_value_batch_function=inference_client.policy_value_fn_batch,
+                                 cache_size=args.mcts_cache_size,
+                                 prune_radius=args.prune_radius,
+                                 prune_top_k=args.prune_top_k,
+                                 solver_depth=args.solver_depth,
+                                 solver_in_tree=args.solver_in_tree)
+    while not stop_event.is_set():
+        if inference_client is None and version.value != loaded_version:
+            loaded_version = version.value
+            loaded_versions[worker_id] = loaded_version
+            weights_path = get_weights_path(args.output_dir, loaded_version)
+            if policy_value_net is not None and hasattr(policy_value_net, "restore_model"):
+                policy_value_net.restore_model(weights_path)
+            else:
+                policy_value_net = load_policy_value_net(args, weights_path, inference_only=True)
+            mcts_player = MCTSPlayer(policy_value_net.policy_value_fn,
+                                     c_puct=args.c_puct,
+                                     n_playout=args.n_playout,
+                                     is_selfplay=1,
+                                     ef_for_eight=args.ef_for_eight,
+                                     n_batch=args.mcts_batch_size,
+                                     policy_value_batch_function=policy_value_net.policy_value_fn_batch,
+                                     cache_size=args.mcts_cache_size,
+                                     prune_radius=args.prune_radius,
+                                     prune_top_k=args.prune_top_k,
+                                     solver_depth=args.solver_depth,
+                                     solver_in_tree=args.solver_in_tree)
+        if args.enable_random_logic:
+            winner, play_data = game.start_self_play_random(mcts_player, temp=args.temp)
+        else:
+            winner, play_data = game.start_self_play(mcts_player, temp=args.temp)
+        sample_queue.put((worker_id, loaded_version, list(play_data)))
+
+
+class SelfPlayWorkerPool(object):
+    """K self-play worker processes, each with its own MCTSPlayer and a copy
+    of the policy-value net. The trainer publishes new weights with publish()
+    and gets finished games with collect().
+    With use_inference_server, the workers hold no net: their boards are
+    evaluated in batches by an InferenceServer thread of this process, which
+    uses policy_value_net itself, so they always play the latest weights.
+    """
+
+    def __init__(self, args, policy_value_net, n_workers, use_inference_server=False):
+        self.args = args
+        self.policy_value_net = policy_value_net
+        self.n_workers = n_workers
+        # processes are spawned, since the deep learning frameworks
+        # are not fork-safe once a session exists
+        self._context = multiprocessing.get_context("spawn")
+        self._version = self._context.Value("i", 0)
+        # the version each worker is loading or playing, and the oldest
+        # version still on disk
+        self._loaded_versions = self._context.Array("i", n_workers)
+        self._oldest_version = 1
+        self._queue = self._context.Queue()
+        self._stop_event = self._context.Event()
+        self._workers = []
+        if use_inference_server:
+            self.inference_server = InferenceServer(policy_value_net,
+                                                    args.board_width,
+                                                    args.board_height,
+                                                    max_batch_size=args.inference_max_batch_size,
+                                                    max_wait=args.inference_max_wait,
+                                                    context=self._context)
+        else:
+            self.inference_server = None
+
+    def publish(self):
+        """save the current weights as a new version for the workers,
+        removing the versions older than the oldest one a worker is loading
+        or playing; a worker only acknowledges a version after reading it
+        from self._version, so it never loads a version older than its
+        acknowledged one
+        """
+        if self.inference_server is not None:
+            return
+        version = self._version.value + 1
+        weights_path = get_weights_path(self.args.output_dir, version)
+        if not os.path.exists(os.path.dirname(weights_path)):
+            os.makedirs(os.path.dirname(weights_path))
+        self.policy_value_net.save_model(weights_path)
+        self._version.value = version
+        if not self._workers:
+            return
+        in_use = min(self._loaded_versions[:])
+        while self._oldest_version < min(in_use, version):
+            for path in glob.glob(get_weights_path(self.args.output_dir, self._oldest_version) + "*"):
+                os.remove(path)
+            self._oldest_version += 1
+
+    def start(self):
+        if self.inference_server is not None:
+            self.inference_server.start()
+        else:
+            self.publish()
+        for worker_id in range(self.n_workers):
+            if self.inference_server is not None:
+                inference_client = self.inference_server.make_client()
+            else:
+                inference_client = None
+            worker = self._context.Process(target=_selfplay_worker,
+                                           args=(worker_id, self.args, self._version,
+                                                 self._loaded_versions,
+                                                 self._queue, self._stop_event,
+                                                 inference_client))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def collect(self, n_games=1):
+        """block until n_games games are finished, then also take whatever
+        else is already queued
+        return: a list of play_data, one list of (state, mcts_prob, winner_z)
+            for each game
+        """
+        games = []
+        while len(games) < n_games:
+            worker_id, version, play_data = self._queue.get()
+            games.append(play_data)
+        while True:
+            try:
+                worker_id, version, play_data = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            games.append(play_data)
+        return games
+
+    def stop(self):
+        self._stop_event.set()
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+        if self.inference_server is not None:
+            self.inference_server.stop()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk store of self-play samples, so that a restarted training
+keeps its data and other runs can train on it offline.
+
+The samples are appended to shards of .npy files, encoded like the replay
+buffer (bit-packed states, float16 probabilities, int8 results), and listed
+in index.json. The shards are memory-mapped for sampling, so the dataset
+never has to fit in RAM.
+"""
+
+import json
+import os
+import numpy as np
+from replay_buffer import pack_states, unpack_states
+
+
+class SelfPlayDataset(object):
+    """An append-only dataset of (state, mcts_prob, winner_z) samples in
+    data_dir. Appended samples are written out as a new shard every
+    shard_size samples, or on flush().
+    """
+
+    def __init__(self, data_dir, board_height, board_width, n_planes=4,
+                 shard_size=10000):
+        self.data_dir = data_dir
+        self.board_height = board_height
+        self.board_width = board_width
+        self.n_planes = n_planes
+        self.shard_size = shard_size
+        self._index_path = os.path.join(data_dir, "index.json")
+        if os.path.isfile(self._index_path):
+            with open(self._index_path, 'r', encoding='utf8') as fin:
+                self.index = json.load(fin)
+            if (self.index["board_height"], self.index["board_width"],
+                    self.index["n_planes"]) != (board_height, board_width, n_planes):
+                raise Exception('dataset in {} is for a {}x{} board with {} planes'.format(
+                    data_dir, self.index["board_height"], self.index["board_width"],
+                    self.index["n_planes"]))
+        else:
+            if not os.path.exists(data_dir):
+                os.makedirs(data_dir)
+            self.index = {"board_height": board_height,
+                          "board_width": board_width,
+                          "n_planes": n_planes,
+                          "shards": []}
+        self._pending = []
+        self._n_pending = 0
+        self._shards = {}
+
+    def __len__(self):
+        """num of samples on disk, not counting the pending ones"""
+        return sum(shard["n_samples"] for shard in self.index["shards"])
+
+    def append(self, play_data):
+        """add samples
+        play_data: [(state, mcts_prob, winner_z), ..., ...]
+        """
+        play_data = list(play_data)
+        if not play_data:
+            return
+        states, mcts_probs, winners = zip(*play_data)
+        self._pending.append((pack_states(np.array(states)),
+                              np.array(mcts_probs, dtype=np.float16),
+                              np.array(winners, dtype=np.int8)))
+        self._n_pending += len(play_data)
+        if self._n_pending >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """write the pending samples as a new shard"""
+        if not self._pending:
+            return
+        states, mcts_probs, winners = [np.concatenate(arrays) for arrays in zip(*self._pending)]
+        name = "shard_{:06d}".format(len(self.index["shards"]))
+        np.save(os.path.join(self.data_dir, name + "_states.npy"), states)
+        np.save(os.path.join(self.data_dir, name + "_probs.npy"), mcts_probs)
+        np.save(os.path.join(self.data_dir, name + "_winners.npy"), winners)
+        self.index["shards"].append({"name": name, "n_samples": len(states)})
+        # replace the index at once, so it never lists a missing shard
+        with open(self._index_path + ".tmp", 'w', encoding='utf8') as fout:
+            fout.write(json.dumps(self.index))
+        os.replace(self._index_path + ".tmp", self._index_path)
+        self._pending = []
+        self._n_pending = 0
+
+    def _open_shard(self, i):
+        if i not in self._shards:
+            path = os.path.join(self.data_dir, self.index["shards"][i]["name"])
+            self._shards[i] = tuple(np.load(path + suffix, mmap_mode='r')
+                                    for suffix in ["_states.npy", "_probs.npy", "_winners.npy"])
+        return self._shards[i]
+
+    def get_arrays(self, index):
+        """return the samples at the global positions index, which count
+        from the oldest sample on disk, as ready-to-feed float32 arrays of
+        states, mcts_probs and winners
+        """
+        index = np.asarray(index)
+        ends = np.cumsum([shard["n_samples"] for shard in self.index["shards"]])
+        shard_of = np.searchsorted(ends, index, side='right')
+        n_cells = self.board_height * self.board_width
+        packed = np.empty((len(index), self.n_planes, (n_cells + 7) // 8), dtype=np.uint8)
+        mcts_probs = np.empty((len(index), n_cells), dtype=np.float32)
+        winners = np.empty(len(index), dtype=np.float32)
+        for i in np.unique(shard_of):
+            rows = np.flatnonzero(shard_of == i)
+            offsets = index[rows] - (ends[i - 1] if i > 0 else 0)
+            states_i, probs_i, winners_i = self._open_shard(i)
+            packed[rows] = states_i[offsets]
+            mcts_probs[rows] = probs_i[offsets]
+            winners[rows] = winners_i[offsets]
+        return (unpack_states(packed, self.board_height, self.board_width),
+                mcts_probs, winners)
+
+    def sample(self, batch_size):
+        """sample a mini-batch uniformly from every sample on disk, with
+        replacement, which avoids a permutation of millions of positions
+        """
+        index = np.random.randint(len(self), size=batch_size)
+        return self.get_arrays(index)
+
+    def load_latest(self, n):
+        """return the newest n samples on disk, oldest first"""
+        size = len(self)
+        return self.get_arrays(np.arange(max(size - n, 0), size))
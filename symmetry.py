@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Dihedral symmetries (4 rotations, each with and without a flip) of the
+self-play samples, applied with batched array operations.
+
+The planes of a state are stored upside down with respect to the move
+indices of mcts_probs (see Board.current_state), so mcts_probs is flipped
+vertically before and after being transformed like the planes.
+"""
+
+import numpy as np
+
+
+def _transform(states, mcts_probs, board_height, board_width, rot, flip):
+    """rotate a batch counterclockwise by rot quarter turns, then flip it
+    horizontally if flip
+    states: array of shape (N, 4, board_height, board_width)
+    mcts_probs: array of shape (N, board_height * board_width)
+    """
+    equi_states = np.rot90(states, rot, axes=(2, 3))
+    equi_probs = np.rot90(
+        mcts_probs.reshape(-1, board_height, board_width)[:, ::-1, :],
+        rot, axes=(1, 2))
+    if flip:
+        equi_states = equi_states[:, :, :, ::-1]
+        equi_probs = equi_probs[:, :, ::-1]
+    return equi_states, equi_probs[:, ::-1, :].reshape(len(mcts_probs), -1)
+
+
+def get_equi_data(play_data, board_height, board_width):
+    """augment the data set by rotation and flipping
+    play_data: [(state, mcts_prob, winner_z), ..., ...]
+    return: the 8 symmetries of each sample, in the order of the samples
+    """
+    play_data = list(play_data)
+    if not play_data:
+        return []
+    states, mcts_probs, winners = zip(*play_data)
+    states = np.array(states)
+    mcts_probs = np.array(mcts_probs)
+    n = len(states)
+    equi_states = np.empty((n, 8) + states.shape[1:], dtype=states.dtype)
+    equi_probs = np.empty((n, 8) + mcts_probs.shape[1:], dtype=mcts_probs.dtype)
+    for i in [1, 2, 3, 4]:
+        for flip in [0, 1]:
+            t = 2 * (i - 1) + flip
+            equi_states[:, t], equi_probs[:, t] = _transform(
+                states, mcts_probs, board_height, board_width, i, flip)
+    equi_states = equi_states.reshape((n * 8,) + states.shape[1:])
+    equi_probs = equi_probs.reshape((n * 8,) + mcts_probs.shape[1:])
+    equi_winners = np.repeat(winners, 8)
+    return list(zip(equi_states, equi_probs, equi_winners))
+
+
+def random_symmetry(states, mcts_probs, board_height, board_width):
+    """apply one random symmetry to each sample of a mini-batch, so that
+    only the original samples have to be stored in the buffer
+    """
+    states = np.asarray(states)
+    mcts_probs = np.asarray(mcts_probs)
+    equi_states = np.empty_like(states)
+    equi_probs = np.empty_like(mcts_probs)
+    symmetries = np.random.randint(8, size=len(states))
+    for t in range(8):
+        index = np.flatnonzero(symmetries == t)
+        if len(index):
+            equi_states[index], equi_probs[index] = _transform(
+                states[index], mcts_probs[index], board_height, board_width,
+                t // 2, t % 2)
+    return equi_states, equi_probs
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the engine against simple reference implementations, run with
+
+python -m pytest -q tests
+"""
+
+import os
+import random
+import numpy as np
+import pytest
+from arena import fit_elo
+from bench import random_positions
+from game import Board, MoveSet
+from models.policy_value_net_numpy import (PolicyValueNetNumpy, load_net_params, params_from_pytorch,
+                                           params_from_tensorflow, quantize_params, save_net_params)
+from models.threat_search import ThreatSearch
+from replay_buffer import ReplayBuffer
+from selfplay_dataset import SelfPlayDataset
+from symmetry import get_equi_data, random_symmetry
+
+
+def reference_winner(board):
+    """the winner of the original full-board scan, or -1"""
+    width, height, n = board.width, board.height, board.n_in_row
+    states = board.states
+    for m, player in states.items():
+        h, w = m // width, m % width
+        for dh, dw in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+            if not (0 <= h + (n - 1) * dh < height and 0 <= w + (n - 1) * dw < width):
+                continue
+            if all(states.get(m + i * (dh * width + dw), -1) == player for i in range(n)):
+                return player
+    return -1
+
+
+def reference_state(board):
+    """the planes of the original current_state, built from board.states"""
+    square_state = np.zeros((4, board.height, board.width))
+    for move, player in board.states.items():
+        plane = 0 if player == board.current_player else 1
+        square_state[plane][move // board.width, move % board.width] = 1.0
+    if board.states:
+        square_state[2][board.last_move // board.width, board.last_move % board.width] = 1.0
+    if len(board.states) % 2 == 0:
+        square_state[3][:, :] = 1.0
+    return square_state[:, ::-1, :]
+
+
+def random_games(width, height, n_in_row, n_games, seed=0):
+    """yield the boards of seeded random games after every move"""
+    rng = random.Random(seed)
+    for _ in range(n_games):
+        board = Board(width=width, height=height, n_in_row=n_in_row)
+        board.init_board(rng.randint(0, 1))
+        while True:
+            board.do_move(rng.choice(board.availables.tolist()))
+            yield board
+            if board.game_end()[0]:
+                break
+
+
+def test_winner_matches_full_board_scan():
+    n_wins = 0
+    for width, height, n_in_row in [(6, 6, 4), (9, 9, 5), (8, 11, 5)]:
+        for board in random_games(width, height, n_in_row, 30):
+            win, winner = board.has_a_winner()
+            assert winner == reference_winner(board)
+            n_wins += win
+    assert n_wins > 0
+
+
+def test_current_state_matches_reference():
+    for width, height in [(6, 6), (7, 10)]:
+        for board in random_games(width, height, 4, 5):
+            state = board.current_state()
+            assert state.dtype == np.float32
+            assert np.array_equal(state, reference_state(board))
+            assert np.array_equal(board.current_state(share=True), state)
+
+
+def test_undo_move_restores_the_board():
+    rng = random.Random(1)
+    board = Board(width=9, height=9, n_in_row=5, ef_for_eight=1)
+    board.init_board(0)
+    snapshots = []
+    for _ in range(40):
+        snapshots.append((dict(board.states), dict(board.bitboards), board.availables.tolist(),
+                          board.eight_connected_region_to_moved.tolist(), board.zobrist_key(),
+                          board.current_player, board.last_move, board.current_state()))
+        board.do_move(rng.choice(board.availables.tolist()))
+    while snapshots:
+        board.undo_move()
+        (states, bitboards, availables, region, key,
+         current_player, last_move, state) = snapshots.pop()
+        assert board.states == states
+        assert board.bitboards == bitboards
+        assert board.availables.tolist() == availables
+        assert board.eight_connected_region_to_moved.tolist() == region
+        assert board.zobrist_key() == key
+        assert board.current_player == current_player
+        assert board.last_move == last_move
+        assert np.array_equal(board.current_state(), state)
+
+
+def test_clone_is_independent():
+    board = Board(width=6, height=6, n_in_row=4)
+    board.init_board(0)
+    board.do_move(14)
+    clone = board.clone()
+    clone.do_move(15)
+    assert 15 not in board.states and 15 in board.availables
+    assert np.array_equal(board.current_state(), reference_state(board))
+
+
+def test_move_set_matches_a_set():
+    rng = random.Random(2)
+    move_set = MoveSet(81, range(0, 81, 3))
+    reference = set(range(0, 81, 3))
+    for _ in range(2000):
+        move = rng.randrange(81)
+        if rng.random() < 0.5:
+            move_set.add(move)
+            reference.add(move)
+        else:
+            move_set.discard(move)
+            reference.discard(move)
+        assert len(move_set) == len(reference)
+        assert (move in move_set) == (move in reference)
+    assert list(move_set) == sorted(reference)
+    assert np.array_equal(np.flatnonzero(move_set.mask), sorted(reference))
+    copy = move_set.copy()
+    copy.add(next(m for m in range(81) if m not in reference))
+    assert list(move_set) == sorted(reference)
+
+
+def test_forbidden_hands_table_matches_patterns():
+    n_forbidden = 0
+    for size in [9, 15]:
+        for board in random_positions(size, size, 1500, seed=3):
+            forbidden = board.check_forbidden_hands()
+            assert forbidden == bool(board.check_forbidden_hands_by_patterns())
+            n_forbidden += forbidden
+    assert n_forbidden > 0
+
+
+def _wins_at_once(board):
+    """whether the player to move has a move completing n in a row"""
+    for move in board.availables.tolist():
+        board.do_move(move)
+        win = board.has_a_winner()[0]
+        board.undo_move()
+        if win:
+            return True
+    return False
+
+
+def _is_forced_win(board, line):
+    """whether playing line, the attacker to move, wins against every
+    defence: each reply off the line must allow a win at once
+    """
+    board.do_move(line[0])
+    try:
+        if board.has_a_winner()[0]:
+            return True
+        for reply in board.availables.tolist():
+            board.do_move(reply)
+            try:
+                if board.has_a_winner()[0]:
+                    return False
+                if len(line) > 1 and reply == line[1]:
+                    if not _is_forced_win(board, line[2:]):
+                        return False
+                elif not _wins_at_once(board):
+                    return False
+            finally:
+                board.undo_move()
+        return True
+    finally:
+        board.undo_move()
+
+
+def test_threat_search_lines_are_sound():
+    search = ThreatSearch(9, 9, 5)
+    kinds = set()
+    for board in random_positions(9, 9, 500, seed=4):
+        if board.game_end()[0]:
+            continue
+        solved = search.solve(board)
+        if solved is None:
+            continue
+        kind, line = solved
+        kinds.add(kind)
+        if kind == 'block':
+            # the opponent has exactly one winning move, which is blocked
+            board.do_move(line[0])
+            assert not _wins_at_once(board)
+            board.undo_move()
+        else:
+            assert _is_forced_win(board, line)
+    assert kinds == {'win', 'block', 'vcf'}
+
+
+def reference_equi_data(play_data, board_height, board_width):
+    """the original loop of TrainPipeline.get_equi_data"""
+    extend_data = []
+    for state, mcts_porb, winner in play_data:
+        for i in [1, 2, 3, 4]:
+            # rotate counterclockwise
+            equi_state = np.array([np.rot90(s, i) for s in state])
+            equi_mcts_prob = np.rot90(np.flipud(
+                mcts_porb.reshape(board_height, board_width)), i)
+            extend_data.append((equi_state,
+                                np.flipud(equi_mcts_prob).flatten(),
+                                winner))
+            # flip horizontally
+            equi_state = np.array([np.fliplr(s) for s in equi_state])
+            equi_mcts_prob = np.fliplr(equi_mcts_prob)
+            extend_data.append((equi_state,
+                                np.flipud(equi_mcts_prob).flatten(),
+                                winner))
+    return extend_data
+
+
+def _play_data(size, n_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    return [(board.current_state(), rng.dirichlet(np.ones(size * size)), rng.choice([-1.0, 1.0]))
+            for board in random_positions(size, size, n_samples, seed)]
+
+
+def test_equi_data_matches_the_original_loop():
+    for size in [6, 9]:
+        play_data = _play_data(size, 20)
+        equi_data = get_equi_data(play_data, size, size)
+        reference = reference_equi_data(play_data, size, size)
+        assert len(equi_data) == len(reference)
+        for (state, probs, winner), (ref_state, ref_probs, ref_winner) in zip(equi_data, reference):
+            assert np.array_equal(state, ref_state)
+            assert np.array_equal(probs, ref_probs)
+            assert winner == ref_winner
+
+
+def test_random_symmetry_is_one_of_the_eight():
+    np.random.seed(5)
+    play_data = _play_data(9, 30)
+    states, mcts_probs, winners = [np.array(x) for x in zip(*play_data)]
+    equi_states, equi_probs = random_symmetry(states, mcts_probs, 9, 9)
+    equi_data = get_equi_data(play_data, 9, 9)
+    for i in range(len(states)):
+        assert any(np.array_equal(equi_states[i], state) and np.array_equal(equi_probs[i], probs)
+                   for state, probs, winner in equi_data[8 * i:8 * i + 8])
+
+
+def _as_arrays(play_data):
+    states, mcts_probs, winners = zip(*play_data)
+    return (np.array(states, dtype=np.float32),
+            np.array(mcts_probs, dtype=np.float16).astype(np.float32),
+            np.array(winners, dtype=np.float32))
+
+
+def test_replay_buffer_round_trip():
+    play_data = _play_data(9, 50)
+    buffer = ReplayBuffer(32, 9, 9)
+    buffer.extend(play_data[:20])
+    buffer.extend(play_data[20:])
+    # a ring buffer keeps the newest samples, like a deque with maxlen
+    assert len(buffer) == 32
+    newest = play_data[-32:]
+    index = np.array([(50 - 32 + i) % 32 for i in range(32)])
+    for got, expected in zip(buffer.get_arrays(index), _as_arrays(newest)):
+        assert got.dtype == np.float32
+        assert np.array_equal(got, expected)
+    states, mcts_probs, winners = buffer.sample(8)
+    assert states.shape == (8, 4, 9, 9) and mcts_probs.shape == (8, 81)
+
+
+def test_selfplay_dataset_round_trip(tmp_path):
+    play_data = _play_data(9, 50)
+    dataset = SelfPlayDataset(str(tmp_path), 9, 9, shard_size=16)
+    for i in range(0, 50, 10):
+        dataset.append(play_data[i:i + 10])
+    dataset.flush()
+    assert len(dataset) == 50
+    # reopened from the index, the samples span several shards
+    dataset = SelfPlayDataset(str(tmp_path), 9, 9)
+    assert len(dataset.index["shards"]) > 1
+    for got, expected in zip(dataset.load_latest(50), _as_arrays(play_data)):
+        assert np.array_equal(got, expected)
+    index = np.array([49, 0, 17, 33])
+    for got, expected in zip(dataset.get_arrays(index), _as_arrays([play_data[i] for i in index])):
+        assert np.array_equal(got, expected)
+
+
+def test_fit_elo_recovers_the_ratings():
+    # 3 wins out of 4 is a difference of 400 * log10(3), about 191 Elo
+    ratings = fit_elo(2, [(0, 1, 1)] * 300 + [(0, 1, 0)] * 100, prior_draws=0.1, n_iter=500)
+    assert abs(ratings.mean()) < 1e-9
+    assert abs(ratings[0] - ratings[1] - 400 * np.log10(3)) < 5
+    # games sampled from known ratings
+    rng = np.random.RandomState(6)
+    true_ratings = np.array([-200.0, 0.0, 150.0, 300.0])
+    results = []
+    for _ in range(4000):
+        i, j = rng.choice(4, 2, replace=False)
+        expected = 1 / (1 + 10 ** ((true_ratings[j] - true_ratings[i]) / 400))
+        results.append((i, j, float(rng.rand() < expected)))
+    ratings = fit_elo(4, results, n_iter=500)
+    assert np.all(np.abs(ratings - (true_ratings - true_ratings.mean())) < 40)
+
+
+def _conv_nchw(x, W, b=None):
+    """a "same" cross-correlation of x (N, C, H, W) with W (F, C, kh, kw)"""
+    kh, kw = W.shape[2:]
+    ph, pw = kh // 2, kw // 2
+    x_padded = np.pad(x, ((0, 0), (0, 0), (ph, ph), (pw, pw)))
+    h, w = x.shape[2:]
+    out = np.zeros((x.shape[0], W.shape[0], h, w))
+    for i in range(kh):
+        for j in range(kw):
+            out += np.einsum('nchw,fc->nfhw', x_padded[:, :, i:i + h, j:j + w], W[:, :, i, j])
+    return out if b is None else out + b.reshape(1, -1, 1, 1)
+
+
+def _conv_nhwc(x, kernel, b):
+    """a "same" cross-correlation of x (N, H, W, C) with kernel (kh, kw, C, F)"""
+    kh, kw = kernel.shape[:2]
+    ph, pw = kh // 2, kw // 2
+    x_padded = np.pad(x, ((0, 0), (ph, ph), (pw, pw), (0, 0)))
+    h, w = x.shape[1:3]
+    out = np.zeros(x.shape[:3] + (kernel.shape[3],))
+    for i in range(kh):
+        for j in range(kw):
+            out += np.einsum('nhwc,cf->nhwf', x_padded[:, i:i + h, j:j + w], kernel[i, j])
+    return out + b
+
+
+def _relu(x):
+    return np.maximum(x, 0)
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def _random_tensorflow_variables(rng, size, n_blocks=1):
+    """the variables of policy_value_net_tensorflow2 with n_blocks blocks"""
+    n_cells = size * size
+    convs = [(3, 4, 32), (3, 32, 64), (3, 64, 128)] + [(3, 128, 128)] * n_blocks + [(1, 128, 4), (1, 128, 2)]
+    dense = [(4 * n_cells, n_cells), (2 * n_cells, 64), (64, 1)]
+    variables = {}
+    for i, (k, c, f) in enumerate(convs):
+        name = "conv2d" if i == 0 else "conv2d_{}".format(i)
+        variables[name + "/kernel"] = rng.normal(0, 0.1, (k, k, c, f))
+        variables[name + "/bias"] = rng.normal(0, 0.1, f)
+        variables[name + "/kernel/Adam"] = np.zeros((k, k, c, f))
+    for i, (n_in, n_out) in enumerate(dense):
+        name = "dense" if i == 0 else "dense_{}".format(i)
+        variables[name + "/kernel"] = rng.normal(0, 0.1, (n_in, n_out))
+        variables[name + "/bias"] = rng.normal(0, 0.1, n_out)
+    return variables
+
+
+def _tensorflow_forward(variables, states, n_blocks=1):
+    def conv(i, x):
+        name = "conv2d" if i == 0 else "conv2d_{}".format(i)
+        return _relu(_conv_nhwc(x, variables[name + "/kernel"], variables[name + "/bias"]))
+
+    def dense(i, x):
+        name = "dense" if i == 0 else "dense_{}".format(i)
+        return x.dot(variables[name + "/kernel"]) + variables[name + "/bias"]
+
+    x = states.transpose(0, 2, 3, 1)
+    for i in range(3 + n_blocks):
+        x = conv(i, x)
+    x_act = conv(3 + n_blocks, x).reshape(len(states), -1)
+    x_val = conv(4 + n_blocks, x).reshape(len(states), -1)
+    return _softmax(dense(0, x_act)), np.tanh(dense(2, _relu(dense(1, x_val))))
+
+
+def _random_pytorch_state_dict(rng, size, n_blocks=1):
+    """the state dict of policy_value_net_pytorch2 with n_blocks blocks"""
+    n_cells = size * size
+    state_dict = {}
+    for name, (f, c, k) in [("conv1", (32, 4, 3)), ("conv2", (64, 32, 3)), ("conv3", (128, 64, 3)),
+                            ("act_conv1", (4, 128, 1)), ("val_conv1", (2, 128, 1))]:
+        state_dict[name + ".weight"] = rng.normal(0, 0.1, (f, c, k, k))
+        state_dict[name + ".bias"] = rng.normal(0, 0.1, f)
+    for name, (n_out, n_in) in [("act_fc1", (n_cells, 4 * n_cells)), ("val_fc1", (64, 2 * n_cells)),
+                                ("val_fc2", (1, 64))]:
+        state_dict[name + ".weight"] = rng.normal(0, 0.1, (n_out, n_in))
+        state_dict[name + ".bias"] = rng.normal(0, 0.1, n_out)
+    for block in range(n_blocks):
+        prefix = "res_{}.".format(block)
+        for i in [1, 2]:
+            state_dict[prefix + "conv{}.weight".format(i)] = rng.normal(0, 0.05, (128, 128, 3, 3))
+            state_dict[prefix + "bn{}.weight".format(i)] = rng.uniform(0.5, 1.5, 128)
+            state_dict[prefix + "bn{}.bias".format(i)] = rng.normal(0, 0.1, 128)
+            state_dict[prefix + "bn{}.running_mean".format(i)] = rng.normal(0, 0.1, 128)
+            state_dict[prefix + "bn{}.running_var".format(i)] = rng.uniform(0.5, 1.5, 128)
+            state_dict[prefix + "bn{}.num_batches_tracked".format(i)] = np.array(10)
+    return state_dict
+
+
+def _pytorch_forward(state_dict, states, n_blocks=1, bn_eps=1e-5):
+    def conv(name, x):
+        return _conv_nchw(x, state_dict[name + ".weight"], state_dict.get(name + ".bias"))
+
+    def bn(name, x):
+        def p(key):
+            return state_dict[name + "." + key].reshape(1, -1, 1, 1)
+        return (x - p("running_mean")) / np.sqrt(p("running_var") + bn_eps) * p("weight") + p("bias")
+
+    def linear(name, x):
+        return x.dot(state_dict[name + ".weight"].T) + state_dict[name + ".bias"]
+
+    x = states
+    for name in ["conv1", "conv2", "conv3"]:
+        x = _relu(conv(name, x))
+    for block in range(n_blocks):
+        prefix = "res_{}.".format(block)
+        out = _relu(bn(prefix + "bn1", conv(prefix + "conv1", x)))
+        x = _relu(bn(prefix + "bn2", conv(prefix + "conv2", out)) + x)
+    x_act = _relu(conv("act_conv1", x)).reshape(len(states), -1)
+    x_val = _relu(conv("val_conv1", x)).reshape(len(states), -1)
+    return (_softmax(linear("act_fc1", x_act)),
+            np.tanh(linear("val_fc2", _relu(linear("val_fc1", x_val)))))
+
+
+def test_numpy_net_matches_the_exported_checkpoints():
+    rng = np.random.RandomState(7)
+    size = 6
+    states = np.array([board.current_state() for board in random_positions(size, size, 16)])
+    variables = _random_tensorflow_variables(rng, size)
+    state_dict = _random_pytorch_state_dict(rng, size)
+    for net_params, (act_probs, value) in [
+            (params_from_tensorflow(variables, size, size), _tensorflow_forward(variables, states)),
+            (params_from_pytorch(state_dict), _pytorch_forward(state_dict, states))]:
+        net = PolicyValueNetNumpy(None, size, size, net_params)
+        numpy_act_probs, numpy_value = net.policy_value(states)
+        assert np.abs(numpy_act_probs - act_probs).max() < 1e-5
+        assert np.abs(numpy_value - value).max() < 1e-5
+
+
+def test_quantized_numpy_net_stays_close(tmp_path):
+    rng = np.random.RandomState(8)
+    size = 6
+    states = np.array([board.current_state() for board in random_positions(size, size, 32)])
+    net_params = params_from_pytorch(_random_pytorch_state_dict(rng, size))
+    net = PolicyValueNetNumpy(None, size, size, net_params)
+    act_probs, value = net.policy_value(states)
+    float32_file = str(tmp_path / "float32.model")
+    save_net_params(net_params, float32_file)
+    for quantization, max_kl, ratio in [("int8", 1e-3, 0.3), ("float16", 1e-5, 0.55)]:
+        quantized = quantize_params(net_params, quantization)
+        model_file = str(tmp_path / (quantization + ".model"))
+        save_net_params(quantized, model_file)
+        assert os.path.getsize(model_file) < ratio * os.path.getsize(float32_file)
+        quantized_net = PolicyValueNetNumpy(None, size, size, model_file=model_file)
+        assert quantized_net.quantization == quantization
+        quantized_act_probs, quantized_value = quantized_net.policy_value(states)
+        kl = np.sum(act_probs * (np.log(act_probs) - np.log(quantized_act_probs)), axis=1)
+        assert kl.max() < max_kl
+        assert np.abs(quantized_value - value).max() < 0.05
+        with pytest.raises(Exception):
+            quantize_params(load_net_params(model_file), quantization)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the tensorflow nets, skipped without tensorflow 1.x, run with
+
+python -m pytest -q tests
+"""
+
+import argparse
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+if not hasattr(tf, "placeholder"):
+    pytest.skip("the tensorflow nets need the tensorflow 1.x api of requirements.txt",
+                allow_module_level=True)
+
+from bench import random_positions
+from models.policy_value_net_tensorflow import PolicyValueNet
+
+
+def _states(size, n):
+    return np.array([board.current_state() for board in random_positions(size, size, n)])
+
+
+def test_frozen_graph_matches_the_trainable_net(tmp_path):
+    args = argparse.Namespace(n_layer_resnet=-1)
+    size = 6
+    states = _states(size, 16)
+    net = PolicyValueNet(args, size, size)
+    model_file = str(tmp_path / "policy.model")
+    net.save_model(model_file)
+    act_probs, value = net.policy_value(states)
+
+    frozen = PolicyValueNet(args, size, size, model_file=model_file, inference_only=True)
+    frozen_file = str(tmp_path / "policy.pb")
+    frozen.save_frozen_graph(frozen_file)
+    reloaded = PolicyValueNet(args, size, size, model_file=frozen_file, inference_only=True)
+    for inference_net in [frozen, reloaded]:
+        frozen_act_probs, frozen_value = inference_net.policy_value(states)
+        assert np.abs(frozen_act_probs - act_probs).max() < 1e-5
+        assert np.abs(frozen_value - value).max() < 1e-5
+        (moves, value_fn), = inference_net.policy_value_fn_batch(random_positions(size, size, 1))
+        assert isinstance(value_fn, float)
+    with pytest.raises(Exception):
+        frozen.save_model(model_file)
+
+
+def test_nets_have_their_own_graphs(tmp_path):
+    args = argparse.Namespace(n_layer_resnet=-1)
+    size = 6
+    states = _states(size, 4)
+    nets = [PolicyValueNet(args, size, size) for _ in range(2)]
+    assert nets[0].graph is not nets[1].graph
+    outputs = [net.policy_value(states)[0] for net in nets]
+    # restoring one net leaves the other as it was
+    model_file = str(tmp_path / "policy.model")
+    nets[0].save_model(model_file)
+    nets[1].restore_model(model_file)
+    assert np.abs(nets[1].policy_value(states)[0] - outputs[0]).max() < 1e-6
+    assert np.abs(nets[0].policy_value(states)[0] - outputs[0]).max() < 1e-6
@@ -6,13 +6,19 @@ An implementation of the training pipeline of AlphaZero for Gomoku
 """
 
 from __future__ import print_function
-import random
 import numpy as np
 from tensorboardX import SummaryWriter
-from collections import defaultdict, deque
+from collections import defaultdict
 from game import Board, Game
 from models.mcts_pure import MCTSPlayer as MCTS_Pure
 from models.mcts_alphaZero import MCTSPlayer
+from selfplay import SelfPlayWorkerPool
+from symmetry import get_equi_data, random_symmetry
+from replay_buffer import ReplayBuffer
+from selfplay_dataset import SelfPlayDataset
+from heartbeat import Heartbeat
+from evaluation import AsyncEvaluator, copy_model, elo_difference, remove_model
+from profiling import profiler
 #from models.policy_value_net_pytorch import PolicyValueNet as PytorchPolicyValueNet # Pytorch
 #from models.policy_value_net_pytorch2 import PolicyValueNet as PytorchPolicyValueNet2 # Pytorch
 
@@ -49,6 +55,8 @@ parser.add_argument("--check_freq", default=50, type=int,help="check_freq.")
 parser.add_argument("--game_batch_num", default=1500, type=int,help="game_batch_num.")
 parser.add_argument("--best_win_ratio", default=0.0, type=int,help="best_win_ratio.")
 parser.add_argument("--pure_mcts_playout_num", default=1000, type=int,help="pure_mcts_playout_num.")
+parser.add_argument("--pure_mcts_n_rollout", default=1, type=int,
+                    help="num of random games played from each leaf by the pure mcts opponent")
 parser.add_argument("--output_dir", default="./", type=str,
                     help="The output directory where the model predictions and checkpoints will be written.")
 parser.add_argument("--continue_train", action='store_true', help="whether to continue_train")
@@ -61,15 +69,56 @@ parser.add_argument("--enable_random_logic", action='store_true',
                     help="enable random movement logic")
 parser.add_argument("--disable_equi_logic", action='store_true',
                     help="disable_equi_logic")
+parser.add_argument("--lazy_equi_logic", action='store_true',
+                    help="store only the original samples and apply a random symmetry to each sampled one in policy_update")
 parser.add_argument("--if_check_forbidden_hands", action='store_true',
                     help="if check forbidden hands, default false")
+parser.add_argument("--mcts_batch_size", default=1, type=int,
+                    help="num of MCTS leaves evaluated in one batch with virtual loss, 1 to disable it")
+parser.add_argument("--selfplay_workers", default=0, type=int,
+                    help="num of self-play worker processes running alongside training, 0 to self-play in the training process")
+parser.add_argument("--selfplay_inference_server", action='store_true',
+                    help="evaluate the boards of all self-play workers in batches with the training net")
+parser.add_argument("--inference_max_batch_size", default=32, type=int,
+                    help="max num of states in one batch of the inference server")
+parser.add_argument("--inference_max_wait", default=0.002, type=float,
+                    help="max seconds the inference server waits to fill a batch")
+parser.add_argument("--dataset_dir", default=None, type=str,
+                    help="directory of the on-disk self-play dataset, every game is appended to it and "
+                         "the data buffer is refilled from it when training restarts")
+parser.add_argument("--offline_train", action='store_true',
+                    help="train on mini-batches sampled from the whole dataset in dataset_dir, without self-play")
+parser.add_argument("--eval_workers", default=0, type=int,
+                    help="num of worker processes playing the evaluation games on a snapshot of the weights "
+                         "while training goes on, 0 to play them on the training thread")
+parser.add_argument("--keep_alive_interval", default=0, type=float,
+                    help="seconds between two dummy evaluations of a batch by the net in a background thread, "
+                         "to keep the device from looking idle, 0 to disable it")
+parser.add_argument("--prune_radius", default=0, type=int,
+                    help="only search the empty moves within this distance of a stone, e.g. 1, 2 or 3, 0 to disable it")
+parser.add_argument("--prune_top_k", default=0, type=int,
+                    help="only expand the k moves of highest prior of each node of the search, 0 to disable it")
+parser.add_argument("--solver_depth", default=0, type=int,
+                    help="max num of fours of the VCF looked for by a threat search before each mcts move, "
+                         "a forced move is played at once, 0 to disable it")
+parser.add_argument("--solver_in_tree", action='store_true',
+                    help="also run the threat search at every new leaf of the mcts")
+parser.add_argument("--use_xla", action='store_true',
+                    help="compile the frozen inference graphs of the tensorflow self-play and evaluation workers with XLA")
+parser.add_argument("--profile", action='store_true',
+                    help="time the phases of self-play and training, and add them to tensorboard after every batch")
+parser.add_argument("--mcts_cache_size", default=0, type=int,
+                    help="max number of network evaluations kept in the MCTS transposition table, 0 to disable it")
 
 args, _ = parser.parse_known_args()
 print("Print the args:")
 for key, value in sorted(args.__dict__.items()):
     print("{} = {}".format(key, value))
 
-tb_writer = SummaryWriter(args.output_dir)
+# spawned self-play workers import this file as __mp_main__,
+# they must not open a summary writer of their own
+if __name__ != '__mp_main__':
+    tb_writer = SummaryWriter(args.output_dir)
 
 class TrainPipeline():
     def __init__(self, init_model=None):
@@ -91,7 +140,16 @@ class TrainPipeline():
         self.c_puct = args.c_puct
         self.buffer_size = args.buffer_size
         self.batch_size = args.batch_size  # mini-batch size for training
-        self.data_buffer = deque(maxlen=self.buffer_size)
+        self.data_buffer = ReplayBuffer(self.buffer_size,
+                                        self.board_height,
+                                        self.board_width)
+        if args.dataset_dir is not None:
+            self.dataset = SelfPlayDataset(args.dataset_dir,
+                                           self.board_height,
+                                           self.board_width)
+            self.load_data_buffer_from_dataset()
+        else:
+            self.dataset = None
         self.play_batch_size = args.play_batch_size
         self.epochs = args.epochs  # num of train_steps for each update
         self.kl_targ = args.kl_targ
@@ -122,30 +180,39 @@ class TrainPipeline():
                                       c_puct=self.c_puct,
                                       n_playout=self.n_playout,
                                       is_selfplay=1,
-                                      ef_for_eight=args.ef_for_eight)
+                                      ef_for_eight=args.ef_for_eight,
+                                      n_batch=args.mcts_batch_size,
+                                      policy_value_batch_function=self.policy_value_net.policy_value_fn_batch,
+                                      cache_size=args.mcts_cache_size,
+                                      prune_radius=args.prune_radius,
+                                      prune_top_k=args.prune_top_k,
+                                      solver_depth=args.solver_depth,
+                                      solver_in_tree=args.solver_in_tree)
         self.logs = {}
 
     def get_equi_data(self, play_data):
         """augment the data set by rotation and flipping
         play_data: [(state, mcts_prob, winner_z), ..., ...]
         """
-        extend_data = []
-        for state, mcts_porb, winner in play_data:
-            for i in [1, 2, 3, 4]:
-                # rotate counterclockwise
-                equi_state = np.array([np.rot90(s, i) for s in state])
-                equi_mcts_prob = np.rot90(np.flipud(
-                    mcts_porb.reshape(self.board_height, self.board_width)), i)
-                extend_data.append((equi_state,
-                                    np.flipud(equi_mcts_prob).flatten(),
-                                    winner))
-                # flip horizontally
-                equi_state = np.array([np.fliplr(s) for s in equi_state])
-                equi_mcts_prob = np.fliplr(equi_mcts_prob)
-                extend_data.append((equi_state,
-                                    np.flipud(equi_mcts_prob).flatten(),
-                                    winner))
-        return extend_data
+        if args.lazy_equi_logic:
+            # the symmetries are applied in policy_update instead
+            return play_data
+        with profiler.timer('augmentation'):
+            return get_equi_data(play_data, self.board_height, self.board_width)
+
+    def load_data_buffer_from_dataset(self):
+        """warm start the data buffer with the newest samples of the dataset"""
+        if args.disable_equi_logic or args.lazy_equi_logic:
+            n_samples = self.buffer_size
+        else:
+            # each sample takes 8 places in the buffer once augmented
+            n_samples = (self.buffer_size + 7) // 8
+        states, mcts_probs, winners = self.dataset.load_latest(n_samples)
+        print("load {} samples from {}".format(len(states), args.dataset_dir))
+        play_data = list(zip(states, mcts_probs, winners))
+        if not args.disable_equi_logic:
+            play_data = self.get_equi_data(play_data)
+        self.data_buffer.extend(play_data)
 
     def collect_selfplay_data(self, n_games=1):
         """collect self-play data for training"""
@@ -155,6 +222,10 @@ class TrainPipeline():
                                                           temp=self.temp)
             play_data = list(play_data)[:]
             self.episode_len = len(play_data)
+            if profiler.enabled:
+                profiler.count('selfplay_samples', len(play_data))
+            if self.dataset is not None:
+                self.dataset.append(play_data)
             # augment the data
             if not args.disable_equi_logic:
                 play_data = self.get_equi_data(play_data)
@@ -167,6 +238,22 @@ class TrainPipeline():
                                                           temp=self.temp)
             play_data = list(play_data)[:]
             self.episode_len = len(play_data)
+            if profiler.enabled:
+                profiler.count('selfplay_samples', len(play_data))
+            if self.dataset is not None:
+                self.dataset.append(play_data)
+            # augment the data
+            if not args.disable_equi_logic:
+                play_data = self.get_equi_data(play_data)
+            self.data_buffer.extend(play_data)
+    def collect_selfplay_data_parallel(self, n_games=1):
+        """collect self-play data finished by the worker pool"""
+        for play_data in self.selfplay_pool.collect(n_games):
+            self.episode_len = len(play_data)
+            if profiler.enabled:
+                profiler.count('selfplay_samples', len(play_data))
+            if self.dataset is not None:
+                self.dataset.append(play_data)
             # augment the data
             if not args.disable_equi_logic:
                 play_data = self.get_equi_data(play_data)
@@ -176,12 +263,21 @@ class TrainPipeline():
     def policy_update(self, step_index):
         logs = {}
         """update the policy-value net"""
-        mini_batch = random.sample(self.data_buffer, self.batch_size)
-        state_batch = [data[0] for data in mini_batch]
-        mcts_probs_batch = [data[1] for data in mini_batch]
-        winner_batch = [data[2] for data in mini_batch]
+        if args.offline_train:
+            state_batch, mcts_probs_batch, winner_batch = self.dataset.sample(
+                    self.batch_size)
+        else:
+            state_batch, mcts_probs_batch, winner_batch = self.data_buffer.sample(
+                    self.batch_size)
+        if (args.lazy_equi_logic or args.offline_train) and not args.disable_equi_logic:
+            # the dataset only holds the original samples
+            state_batch, mcts_probs_batch = random_symmetry(
+                    state_batch, mcts_probs_batch,
+                    self.board_height, self.board_width)
         old_probs, old_v = self.policy_value_net.policy_value(state_batch)
         for i in range(self.epochs):
+            if profiler.enabled:
+                profiler.count('train_samples', len(state_batch))
             loss, entropy = self.policy_value_net.train_step(
                     state_batch,
                     mcts_probs_batch,
@@ -243,9 +339,17 @@ class TrainPipeline():
         current_mcts_player = MCTSPlayer(self.policy_value_net.policy_value_fn,
                                          c_puct=self.c_puct,
                                          n_playout=self.n_playout,
-                                         ef_for_eight=args.ef_for_eight)
+                                         ef_for_eight=args.ef_for_eight,
+                                         n_batch=args.mcts_batch_size,
+                                         policy_value_batch_function=self.policy_value_net.policy_value_fn_batch,
+                                         cache_size=args.mcts_cache_size,
+                                         prune_radius=args.prune_radius,
+                                         prune_top_k=args.prune_top_k,
+                                         solver_depth=args.solver_depth,
+                                         solver_in_tree=args.solver_in_tree)
         pure_mcts_player = MCTS_Pure(c_puct=5,
-                                     n_playout=self.pure_mcts_playout_num)
+                                     n_playout=self.pure_mcts_playout_num,
+                                     n_rollout=args.pure_mcts_n_rollout)
         win_cnt = defaultdict(int)
         for i in range(n_games):
             winner = self.game.start_play(current_mcts_player,
@@ -262,6 +366,9 @@ class TrainPipeline():
         result["win"] = win_cnt[1]
         result["lose"] = win_cnt[2]
         result["tie"] = win_cnt[-1]
+        result["elo"] = elo_difference(win_ratio, n_games)
+        if current_mcts_player.mcts.cache is not None:
+            result["cache_hit_rate"] = current_mcts_player.mcts.cache.hit_rate()
 
         for key, value in result.items():
             eval_key = 'eval_{}'.format(key)
@@ -271,39 +378,123 @@ class TrainPipeline():
 
         return win_ratio
 
+    def handle_async_evaluation(self, result):
+        """log the result of an evaluation of a snapshot by the evaluator,
+        and promote the snapshot if it is the best policy so far
+        """
+        print("step:{}, num_playouts:{}, win: {}, lose: {}, tie:{}, elo:{:.0f}".format(
+                result["step_index"], result["num_playouts"],
+                result["win"], result["lose"], result["tie"], result["elo"]))
+        for key in ["num_playouts", "win", "lose", "tie", "elo"]:
+            tb_writer.add_scalar('eval_{}'.format(key), result[key], result["step_index"])
+        # a result against a weaker pure mcts than the current one is only logged
+        if result["num_playouts"] == self.pure_mcts_playout_num:
+            self.update_best_policy(result["win_ratio"], result["model_file"])
+        remove_model(result["model_file"])
+
+    def update_best_policy(self, win_ratio, model_file=None):
+        """save the policy as best_policy.model if win_ratio is the best so far,
+        the current weights or the snapshot saved at model_file
+        """
+        if win_ratio > self.best_win_ratio:
+            print("New best policy!!!!!!!!")
+            self.best_win_ratio = win_ratio
+            # update the best_policy
+            if model_file is None:
+                self.policy_value_net.save_model(os.path.join(args.output_dir, 'best_policy.model'))
+            else:
+                copy_model(model_file, os.path.join(args.output_dir, 'best_policy.model'))
+            if (self.best_win_ratio == 1.0 and
+                    self.pure_mcts_playout_num < 5000):
+                self.pure_mcts_playout_num += 1000
+                self.best_win_ratio = 0.0
+
     def run(self):
         """run the training pipeline"""
+        if args.offline_train and (self.dataset is None or len(self.dataset) == 0):
+            raise Exception('offline_train needs a non-empty dataset_dir')
+        if args.offline_train and args.selfplay_workers > 0:
+            raise Exception('offline_train runs no self-play workers')
+        if args.selfplay_workers > 0:
+            self.selfplay_pool = SelfPlayWorkerPool(args, self.policy_value_net,
+                                                    args.selfplay_workers,
+                                                    use_inference_server=args.selfplay_inference_server)
+            self.selfplay_pool.start()
+        if args.keep_alive_interval > 0:
+            dummy_batch = np.zeros((self.batch_size, 4, self.board_width, self.board_height),
+                                   dtype=np.float32)
+            heartbeat = Heartbeat(lambda: self.policy_value_net.policy_value(dummy_batch),
+                                  args.keep_alive_interval)
+            heartbeat.start()
+        if args.eval_workers > 0:
+            self.evaluator = AsyncEvaluator(args, args.eval_workers)
+        if args.profile:
+            profiler.enable()
         try:
             for i in range(self.game_batch_num):
-                if args.enable_random_logic:
-                    self.collect_selfplay_data_random(self.play_batch_size)
+                if args.offline_train:
+                    print("batch i:{}".format(i+1))
+                    with profiler.timer('policy_update'):
+                        loss, entropy = self.policy_update(i)
                 else:
-                    if i < 1000:
-                        self.collect_selfplay_data(self.play_batch_size)
-                    else:
-                        self.collect_selfplay_data_random(self.play_batch_size)
+                    with profiler.timer('selfplay'):
+                        if args.selfplay_workers > 0:
+                            self.collect_selfplay_data_parallel(self.play_batch_size)
+                        elif args.enable_random_logic:
+                            self.collect_selfplay_data_random(self.play_batch_size)
+                        else:
+                            if i < 1000:
+                                self.collect_selfplay_data(self.play_batch_size)
+                            else:
+                                self.collect_selfplay_data_random(self.play_batch_size)
 
-                print("batch i:{}, episode_len:{}".format(
-                        i+1, self.episode_len))
-                if len(self.data_buffer) > self.batch_size:
-                    loss, entropy = self.policy_update(i)
+                    print("batch i:{}, episode_len:{}".format(
+                            i+1, self.episode_len))
+                    cache = self.mcts_player.mcts.cache
+                    if cache is not None and args.selfplay_workers == 0:
+                        print("mcts cache hit rate:{:.3f}".format(cache.hit_rate()))
+                        tb_writer.add_scalar('selfplay_cache_hit_rate', cache.hit_rate(), i)
+                        cache.reset_stats()
+                if not args.offline_train and len(self.data_buffer) > self.batch_size:
+                    with profiler.timer('policy_update'):
+                        loss, entropy = self.policy_update(i)
+                    if args.selfplay_workers > 0:
+                        self.selfplay_pool.publish()
                 # check the performance of the current model,
                 # and save the model params
                 if (i+1) % self.check_freq == 0:
                     print("current self-play batch: {}".format(i+1))
-                    win_ratio = self.policy_evaluate(i, n_games=6)
-                    self.policy_value_net.save_model(os.path.join(args.output_dir, 'current_policy.model'))
-                    if win_ratio > self.best_win_ratio:
-                        print("New best policy!!!!!!!!")
-                        self.best_win_ratio = win_ratio
-                        # update the best_policy
-                        self.policy_value_net.save_model(os.path.join(args.output_dir, 'best_policy.model'))
-                        if (self.best_win_ratio == 1.0 and
-                                self.pure_mcts_playout_num < 5000):
-                            self.pure_mcts_playout_num += 1000
-                            self.best_win_ratio = 0.0
+                    if self.dataset is not None:
+                        self.dataset.flush()
+                    with profiler.timer('evaluation'):
+                        if args.eval_workers > 0:
+                            self.evaluator.submit(i, self.policy_value_net,
+                                                  self.pure_mcts_playout_num, n_games=6)
+                            self.policy_value_net.save_model(os.path.join(args.output_dir, 'current_policy.model'))
+                        else:
+                            win_ratio = self.policy_evaluate(i, n_games=6)
+                            self.policy_value_net.save_model(os.path.join(args.output_dir, 'current_policy.model'))
+                            self.update_best_policy(win_ratio)
+                if args.eval_workers > 0:
+                    for result in self.evaluator.poll():
+                        self.handle_async_evaluation(result)
+                if profiler.enabled:
+                    profiler.report(tb_writer, i)
+            if args.eval_workers > 0:
+                # wait for the evaluations of the last snapshots
+                for result in self.evaluator.poll(wait=True):
+                    self.handle_async_evaluation(result)
         except KeyboardInterrupt:
             print('\n\rquit')
+        finally:
+            if args.eval_workers > 0:
+                self.evaluator.shutdown()
+            if args.keep_alive_interval > 0:
+                heartbeat.stop()
+            if args.selfplay_workers > 0:
+                self.selfplay_pool.stop()
+            if self.dataset is not None:
+                self.dataset.flush()
 
 
 if __name__ == '__main__':